@@ -0,0 +1,144 @@
+from file_database.database import FileDatabase
+from testcase import TestCaseContentManager
+
+from math import sin, pi
+from os import makedirs
+from random import Random
+
+# Generators of synthetic test data for the benchmarks. Everything is
+# generated from a seed, so the same parameters give the same data
+# (and benchmark results can be compared between commits).
+
+# Noise profiles: given a random generator and a number of samples,
+# return a list of data values. These range from data that compresses
+# well (steps, boolean) to data that doesn't compress at all (random)
+def _boolean(rng, n):
+    values, value = [], 0.0
+    for _ in range(n):
+        if rng.random() < 0.01:
+            value = 1.0 - value
+        values.append(value)
+    return values
+
+def _steps(rng, n):
+    values, value = [], 0.0
+    for _ in range(n):
+        if rng.random() < 0.005:
+            value = float(rng.randrange(-10, 10))
+        values.append(value)
+    return values
+
+def _ramps(rng, n):
+    values, value, slope = [], 0.0, 0.0
+    for _ in range(n):
+        if rng.random() < 0.005:
+            slope = rng.uniform(-0.01, 0.01)
+        value += slope
+        values.append(round(value, 3))
+    return values
+
+def _sine(rng, n):
+    period = rng.uniform(0.1, 0.5)*n
+    return [round(10.0*sin(2*pi*i/period), 3) for i in range(n)]
+
+def _gaussian(rng, n):
+    return [round(v + rng.gauss(0, 0.1), 3) for v in _sine(rng, n)]
+
+def _random(rng, n):
+    return [round(rng.uniform(-10.0, 10.0), 3) for _ in range(n)]
+
+noise_profiles = {
+    'boolean' : _boolean,
+    'steps' : _steps,
+    'ramps' : _ramps,
+    'sine' : _sine,
+    'gaussian' : _gaussian,
+    'random' : _random,
+}
+
+# Timeseries of (time, data) points sampled every sample_time
+def make_timeseries(samples, profile='steps', sample_time=0.001, seed=0):
+    if profile not in noise_profiles:
+        raise ValueError("Unknown noise profile '{}'!".format(profile))
+    values = noise_profiles[profile](Random(seed), samples)
+    return [(round(i*sample_time, 6), v) for i, v in enumerate(values)]
+
+# Run data for the expected timeseries: the expected data delayed by
+# latency samples, with noise (up to noise either way) on top
+def make_run_data(expected, latency=0, noise=0.0, seed=0):
+    rng = Random(seed)
+    data = [v for _, v in expected]
+    data = data[:1]*latency + data[:len(data) - latency]
+    return [(t, round(v + rng.uniform(-noise, noise), 3)) \
+            for (t, _), v in zip(expected, data)]
+
+# Testcase (not written yet) with the given number of signals in each
+# section, where every timeseries has the given number of samples
+def make_testcase(filepath, signals=4, samples=1000, profile='steps', seed=0, \
+        obj_class=TestCaseContentManager):
+    testcase = obj_class(filepath)
+    rng = Random(seed)
+    testcase.set_title('Benchmark case {}'.format(seed))
+    testcase.set_description('Generated with the {} profile'.format(profile))
+    for i in range(signals):
+        name = 'sig-{}'.format(i)
+        testcase.add_section_obj('setup', name=name, value=str(rng.randrange(100)))
+        for section in ['action', 'verify']:
+            timeseries = make_timeseries(samples, profile, seed=rng.randrange(2**32))
+            testcase.add_section_obj(section, name=name, timeseries=timeseries, \
+                    sample_time=0.001, lsb=0.01, latency=0.002, variance=0.1)
+    return testcase
+
+# Database of testcases (in directories of up to 100 testcases),
+# written to the root directory
+def make_database(root, cases=100, signals=4, samples=1000, profile='steps', seed=0, \
+        obj_class=TestCaseContentManager, **db_options):
+    makedirs(root, exist_ok=True)
+    db = FileDatabase(root, obj_class=obj_class, ext='xml', **db_options)
+    for i in range(cases):
+        basename = 'group-{:03d}/case-{:05d}'.format(i // 100, i)
+        testcase = make_testcase(db._fullpath_from(basename), signals, samples, \
+                profile, seed + i, obj_class)
+        db.add_obj(basename, testcase._contents)
+    return db
+
+if __name__ == '__main__':
+    from timeseries.compression import compress
+    from shutil import rmtree
+    from os.path import exists as file_exists
+
+    # Profiles are reproducible, and compress differently
+    for profile in noise_profiles:
+        timeseries = make_timeseries(1000, profile, seed=1)
+        assert(timeseries == make_timeseries(1000, profile, seed=1))
+        assert(len(timeseries) == 1000 and timeseries[-1][0] == 0.999)
+    assert(make_timeseries(10, 'steps', seed=1) != make_timeseries(10, 'random', seed=1))
+    ratio = lambda p: len(compress(make_timeseries(1000, p))[0])/1000.
+    assert(ratio('steps') < ratio('sine') < ratio('random'))
+    try:
+        make_timeseries(10, 'unknown')
+        assert(False)
+    except ValueError:
+        pass
+
+    expected = make_timeseries(100, 'ramps')
+    actual = make_run_data(expected, latency=2)
+    assert([t for t, _ in actual] == [t for t, _ in expected])
+    assert(actual[2:] == [(t, v) for (t, _), (_, v) in zip(expected[2:], expected)])
+    assert(all(abs(a - e) <= 0.5 + 1e-9 for (_, a), (_, e) in \
+            zip(make_run_data(expected, noise=0.5), expected)))
+
+    test_dir = 'test-benchmark-db'
+    if file_exists(test_dir):
+        rmtree(test_dir)
+    db = make_database(test_dir, cases=3, signals=2, samples=50, index=True)
+    assert([e.basename for e in db.get_listing()] == \
+            ['group-000/case-00000', 'group-000/case-00001', 'group-000/case-00002'])
+    testcase = next(iter(db.get_objs('group-000/case-00001')))
+    assert(testcase.get_title() == 'Benchmark case 1')
+    times, data = testcase.get_timeseries('verify', 'sig-1')
+    assert(len(times) == len(data) == 50)
+    assert(testcase.get_metadata()['signals'] == ['sig-0', 'sig-1']*3)
+    db.close()
+    rmtree(test_dir)
+    print("Benchmark datasets Testing Passed!")
@@ -0,0 +1,243 @@
+from .datasets import noise_profiles, make_timeseries, make_run_data, \
+        make_database
+from file_database.database import FileDatabase
+from file_database.traverse import traverse, compile_path
+from sections import section_classes
+from testcase import TestCaseContentManager
+from timeseries.compression import compress, uncompress
+from timeseries.exceedence import get_exceedences, get_segment_exceedences
+from timeseries.pyramid import Pyramid
+from timeseries.vectorized import to_arrays
+
+from collections import OrderedDict
+from fnmatch import fnmatch
+from gc import collect as gc_collect
+from json import dump as json_dump, load as json_load
+from os.path import getsize as file_size
+from platform import platform, python_version
+from shutil import rmtree
+from subprocess import check_output, CalledProcessError
+from tempfile import mkdtemp
+from time import perf_counter, strftime
+import tracemalloc
+
+# Benchmarks of the hot paths: the database (loading, querying and
+# applying functions to testcases), XML reading and writing, tree
+# traversal, compression, exceedence checks and plotting pyramids.
+#
+# Each benchmark is timed over a number of runs (the best run is the
+# one that counts, the rest being noise), and run once more under
+# tracemalloc for its peak memory. Results are saved as JSON along
+# with the parameters and commit, so they can be compared later:
+#
+#   python -m benchmarks.run --output before.json
+#   python -m benchmarks.run --compare before.json
+
+# Time func() over repeat runs (calling setup() before each one, untimed)
+# and measure its peak memory in one more run. items is the number of
+# things (e.g. cases, points or bytes) each run handles, for throughput.
+# If func returns a dict, it is added to the result (e.g. ratios)
+def measure(func, items=1, unit='items', repeat=3, setup=None):
+    times = []
+    extra = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc_collect()
+        start = perf_counter()
+        extra = func()
+        times.append(perf_counter() - start)
+    if setup:
+        setup()
+    gc_collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result = OrderedDict([
+        ('best_s', min(times)),
+        ('mean_s', sum(times)/len(times)),
+        ('items', items),
+        ('unit', unit),
+        (unit + '_per_s', items/min(times) if min(times) > 0 else None),
+        ('peak_bytes', peak)
+    ])
+    if isinstance(extra, dict):
+        result.update(extra)
+    return result
+
+def format_result(name, result):
+    line = '{:28s} {:10.4f} s  {:12.1f} {:>12s}  {:8.2f} MB'.format(name, \
+            result['best_s'], result[result['unit'] + '_per_s'] or 0, \
+            result['unit'] + '/s', result['peak_bytes']/1e6)
+    extra = [k for k in result if k not in \
+            ('best_s', 'mean_s', 'items', 'unit', result['unit'] + '_per_s', 'peak_bytes')]
+    return line + ''.join('  {}={:.4g}'.format(k, result[k]) for k in extra)
+
+def git_commit():
+    try:
+        return check_output(['git', 'rev-parse', '--short', 'HEAD'], \
+                universal_newlines=True).strip()
+    except (OSError, CalledProcessError):
+        return None
+
+# Run the benchmarks (all of them, or the ones with names matching the
+# only pattern) over a generated dataset in workdir. Returns the results
+# by benchmark name, printing each as it finishes
+def run_benchmarks(workdir, cases=100, signals=4, samples=1000, profile='steps', \
+        repeat=3, only=None, verbose=True):
+    results = OrderedDict()
+    def wanted(*names):
+        return not only or any(fnmatch(name, only) for name in names)
+    def run(name, func, items=1, unit='items', setup=None):
+        if not wanted(name):
+            return
+        results[name] = measure(func, items, unit, repeat, setup)
+        if verbose:
+            print(format_result(name, results[name]))
+
+    # Database (written and read as XML testcases)
+    root = workdir + '/db'
+    def clear_root():
+        rmtree(root, ignore_errors=True)
+    run('db_write', lambda: make_database(root, cases, signals, samples, profile).close(), \
+            cases, 'cases', setup=clear_root)
+    if not wanted('db_*', 'xml_*', 'traverse*'):
+        return run_timeseries_benchmarks(run, signals, samples, profile, results)
+    if not wanted('db_write'):
+        make_database(root, cases, signals, samples, profile).close()
+    # No cache, so every run loads the testcases again
+    db = FileDatabase(root, obj_class=TestCaseContentManager, ext='xml', cache_size=0)
+    run('db_get_objs', lambda: list(db.get_objs()), cases, 'cases')
+    run('db_query', lambda: list(db.query(lambda o: 'sig-0' in \
+            o.get_metadata()['signals'])), cases, 'cases')
+    run('db_apply', lambda: db.apply(lambda o: [o.get_section_objs(s) \
+            for s in section_classes]), cases, 'cases')
+    db.close()
+
+    # XML reading (in full) and writing
+    fullpaths = db.get_fullpaths()
+    size = sum(file_size(f) for f in fullpaths)
+    objs = [TestCaseContentManager(f) for f in fullpaths]
+    [o._contents for o in objs]
+    run('xml_read', lambda: [TestCaseContentManager(f)._contents for f in fullpaths], \
+            size, 'bytes')
+    def write():
+        for obj in objs:
+            obj.mark_dirty()
+            obj._write()
+    run('xml_write', write, size, 'bytes')
+
+    # Tree traversal, both parsing paths each time and compiled
+    tree = objs[0]._contents
+    paths = ['root/testcase/title', 'root/testcase/@uid', 'root/testcase/description']
+    # (A section with one signal isn't a list)
+    if signals > 1:
+        paths.extend('root/testcase/{}/{}/@name'.format(s, i) \
+                for s in ['action', 'verify'] for i in range(signals))
+    compiled = [compile_path(p) for p in paths]
+    N = 10000
+    run('traverse', lambda: [traverse(tree, p) for _ in range(N) for p in paths], \
+            N*len(paths), 'lookups')
+    run('traverse_compiled', lambda: [c.get(tree) for _ in range(N) for c in compiled], \
+            N*len(paths), 'lookups')
+    del objs, tree
+    return run_timeseries_benchmarks(run, signals, samples, profile, results)
+
+# The benchmarks that don't need the database
+def run_timeseries_benchmarks(run, signals, samples, profile, results):
+    # Compression, of all the samples of a testcase at once
+    points = samples*signals
+    timeseries = make_timeseries(points, profile)
+    compressed, update_rate = compress(timeseries)
+    run('compress', lambda: {'compression_ratio': \
+            len(compress(timeseries)[0])/float(len(timeseries))}, points, 'points')
+    run('uncompress', lambda: uncompress(compressed, update_rate), points, 'points')
+
+    # Exceedences, of run data delayed by a sample (within the
+    # latency of 2 samples) and with noise (some out of bounds)
+    expected = timeseries
+    actual = make_run_data(expected, latency=1, noise=0.15)
+    check = dict(sample_time=0.001, lsb=0.01, latency=0.002, variance=0.1)
+    run('get_exceedences', lambda: {'exceedences': \
+            len(get_exceedences(actual, expected, **check))}, points, 'points')
+    actual_compressed = compress(actual)[0]
+    run('get_segment_exceedences', lambda: {'exceedences': \
+            len(get_segment_exceedences(actual_compressed, compressed, **check))}, \
+            points, 'points')
+
+    # Pyramids, built and queried for windows of a tenth of
+    # the timeseries, plotted 1000 pixels wide
+    times, data = to_arrays(timeseries)
+    run('pyramid_build', lambda: Pyramid.build(data), points, 'points')
+    pyramid = Pyramid.build(data)
+    span = times[-1] - times[0]
+    windows = [(times[0] + span*i/100., times[0] + span*(i + 10)/100.) for i in range(90)]
+    run('pyramid_query', lambda: [pyramid.query(times, data, t0, t1, 1000) \
+            for t0, t1 in windows], len(windows), 'queries')
+    return results
+
+# Compare results against older results, giving the change in the best
+# time of every benchmark in both as (name, old time, new time, ratio)
+def compare_results(old, new):
+    changes = []
+    for name, result in new['results'].items():
+        if name in old['results']:
+            old_time = old['results'][name]['best_s']
+            changes.append((name, old_time, result['best_s'], \
+                    result['best_s']/old_time if old_time > 0 else float('inf')))
+    return changes
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from sys import exit
+
+    parser = ArgumentParser(description="Benchmark the database, XML and timeseries code")
+    parser.add_argument('--cases', type=int, default=100, help="testcases in the database")
+    parser.add_argument('--signals', type=int, default=4, help="signals per section")
+    parser.add_argument('--samples', type=int, default=1000, help="samples per signal")
+    parser.add_argument('--profile', choices=sorted(noise_profiles), default='steps', \
+            help="noise profile of the generated data")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs of each benchmark")
+    parser.add_argument('--only', help="run the benchmarks matching this pattern")
+    parser.add_argument('--output', help="save the results to this JSON file")
+    parser.add_argument('--compare', help="compare against results saved in this JSON file")
+    parser.add_argument('--threshold', type=float, default=0.2, \
+            help="slowdown (as a fraction) that counts as a regression")
+    args = parser.parse_args()
+
+    workdir = mkdtemp(prefix='noisy-fox-bench-')
+    try:
+        results = run_benchmarks(workdir, args.cases, args.signals, args.samples, \
+                args.profile, args.repeat, args.only)
+    finally:
+        rmtree(workdir, ignore_errors=True)
+    report = OrderedDict([
+        ('commit', git_commit()),
+        ('date', strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', python_version()),
+        ('platform', platform()),
+        ('params', OrderedDict((k, getattr(args, k)) for k in \
+                ['cases', 'signals', 'samples', 'profile', 'repeat'])),
+        ('results', results)
+    ])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json_dump(report, f, indent=2)
+
+    regressions = 0
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            old = json_load(f)
+        if old['params'] != report['params']:
+            print("Warning: comparing against results with other parameters {}".format( \
+                    dict(old['params'])))
+        print("\nCompared to {} ({}):".format(args.compare, old.get('commit')))
+        for name, old_time, new_time, ratio in compare_results(old, report):
+            regressed = ratio > 1 + args.threshold
+            regressions += regressed
+            print('{:28s} {:10.4f} s -> {:10.4f} s  {:+7.1f}%{}'.format(name, \
+                    old_time, new_time, 100*(ratio - 1), '  REGRESSION' if regressed else ''))
+    exit(1 if regressions else 0)
@@ -0,0 +1,142 @@
+from .metrics import profiled
+
+from asyncio import wrap_future
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from threading import Lock
+
+class AsyncFileDatabase(object):
+    '''
+    Awaitable interface to a FileDatabase, for serving it asynchronously
+    (e.g. from async views) without blocking on file globbing and parsing.
+
+    Database work runs on a bounded pool of threads, so a slow search
+    can't use every thread at once. Concurrent loads of the same
+    basename are coalesced into one load, which every caller awaits.
+    Futures are shared across event loops, so requests can come from
+    different threads (as with Flask, which runs each async view in
+    its own event loop).
+
+    Work runs in the context of the caller, so its timings and profiles
+    go to the request it is for (see metrics). A coalesced load is
+    counted for the request that started it.
+    '''
+    def __init__(self, db, workers=4):
+        self.db = db
+        self._executor = ThreadPoolExecutor(workers)
+        # Loads in progress, by basename
+        self._loading = {}
+        self._loading_lock = Lock()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _submit(self, func, *args, **kwargs):
+        return self._executor.submit(copy_context().run, profiled, func, *args, **kwargs)
+
+    # Run func(*args, **kwargs) on the pool of threads
+    async def run(self, func, *args, **kwargs):
+        return await wrap_future(self._submit(func, *args, **kwargs))
+
+    # Load the object with the basename (None if there is no such object)
+    async def get_obj(self, basename):
+        with self._loading_lock:
+            future = self._loading.get(basename)
+            if future is None:
+                future = self._submit(self._load, basename)
+                self._loading[basename] = future
+                future.add_done_callback(lambda f: self._done_loading(basename, f))
+        return await wrap_future(future)
+
+    def _load(self, basename):
+        return next(iter(self.db.get_objs(basename)), None)
+
+    def _done_loading(self, basename, future):
+        with self._loading_lock:
+            if self._loading.get(basename) is future:
+                del self._loading[basename]
+
+    async def get_objs(self, fileglob='**/*'):
+        return await self.run(lambda: list(self.db.get_objs(fileglob)))
+
+    async def get_listing(self, fileglob='**/*', **filters):
+        return await self.run(self.db.get_listing, fileglob, **filters)
+
+    async def lookup(self, query):
+        return await self.run(self.db.lookup, query)
+
+    async def add_obj(self, basename, obj_content=None):
+        return await self.run(self.db.add_obj, basename, obj_content)
+
+    async def query(self, query, objs=None):
+        return await self.run(lambda: list(self.db.query(query, objs)))
+
+    async def apply(self, func, objs=None):
+        return await self.run(self.db.apply, func, objs)
+
+    # Apply the function inside a batch, writing the changes together
+    async def batch_apply(self, func, objs=None):
+        def batch_apply():
+            with self.db.batch():
+                return self.db.apply(func, objs)
+        return await self.run(batch_apply)
+
+    async def flush(self):
+        return await self.run(self.db.flush)
+
+if __name__ == '__main__':
+    from .basic_file_manager import FileContentManager
+    from .database import FileDatabase
+    from asyncio import gather, run as run_async
+    from os import mkdir, rmdir
+    from threading import Thread
+    from time import sleep
+
+    # Count (slow) loads
+    loads = []
+    class SlowContentManager(FileContentManager):
+        def _read(self):
+            loads.append(self._filepath)
+            sleep(0.1)
+            return super()._read()
+
+    test_dir = 'async_testdb'
+    mkdir(test_dir)
+    db = FileDatabase(test_dir, obj_class=SlowContentManager, cache_size=0)
+    adb = AsyncFileDatabase(db, workers=2)
+
+    async def test():
+        await gather(*(adb.add_obj('file-{}'.format(i), 'File {}'.format(i)) \
+                for i in range(4)))
+        # Concurrent loads of the same object are coalesced
+        objs = await gather(*([adb.get_obj('file-0')]*8 + [adb.get_obj('file-1')]*8))
+        assert(len(loads) == 2)
+        assert(all(o is objs[0] for o in objs[:8]) and all(o is objs[8] for o in objs[8:]))
+        assert(str(objs[0]) == 'File 0' and str(objs[8]) == 'File 1')
+        assert(await adb.get_obj('missing') is None)
+        # Later loads load again (the database cache is off)
+        await adb.get_obj('file-0')
+        assert(len(loads) == 3)
+        # Other database work runs on the pool too
+        del loads[:]
+        assert(len(await adb.get_objs()) == 4)
+        assert(len(loads) == 4)
+        await adb.batch_apply(lambda o: o.update_contents('Changed'), objs=objs[:1])
+        assert(len(await adb.query(lambda o: str(o) == 'Changed')) == 1)
+
+    run_async(test())
+
+    # Loads are also coalesced across event loops (in other threads)
+    del loads[:]
+    results = []
+    threads = [Thread(target=lambda: results.append(run_async(adb.get_obj('file-2')))) \
+            for _ in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert(len(loads) == 1 and all(o is results[0] for o in results))
+
+    run_async(adb.apply(lambda o: o.delete()))
+    adb.close()
+    db.close()
+    rmdir(test_dir)
+    print("AsyncFileDatabase() Testing Passed!")
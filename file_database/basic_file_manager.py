@@ -1,5 +1,54 @@
-from os import remove as file_remove
-from os.path import isfile as file_exists
+from .metrics import timed, timer
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import remove as file_remove, stat as file_stat, \
+        replace as file_replace, chmod as file_chmod, fdopen
+from os.path import isfile as file_exists, split as path_split, join as path_join
+from json import loads as json_loads
+from stat import S_IMODE as file_mode
+from tempfile import mkstemp
+from threading import Lock, RLock
+
+# Journal of changes made to a file since it was last written
+# in full, next to it (hidden, so it isn't picked up by globbing)
+def journal_path(filepath):
+    directory, filename = path_split(filepath)
+    return path_join(directory, '.' + filename + '.journal')
+
+# Writes to a file and its journal (by filepath) are made holding its
+# lock, so a journal is never compacted while it is being appended to
+_journal_locks = {}
+_journal_locks_lock = Lock()
+
+def journal_lock(filepath):
+    with _journal_locks_lock:
+        return _journal_locks.setdefault(filepath, RLock())
+
+# Changes made inside deferred_writes() (in the same thread or task)
+# are not written when made, as if their objects were write_behind
+_deferred_writes = ContextVar('deferred_writes', default=False)
+
+@contextmanager
+def deferred_writes():
+    token = _deferred_writes.set(True)
+    try:
+        yield
+    finally:
+        _deferred_writes.reset(token)
+
+class ConflictError(ValueError):
+    '''
+    Raised instead of writing an object whose file was changed (or
+    removed) by someone else since the object read or last wrote it,
+    so those changes aren't overwritten. The object, with its unwritten
+    changes, is kept as obj.
+    '''
+    def __init__(self, filepath, obj=None):
+        super().__init__("File '{}' was changed by someone else!".format(filepath))
+        self.filepath = filepath
+        self.obj = obj
+
 class FileContentManager(object):
     '''
     Class that takes care of loading and manipulating
@@ -9,14 +58,58 @@ class FileContentManager(object):
     The representative file is only written to on object
     removal (from memory), saving unnecessary reads/writes
     until necessary (no longer desire to hold object in memory)
+
+    If write_behind is set (or inside deferred_writes()), update_contents()
+    and move() only mark the object as dirty, and the file is written by the next _write() (see
+    FileDatabase.flush()). Writes go to a temporary file which then
+    replaces the representative file, so readers never see a partially
+    written file.
+
+    If journal is set, changes that are given as journal entries (see
+    mark_dirty()) are written by appending them to a journal next to
+    the file, instead of writing the whole file. The journal is replayed
+    (see _replay()) whenever the file is read, and removed the next
+    time the whole file is written (see compact()). Entries must be
+    idempotent, as the file could be written before its journal is
+    removed.
+
+    The stat() of the file is kept as of when it was read or written,
+    and if it changed by the next write, a ConflictError is raised
+    instead of overwriting someone else's changes.
     '''
+    write_behind = False
+    journal = False
+    # Size of journal (in bytes) worth compacting
+    journal_limit = 64*1024
+
     def __init__(self, filepath, new_contents=None):
         self._filepath = filepath
+        # Called as on_change(obj, event, filepath) whenever the
+        # representative file is written ('write') or removed ('delete'),
+        # or the contents first differ from the file ('dirty')
+        self._on_change = None
+        # Set when the contents in memory differ from the file
+        self._dirty = False
+        # stat() of the file when it was last read or written
+        # (None if it hasn't been yet), to detect conflicts
+        self._stat = None
+        # File left behind by a deferred move, removed on next write
+        self._stale_filepath = None
+        # Journal entries for the changes since the file was written,
+        # or None if the whole file has to be written
+        self._journal_entries = None
+        self._journal_size = 0
         # Allow initializing new file from provided contents
         if file_exists(filepath):
-            self._contents = self._read()
+            self._stat = self.stat(filepath)
+            with timer('file.read'):
+                self._contents = self._read()
+            self._journal_entries = []
+            if self.journal:
+                self._replay_journal()
         elif new_contents:
             self._contents = new_contents
+            self._dirty = True
     
     # Override this to update write() method
     def __str__(self):
@@ -25,32 +118,183 @@ class FileContentManager(object):
     def __repr__(self):
         return  "{0}('{1}')".format(self.__class__.__name__, self._filepath)
     
+    # Modification time and size of the representative file,
+    # used to tell if a file has changed since it was last seen
+    # (including the journal, if any)
+    @classmethod
+    def stat(cls, filepath):
+        st = file_stat(filepath)
+        if cls.journal and file_exists(journal_path(filepath)):
+            journal_st = file_stat(journal_path(filepath))
+            return max(st.st_mtime, journal_st.st_mtime), st.st_size + journal_st.st_size
+        return st.st_mtime, st.st_size
+
+    # Version of the contents (their file's stat()), which changes whenever
+    # they are written, or None while they aren't all written to the file
+    def get_version(self):
+        if self._dirty or not self._filepath or not file_exists(self._filepath):
+            return None
+        return self.stat(self._filepath)
+
+    # Write the whole file (and remove its journal) if it has one
+    # Returns the compacted object, or None if there was no journal
+    @classmethod
+    def compact(cls, filepath):
+        with journal_lock(filepath):
+            if file_exists(filepath) and file_exists(journal_path(filepath)):
+                obj = cls(filepath)
+                obj._write()
+                return obj
+
+    # Override this to provide metadata for indexing.
+    # Text contents are indexed in full (see index.get_terms())
+    def get_metadata(self):
+        return {'text': [self._contents]} if isinstance(self._contents, str) else {}
+
+    # Mark the contents as changed without writing them yet.
+    # If the change is given as a journal entry (a line of JSON, which
+    # _replay() can apply), it can be written by appending it to the
+    # journal. Otherwise, the whole file is written
+    def mark_dirty(self, journal_entry=None):
+        if journal_entry is None or not self.journal:
+            self._journal_entries = None
+        elif self._journal_entries is not None:
+            self._journal_entries.append(journal_entry)
+        if not self._dirty:
+            self._dirty = True
+            self._notify('dirty', self._filepath)
+
+    def _notify(self, event, filepath):
+        if self._on_change:
+            self._on_change(self, event, filepath)
+
     def _read(self):
         with open(self._filepath, 'r') as f:
             return f.read()
 
+    # Override this to apply journal entries
+    def _replay(self, entry):
+        raise ValueError("Can't replay journal entry {}!".format(entry))
+
+    def _replay_journal(self):
+        if file_exists(journal_path(self._filepath)):
+            with open(journal_path(self._filepath), 'r') as f:
+                for line in f:
+                    try:
+                        entry = json_loads(line)
+                    except ValueError:
+                        break # Partially written
+                    self._replay(entry)
+            self._journal_size = file_stat(journal_path(self._filepath)).st_size
+
+    # Override this to update write() method,
+    # by default str() shows how to write it out of the file
+    def _write_to(self, f):
+        f.write(str(self))
+
+    # Raise a ConflictError if the file changed since it was read
+    # or written (by stat(), which covers the journal)
+    def _check_conflict(self):
+        if self._stat is None:
+            return
+        try:
+            stat = self.stat(self._filepath)
+        except OSError:
+            stat = None
+        if stat != self._stat:
+            raise ConflictError(self._filepath, self)
+
+    @timed('file.write')
     def _write(self):
         if self._filepath:
-            with open(self._filepath, 'w') as f:
-                # Use str() to show how to
-                # write it out of the file
-                f.write(str(self))
+            if self.journal:
+                with journal_lock(self._filepath):
+                    self._check_conflict()
+                    if self._journal_entries and file_exists(self._filepath):
+                        self._append_journal()
+                    else:
+                        self._write_file()
+                    self._stat = self.stat(self._filepath)
+            else:
+                self._check_conflict()
+                self._write_file()
+                self._stat = self.stat(self._filepath)
+            self._journal_entries = []
+            self._dirty = False
+            self._remove_stale()
+            self._notify('write', self._filepath)
     
+    def _write_file(self):
+        # Write next to the file (hidden, so it isn't picked up
+        # by globbing) and then replace it in one step
+        directory, filename = path_split(self._filepath)
+        fd, temp_filepath = mkstemp(dir=directory or '.', \
+                prefix='.' + filename + '.', suffix='.tmp')
+        try:
+            with fdopen(fd, 'w') as f:
+                self._write_to(f)
+            mode = file_mode(file_stat(self._filepath).st_mode) \
+                    if file_exists(self._filepath) else 0o644
+            file_chmod(temp_filepath, mode)
+            file_replace(temp_filepath, self._filepath)
+        except BaseException:
+            file_remove(temp_filepath)
+            raise
+        # Everything in the journal is in the file now
+        if self.journal and file_exists(journal_path(self._filepath)):
+            file_remove(journal_path(self._filepath))
+        self._journal_size = 0
+
+    def _append_journal(self):
+        with open(journal_path(self._filepath), 'a') as f:
+            f.write(''.join(entry + '\n' for entry in self._journal_entries))
+            self._journal_size = f.tell()
+
+    def _remove_stale(self):
+        if self._stale_filepath:
+            if file_exists(journal_path(self._stale_filepath)):
+                file_remove(journal_path(self._stale_filepath))
+            if file_exists(self._stale_filepath):
+                file_remove(self._stale_filepath)
+                self._notify('delete', self._stale_filepath)
+            self._stale_filepath = None
+
+    # Whether changes made now are written later (see write_behind)
+    def _writes_behind(self):
+        return self.write_behind or _deferred_writes.get()
+
     def update_contents(self, new_contents):
         self._contents = new_contents
-        self._write() #TODO: FileDatabase().maintain-references
+        if self._writes_behind():
+            self.mark_dirty()
+        else:
+            self._write()
 
     def delete(self):
+        self._remove_stale()
+        if self._filepath and file_exists(journal_path(self._filepath)):
+            file_remove(journal_path(self._filepath))
         if file_exists(self._filepath):
             # In case file has loaded but is not
             # saved yet (e.g. file contents in memory)
             file_remove(self._filepath)
+            self._notify('delete', self._filepath)
         self._filepath = None
+        self._stat = None
+        self._dirty = False
 
     def move(self, new_filepath):
-        self.delete()
-        self._filepath = new_filepath
-        self._write() #TODO: FileDatabase().maintain-references
+        if self._writes_behind():
+            # Keep the old file until the new one is written
+            if not self._stale_filepath and file_exists(self._filepath):
+                self._stale_filepath = self._filepath
+            self._filepath = new_filepath
+            self._stat = None
+            self.mark_dirty()
+        else:
+            self.delete()
+            self._filepath = new_filepath
+            self._write()
 
 if __name__ == '__main__':
     # We can create a new file by making a new object with
@@ -102,4 +346,58 @@ if __name__ == '__main__':
     del obj
     assert(not file_exists(fname))
 
+    # Changes to the representative file are reported to the listener
+    events = []
+    obj = FileContentManager(fname, new_contents=contents)
+    obj._on_change = lambda o, event, filepath: events.append((event, filepath))
+    obj._write()
+    obj.move(fname.replace('rename', 'new'))
+    obj.delete()
+    assert(events == [('write', fname), ('delete', fname), \
+            ('write', fname.replace('rename', 'new')), \
+            ('delete', fname.replace('rename', 'new'))])
+
+    # In write-behind mode, changes are only written when told
+    obj = FileContentManager(fname, new_contents=contents)
+    assert(obj.get_version() is None)
+    obj._write()
+    version = obj.get_version()
+    assert(version == FileContentManager.stat(fname))
+    obj.write_behind = True
+    obj.update_contents(contents.replace('new', 'deferred'))
+    assert(obj.get_version() is None)
+    obj.move(fname.replace('rename', 'deferred'))
+    with open(fname, 'r') as f:
+        assert(contents == f.read())
+    assert(not file_exists(obj._filepath))
+    obj._write()
+    assert(not file_exists(fname))
+    with open(obj._filepath, 'r') as f:
+        assert(contents.replace('new', 'deferred') == f.read())
+    obj.delete()
+    assert(not file_exists(fname.replace('rename', 'deferred')))
+
+    # Changes made by someone else aren't overwritten
+    obj = FileContentManager(fname, new_contents=contents)
+    obj._write()
+    other = FileContentManager(fname)
+    other.update_contents('Changed by someone else')
+    obj.write_behind = True
+    obj.update_contents('Changed here')
+    try:
+        obj._write()
+        assert(False)
+    except ConflictError as e:
+        assert(e.obj is obj and obj._dirty)
+    with open(fname, 'r') as f:
+        assert(f.read() == 'Changed by someone else')
+    # Nor are removed files written again
+    other.delete()
+    try:
+        obj._write()
+        assert(False)
+    except ConflictError:
+        pass
+    assert(not file_exists(fname))
+
     print("FileContentManager() Testing Passed!")
@@ -0,0 +1,201 @@
+from .basic_file_manager import ConflictError
+
+from collections import OrderedDict
+from threading import RLock
+
+class ObjectCache(object):
+    '''
+    Least-recently-used cache of loaded database objects, keyed by
+    the fullpath of their representative file.
+
+    Each entry remembers the (mtime, size) of its file when it was
+    loaded or last written, so an object is reloaded if its file was
+    changed by someone else. The total size of the cached files is kept
+    under max_size bytes (and optionally under max_entries objects),
+    evicting the least recently used objects first. Evicted objects
+    that have unwritten changes are written back to their file.
+
+    An object with unwritten changes whose file was changed by someone
+    else is in conflict (see ConflictError): it is dropped from the
+    cache, and the conflict is raised instead of returning it (or
+    writing it over the file).
+    '''
+    def __init__(self, max_size=16*1024, max_entries=None):
+        self._max_size = max_size
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, fullpath):
+        return fullpath in self._entries
+
+    # Return the cached object for fullpath if it is still current
+    # given the file's (mtime, size), otherwise None
+    def get(self, fullpath, stat):
+        with self._lock:
+            entry = self._entries.get(fullpath)
+            if entry is None:
+                return None
+            obj, cached_stat = entry
+            if cached_stat != stat:
+                self.remove(fullpath)
+                if obj._dirty:
+                    raise ConflictError(fullpath, obj)
+                return None
+            self._entries.move_to_end(fullpath)
+            return obj
+
+    def put(self, fullpath, obj, stat):
+        with self._lock:
+            self.remove(fullpath)
+            self._entries[fullpath] = (obj, stat)
+            self._size += stat[1]
+            self._evict()
+
+    # Remove the entry for fullpath (only if it is for obj, if given)
+    def remove(self, fullpath, obj=None):
+        with self._lock:
+            entry = self._entries.get(fullpath)
+            if entry is None or (obj is not None and entry[0] is not obj):
+                return None
+            del self._entries[fullpath]
+            self._size -= entry[1][1]
+            return entry
+
+    # Evict least recently used objects until we are in budget,
+    # but always keep the most recently used object
+    def _evict(self):
+        while len(self._entries) > 1 and (self._size > self._max_size or \
+                (self._max_entries and len(self._entries) > self._max_entries)):
+            _, (obj, stat) = self._entries.popitem(last=False)
+            self._size -= stat[1]
+            if obj._dirty:
+                try:
+                    obj._write()
+                except ConflictError:
+                    # Still dirty, so whoever keeps track of unwritten
+                    # changes (e.g. FileDatabase) raises it on flush
+                    pass
+
+    # Write back all objects with unwritten changes,
+    # then raise the first conflict (if any)
+    def flush(self):
+        conflicts = []
+        with self._lock:
+            for fullpath, (obj, _) in list(self._entries.items()):
+                if obj._dirty:
+                    try:
+                        obj._write()
+                    except ConflictError as e:
+                        self.remove(fullpath)
+                        conflicts.append(e)
+        if conflicts:
+            raise conflicts[0]
+
+    # Note that the file was rewritten by someone else with the same
+    # contents (e.g. its journal compacted), from old_stat to new_stat,
+    # so the cached object (if cached at old_stat) is still current
+    def rewritten(self, fullpath, old_stat, new_stat):
+        with self._lock:
+            entry = self._entries.get(fullpath)
+            if entry is not None and entry[1] == old_stat:
+                obj = entry[0]
+                self._entries[fullpath] = (obj, new_stat)
+                self._size += new_stat[1] - old_stat[1]
+                if obj._stat == old_stat:
+                    obj._stat = new_stat
+
+    def clear(self):
+        with self._lock:
+            try:
+                self.flush()
+            finally:
+                self._entries.clear()
+                self._size = 0
+
+if __name__ == '__main__':
+    # Stand-in objects, only tracking writes (and conflicting
+    # if their file is set to have changed)
+    class Obj(object):
+        def __init__(self, name):
+            self.name = name
+            self._dirty = False
+            self._stat = None
+            self.changed = False
+            self.writes = 0
+        def _write(self):
+            if self.changed:
+                raise ConflictError(self.name, self)
+            self.writes += 1
+            self._dirty = False
+
+    cache = ObjectCache(max_size=30)
+    a, b, c = Obj('a'), Obj('b'), Obj('c')
+    cache.put('a', a, (1.0, 10))
+    cache.put('b', b, (1.0, 10))
+    cache.put('c', c, (1.0, 10))
+    assert(len(cache) == 3)
+    assert(cache.get('a', (1.0, 10)) is a) # a is now most recently used
+
+    # Least recently used is evicted first, writing it if it is dirty
+    b._dirty = True
+    cache.put('d', Obj('d'), (1.0, 10))
+    assert('b' not in cache and 'a' in cache)
+    assert(b.writes == 1)
+
+    # Changed files invalidate the entry, and conflict with changes in memory
+    assert(cache.get('c', (2.0, 10)) is None)
+    assert('c' not in cache)
+    a._dirty = True
+    try:
+        cache.get('a', (2.0, 10))
+        assert(False)
+    except ConflictError as e:
+        assert(e.obj is a and a._dirty)
+    assert('a' not in cache)
+    cache.put('a', a, (2.0, 10))
+
+    # Objects larger than the budget are still cached by themselves
+    e = Obj('e')
+    cache.put('e', e, (1.0, 100))
+    assert(len(cache) == 1 and cache.get('e', (1.0, 100)) is e)
+    assert(a.writes == 1)
+
+    # Entry budget
+    cache = ObjectCache(max_size=1000, max_entries=2)
+    for name in 'abc':
+        cache.put(name, Obj(name), (1.0, 1))
+    assert(len(cache) == 2 and 'a' not in cache)
+
+    # Flushing writes back everything dirty
+    cache.get('b', (1.0, 1))._dirty = True
+    cache.flush()
+    assert(cache.get('b', (1.0, 1)).writes == 1)
+    # ...except conflicts, which are raised after writing the rest
+    b, c = cache.get('b', (1.0, 1)), cache.get('c', (1.0, 1))
+    b._dirty = c._dirty = b.changed = True
+    try:
+        cache.flush()
+        assert(False)
+    except ConflictError as e:
+        assert(e.obj is b and b._dirty)
+    assert(c.writes == 1 and not c._dirty and 'b' not in cache)
+    # Evicted conflicts are left dirty
+    cache.put('d', b, (1.0, 1))
+    cache.get('c', (1.0, 1))
+    cache.put('e', Obj('e'), (1.0, 1))
+    assert('d' not in cache and b._dirty)
+
+    # Rewritten files (e.g. compacted) keep their objects
+    b.changed = b._dirty = False
+    cache.put('b', b, (1.0, 1))
+    b._stat = (1.0, 1)
+    cache.rewritten('b', (1.0, 1), (3.0, 2))
+    assert(cache.get('b', (3.0, 2)) is b and b._stat == (3.0, 2))
+    cache.rewritten('b', (1.0, 1), (4.0, 3))
+    assert(cache.get('b', (4.0, 3)) is None)
+    print("ObjectCache() Testing Passed!")
@@ -1,8 +1,23 @@
-from .basic_file_manager import FileContentManager
+from .basic_file_manager import FileContentManager, ConflictError, journal_lock, \
+        deferred_writes
+from .index import FileIndex
+from .cache import ObjectCache
+from .parallel import map_chunks, query_chunk, apply_chunk
+from .watcher import create_watcher
+from .listing import DirectoryListing
+from .metrics import timed
 
-from glob import iglob as glob_files
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from os import mkdir as create_directory
 from os.path import isdir as directory_exists
+from threading import Lock, Timer
+from time import monotonic
+
+# Objects changed inside the current batch() (of this thread or task), by id
+_batch_objs = ContextVar('batch_objs', default=None)
+
 class FileDatabase(object):
     '''
     Initialize resources for processing a file database in a given root 
@@ -10,14 +25,58 @@ class FileDatabase(object):
     Uses an underlying class for managing file objects.
     To eliminate excessive memory usage, there is a limit to the amount
     of objects this database can hold internally. We will load
-    and unload objects from here as a FIFO queue (database index)
-    in order to keep relevant things in memory (default is 16KB)
+    and unload objects from here as an LRU cache (see ObjectCache)
+    in order to keep relevant things in memory (default is 16KB of
+    files, set cache_size=0 to disable). Cached objects are reloaded
+    if their file changes, and written back when they are evicted.
+    Objects with unwritten changes to files that were changed by someone
+    else are never written over them: getting or flushing them raises a
+    ConflictError (with the object and its changes) instead.
 
     Provides methods for querying objects, adding new objects, and applying
     functions to objects. This class is meant to be an interface to any
     application using a File Database to manage files as individual records
+
+    If index is set, the metadata of every object (see get_metadata())
+    is kept in an on-disk index in the root directory, so listings don't
+    have to load every object. The index is updated whenever an object
+    is written or deleted, and checked against the files on startup.
+    The index also keeps the terms of the metadata, so objects can be
+    looked up by term or prefix (see lookup()) without loading them.
+
+    If write_behind is set, changes to objects are not written when
+    they are made. Instead, every object with unwritten changes is
+    written together by flush(), optionally on a pool of threads.
+    Using the database as a context manager flushes it on exit.
+    Inside a batch(), only the changes made inside it (in the same
+    thread or task) are deferred, and written together when it ends.
+
+    For large databases, parallel_query() and parallel_apply() spread
+    loading and processing objects over a pool of processes. These take
+    picklable functions, such as the queries in file_database.query.
+
+    Files are found with a cached listing of the directories (see
+    DirectoryListing), so globbing doesn't walk the whole tree again.
+
+    If watch is set, files changed by other tools (e.g. a git checkout)
+    are watched (see watcher.create_watcher()), and each change is
+    applied to the cache, index and listing as it is made (see
+    apply_events()), so only the changed objects are reloaded.
+
+    If the object class keeps a journal (see FileContentManager), files
+    with a journal over the journal_limit are compacted in the background
+    after they are written. Smaller journals are compacted once no
+    journal has been written for journal_idle seconds, and on close()
+    (see compact_journals()), so the files others read catch up.
     '''
-    def __init__(self, db_root, obj_class=FileContentManager, ext='txt'):
+    index_filename = '.index.sqlite'
+    # Seconds between checks of the files, if they are polled
+    watch_interval = 1.0
+    # Seconds without journal writes before the journals are compacted
+    journal_idle = 5.0
+
+    def __init__(self, db_root, obj_class=FileContentManager, ext='txt', index=False, \
+            cache_size=16*1024, cache_entries=None, write_behind=False, watch=False):
         # Database root directory and file extension
         self._root = db_root
         self._ext = ext
@@ -25,16 +84,255 @@ class FileDatabase(object):
         # Class to use to manage database entries (e.g. files)
         self._obj_class = obj_class 
 
+        # Objects with unwritten changes, by id
+        self._write_behind = write_behind
+        self._pending = {}
+        self._pending_lock = Lock()
+
+        # Background compaction of journals
+        self._compactor = None
+        self._compacting = set()
+        # Files with journals not compacted yet, and the timer
+        # for compacting them once journal writes are idle
+        self._journaled = set()
+        self._journal_timer = None
+        self._last_journaled = 0
+
+        # In-memory cache of loaded objects
+        self._cache = None
+        if cache_size:
+            self._cache = ObjectCache(cache_size, cache_entries)
+
+        # Listing of the files, which is kept up to date by the
+        # watcher (if any) instead of checking the directories
+        self._listing = DirectoryListing(self._root, self._ext, validate=not watch)
+
+        # Persistent metadata index (optional)
+        self._index = None
+        if index:
+            if not directory_exists(self._root):
+                create_directory(self._root)
+            self._index = FileIndex(self._root + '/' + self.index_filename)
+            self.sync_index()
+
+        # Watcher of changes made by others (optional)
+        self._watcher = None
+        if watch:
+            if not directory_exists(self._root):
+                create_directory(self._root)
+            self._watcher = create_watcher(self._root, self._ext, \
+                    self._obj_class.stat, self.watch_interval)
+            self._watcher.start(self.apply_events)
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    # Write back any cached changes and release resources
+    def close(self):
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+        try:
+            self.flush()
+        finally:
+            self.compact_journals()
+            try:
+                if self._cache is not None:
+                    self._cache.clear()
+            finally:
+                if self._index is not None:
+                    self._index.close()
+                    self._index = None
+
     def _fullpath_from(self, basename):
         return self._root + '/' + basename + '.' + self._ext
 
     def _basename_from(self, fullpath):
-        return fullpath.replace(self._root + '/', '').replace('.' + self._ext, '')
+        return fullpath[len(self._root) + 1:-len(self._ext) - 1]
+
+    # Get list of the files of objects based on filename globbing
+    @timed('db.list')
+    def get_fullpaths(self, fileglob='**/*'):
+        return [self._fullpath_from(b) for b in self._listing.match(fileglob)]
 
+    @timed('db.load_obj')
     def _load_obj(self, fullpath):
+        if self._cache is not None:
+            stat = self._obj_class.stat(fullpath)
+            try:
+                obj = self._cache.get(fullpath, stat)
+            except ConflictError as e:
+                # Reported here, so it isn't again on flush
+                with self._pending_lock:
+                    self._pending.pop(id(e.obj), None)
+                raise
+            if obj is not None:
+                return obj
         obj = self._obj_class(fullpath)
         obj.basename = self._basename_from(fullpath)
+        obj.write_behind = self._write_behind
+        obj._on_change = self._obj_changed
+        if self._cache is not None:
+            self._cache.put(fullpath, obj, stat)
         return obj 
+
+    # Keep the cache and index up to date with the files of our objects
+    def _obj_changed(self, obj, event, fullpath):
+        if event == 'dirty':
+            self._add_pending(obj)
+            return
+        with self._pending_lock:
+            self._pending.pop(id(obj), None)
+        self._listing.invalidate(fullpath)
+        if event == 'delete':
+            self._file_changed(event, fullpath)
+            return
+        # Objects can be written to a new location (e.g. moved)
+        obj.basename = self._basename_from(fullpath)
+        stat = self._obj_class.stat(fullpath)
+        if self._cache is not None:
+            self._cache.put(fullpath, obj, stat)
+        if self._index is not None:
+            self._index.update(obj.basename, *stat, obj.get_metadata())
+        if obj._journal_size > obj.journal_limit:
+            self._compact_later(fullpath, obj)
+        elif obj._journal_size:
+            self._compact_when_idle(fullpath)
+
+    def _compact_when_idle(self, fullpath):
+        with self._pending_lock:
+            self._journaled.add(fullpath)
+            self._last_journaled = monotonic()
+            if self._journal_timer is None:
+                self._start_journal_timer(self.journal_idle)
+
+    def _start_journal_timer(self, delay):
+        self._journal_timer = Timer(delay, self._journals_idle)
+        self._journal_timer.daemon = True
+        self._journal_timer.start()
+
+    # Compact the journals in the background, unless there
+    # were writes since the timer started (then wait again)
+    def _journals_idle(self):
+        with self._pending_lock:
+            remaining = self._last_journaled + self.journal_idle - monotonic()
+            if remaining > 0 and self._journaled:
+                self._start_journal_timer(remaining)
+                return
+            self._journal_timer = None
+            fullpaths, self._journaled = self._journaled, set()
+        for fullpath in fullpaths:
+            self._compact_later(fullpath)
+
+    def _compact_later(self, fullpath, obj=None):
+        with self._pending_lock:
+            if fullpath in self._compacting:
+                return
+            self._compacting.add(fullpath)
+            if self._compactor is None:
+                self._compactor = ThreadPoolExecutor(1)
+            self._compactor.submit(self._compact, fullpath, obj)
+
+    # Compacting doesn't change the contents, so the objects of the file
+    # (the one that wrote it, cached and pending) don't conflict with it
+    def _compact(self, fullpath, obj=None):
+        try:
+            with journal_lock(fullpath):
+                try:
+                    old_stat = self._obj_class.stat(fullpath)
+                except OSError:
+                    return
+                compacted = self._obj_class.compact(fullpath)
+                if compacted is None:
+                    return
+                with self._pending_lock:
+                    objs = [o for o in self._pending.values() if o._filepath == fullpath]
+                if obj is not None:
+                    objs.append(obj)
+                for o in objs:
+                    if o._stat == old_stat:
+                        o._stat = compacted._stat
+                if self._cache is not None:
+                    self._cache.rewritten(fullpath, old_stat, compacted._stat)
+            if self._index is not None:
+                self._index.update(self._basename_from(fullpath), \
+                        *compacted._stat, compacted.get_metadata())
+        finally:
+            with self._pending_lock:
+                self._compacting.discard(fullpath)
+
+    # Wait for the journals being compacted in the background, then
+    # compact the rest of the journals we wrote. If all is set, compact
+    # every journal in the database instead (e.g. written by others)
+    def compact_journals(self, all=False):
+        with self._pending_lock:
+            compactor, self._compactor = self._compactor, None
+            timer, self._journal_timer = self._journal_timer, None
+            fullpaths, self._journaled = self._journaled, set()
+        if timer is not None:
+            timer.cancel()
+        if compactor is not None:
+            compactor.shutdown(wait=True)
+        for fullpath in self.get_fullpaths() if all else fullpaths:
+            self._compact(fullpath)
+
+    # Update the cache and index for a file that was written
+    # or deleted without going through one of our objects
+    def _file_changed(self, event, fullpath, stat=None, metadata=None):
+        basename = self._basename_from(fullpath)
+        self._listing.invalidate(fullpath)
+        if self._cache is not None:
+            self._cache.remove(fullpath)
+        if self._index is not None:
+            if event == 'delete':
+                self._index.remove(basename)
+            else:
+                self._index.update(basename, *stat, metadata)
+
+    # Apply changes made to files by others (see watcher.FileEvent) to
+    # the cache and index. Only the objects of files that changed since
+    # they were cached or indexed (i.e. not our own writes) are reloaded
+    def apply_events(self, events):
+        for event in events:
+            if event.event in ('delete', 'move'):
+                self._file_changed('delete', event.path)
+            if event.event != 'delete':
+                self._file_reloaded(event.dest if event.event == 'move' else event.path)
+
+    def _file_reloaded(self, fullpath):
+        self._listing.invalidate(fullpath)
+        try:
+            stat = self._obj_class.stat(fullpath)
+        except OSError:
+            return # Gone again
+        # Drops the cached object if it is out of date (if it has
+        # unwritten changes, the conflict is raised when it is flushed)
+        if self._cache is not None:
+            try:
+                self._cache.get(fullpath, stat)
+            except ConflictError:
+                pass
+        if self._index is not None:
+            basename = self._basename_from(fullpath)
+            entry = self._index.get(basename)
+            if entry is None or (entry.mtime, entry.size) != stat:
+                self._index.update(basename, *stat, \
+                        self._obj_class(fullpath).get_metadata())
+
+    # Check the index against the files on disk,
+    # re-indexing any that were changed outside of the database
+    def sync_index(self):
+        files = {}
+        for basename in self._listing.match():
+            files[basename] = self._obj_class.stat(self._fullpath_from(basename))
+        self._index.sync(files, lambda basename: \
+                self._obj_class(self._fullpath_from(basename)).get_metadata())
     
     def add_obj(self, basename, obj_content=None):
         # Starting with the root directory, ensure the path to the
@@ -47,13 +345,90 @@ class FileDatabase(object):
         # Instantiate object class
         obj = self._obj_class(self._fullpath_from(basename), \
                 new_contents=obj_content)
-        obj._write() #TODO: FileContentManager().reference-counting
+        obj.basename = basename
+        obj.write_behind = self._write_behind
+        obj._on_change = self._obj_changed
+        if obj._writes_behind():
+            self._add_pending(obj)
+        else:
+            obj._write()
+
+    # Objects with unwritten changes, also kept by the batch() they
+    # were changed in (if any), so it only writes its own changes
+    def _add_pending(self, obj):
+        with self._pending_lock:
+            self._pending[id(obj)] = obj
+        batch = _batch_objs.get()
+        if batch is not None:
+            batch[id(obj)] = obj
+
+    # Write all objects with unwritten changes, using a pool of the
+    # given number of threads (if any). Objects in conflict aren't
+    # written, and the first conflict is raised after writing the rest
+    def flush(self, workers=None):
+        with self._pending_lock:
+            objs = list(self._pending.values())
+        return self._write_pending(objs, workers)
+
+    # Write the objects that are still pending (and not
+    # already taken to be written by someone else)
+    def _write_pending(self, objs, workers=None):
+        with self._pending_lock:
+            objs = [o for o in objs if self._pending.pop(id(o), None) is not None]
+        objs = [o for o in objs if o._dirty]
+        def write(obj):
+            try:
+                obj._write()
+            except ConflictError as e:
+                return e
+        if workers and len(objs) > 1:
+            with ThreadPoolExecutor(workers) as executor:
+                # Consume results, so errors are raised
+                conflicts = list(executor.map(write, objs))
+        else:
+            conflicts = [write(obj) for obj in objs]
+        conflicts = [e for e in conflicts if e is not None]
+        if conflicts:
+            # Reported here, so they aren't again when got
+            if self._cache is not None:
+                for e in conflicts:
+                    self._cache.remove(e.filepath, e.obj)
+            raise conflicts[0]
+        return len(objs)
+
+    # Defer writes of changes made inside the context (by this thread
+    # or task only), and write them all together on exit
+    @contextmanager
+    def batch(self, workers=None):
+        objs = {}
+        token = _batch_objs.set(objs)
+        try:
+            with deferred_writes():
+                yield self
+        finally:
+            _batch_objs.reset(token)
+            self._write_pending(list(objs.values()), workers)
     
     # Get list of objects based on filename globbing
     def get_objs(self, fileglob='**/*'):
         # Default **/* is any file in folder, recursively
-        return map(self._load_obj, \
-                glob_files(self._fullpath_from(fileglob), recursive=True))
+        return map(self._load_obj, self.get_fullpaths(fileglob))
+
+    # Get list of index entries based on filename globbing, and
+    # optionally filters and pages (see FileIndex.listing()).
+    # Unlike get_objs(), this doesn't need to load any objects
+    def get_listing(self, fileglob='**/*', **filters):
+        if self._index is None:
+            raise ValueError("Database has no index!")
+        return self._index.listing(fileglob, **filters)
+
+    # Get list of basenames (in order) of the objects matching a query
+    # of terms in their metadata (see Term, Prefix, And and Or in query).
+    # Unlike query(), this doesn't need to load any objects
+    def lookup(self, query):
+        if self._index is None:
+            raise ValueError("Database has no index!")
+        return self._index.lookup(query)
 
     # Given a query, perform tho query on a given list 
     # of objects and return list of objects that pass the query.
@@ -66,10 +441,38 @@ class FileDatabase(object):
     def apply(self, func, objs=None):
         return [r for r in map(func, objs if objs else self.get_objs())]
 
+    # Perform the query on the objects matching the file globbing
+    # across a pool of processes, yielding the basenames of objects
+    # that pass the query as they are found (see parallel.map_chunks)
+    def parallel_query(self, query, fileglob='**/*', workers=None, \
+            chunksize=64, ordered=True, cancel=None):
+        # Workers read the files, so make sure they are up to date
+        self.flush()
+        fullpaths = self.get_fullpaths(fileglob)
+        for passed in map_chunks(query_chunk, fullpaths, (self._obj_class, query), \
+                workers, chunksize, ordered, cancel):
+            for fullpath in passed:
+                yield self._basename_from(fullpath)
+
+    # Apply the function to the objects matching the file globbing
+    # across a pool of processes, and return a list of their results.
+    # Objects changed by the function are written by the workers
+    def parallel_apply(self, func, fileglob='**/*', workers=None, \
+            chunksize=64, cancel=None):
+        self.flush()
+        fullpaths = self.get_fullpaths(fileglob)
+        results = []
+        for chunk_results, changes in map_chunks(apply_chunk, fullpaths, \
+                (self._obj_class, func), workers, chunksize, True, cancel):
+            results.extend(chunk_results)
+            for event, fullpath, stat, metadata in changes:
+                self._file_changed(event, fullpath, stat, metadata)
+        return results
+
 if __name__ == '__main__':
-    from os import mkdir, rmdir, listdir
+    from os import mkdir, rmdir, listdir, remove as file_remove
     from os.path import isfile as file_exists
-    
+
     test_dir = 'file_testdb'
     mkdir(test_dir)
 
@@ -109,6 +512,94 @@ if __name__ == '__main__':
         with open(fname, 'r') as f:
             assert(files_to_check[fname] == f.read())
     
+    # Write-behind testing
+    with FileDatabase(test_dir, write_behind=True) as db:
+        db.add_obj('deferred-0', 'Deferred file 0\n')
+        assert(not file_exists(test_dir + '/deferred-0.txt'))
+    assert(file_exists(test_dir + '/deferred-0.txt'))
+    db = FileDatabase(test_dir)
+    with db.batch(workers=4):
+        db.apply(lambda o: o.update_contents(o._contents + 'Batched\n'), \
+                objs=db.get_objs('deferred-0'))
+        db.apply(lambda o: o.move(o._filepath.replace('deferred-', 'batched-')), \
+                objs=db.get_objs('deferred-0'))
+        assert(file_exists(test_dir + '/deferred-0.txt'))
+        assert(not file_exists(test_dir + '/batched-0.txt'))
+    assert(not file_exists(test_dir + '/deferred-0.txt'))
+    with open(test_dir + '/batched-0.txt', 'r') as f:
+        assert(f.read() == 'Deferred file 0\nBatched\n')
+    db.apply(lambda o: o.delete(), objs=db.get_objs('batched-0'))
+    # Only changes made inside the batch (by its thread) are deferred,
+    # including changes to objects got before it
+    from threading import Thread
+    db.add_obj('scoped-0', 'Scoped file 0\n')
+    obj = next(db.get_objs('scoped-0'))
+    with db.batch():
+        obj.update_contents('Batched\n')
+        thread = Thread(target=db.add_obj, args=('scoped-1', 'Scoped file 1\n'))
+        thread.start()
+        thread.join()
+        assert(file_exists(test_dir + '/scoped-1.txt'))
+        with open(test_dir + '/scoped-0.txt', 'r') as f:
+            assert(f.read() == 'Scoped file 0\n')
+    with open(test_dir + '/scoped-0.txt', 'r') as f:
+        assert(f.read() == 'Batched\n')
+    obj.update_contents('Written\n')
+    with open(test_dir + '/scoped-0.txt', 'r') as f:
+        assert(f.read() == 'Written\n')
+    db.apply(lambda o: o.delete(), objs=db.get_objs('scoped-*'))
+    del db
+
+    # Cache testing
+    db = FileDatabase(test_dir, cache_size=1024)
+    db.add_obj('cached-0', 'Cached file 0\n')
+    db.add_obj('cached-1', 'Cached file 1\n')
+    obj = [o for o in db.get_objs('cached-0')][0]
+    assert([o for o in db.get_objs('cached-0')][0] is obj) # No reload
+    # Changes in memory are written back once evicted
+    obj._contents = 'Changed in memory\n'
+    obj.mark_dirty()
+    [o for o in db.get_objs()] # Loads everything, evicting obj
+    assert(obj._filepath not in db._cache)
+    with open(obj._filepath, 'r') as f:
+        assert(f.read() == 'Changed in memory\n')
+    # Changes made to the file are picked up again
+    obj = [o for o in db.get_objs('cached-1')][0]
+    with open(obj._filepath, 'w') as f:
+        f.write('Changed outside the database\n')
+    assert([o for o in db.get_objs('cached-1')][0]._contents == \
+            'Changed outside the database\n')
+    # ...and conflict with changes made in memory, instead of being
+    # overwritten by them (whether the object is got or flushed)
+    for outside in ['Changed outside again\n', 'Changed outside once more\n']:
+        obj = next(db.get_objs('cached-1'))
+        obj._contents = 'Changed in memory\n'
+        obj.mark_dirty()
+        with open(obj._filepath, 'w') as f:
+            f.write(outside)
+        try:
+            next(db.get_objs('cached-1')) if outside.endswith('again\n') else db.flush()
+            assert(False)
+        except ConflictError as e:
+            assert(e.obj is obj and obj._dirty)
+        db.flush() # Only raised once
+        with open(obj._filepath, 'r') as f:
+            assert(f.read() == outside)
+        assert(next(db.get_objs('cached-1'))._contents == outside)
+    db.apply(lambda o: o.delete(), objs=db.get_objs('cached-*'))
+    del db
+
+    # Listing testing (files are found with a cached listing)
+    db = FileDatabase(test_dir)
+    db.add_obj('listed.txt-copy', 'Listed file\n') # Extension within the name
+    db.add_obj('dir/listed', 'Listed file\n')
+    assert([o.basename for o in db.get_objs('listed*')] == ['listed.txt-copy'])
+    assert(db.get_fullpaths('**/listed') == [test_dir + '/dir/listed.txt'])
+    db.apply(lambda o: o.delete(), objs=db.get_objs('**/listed*'))
+    assert(db.get_fullpaths('**/listed*') == [])
+    rmdir(test_dir + '/dir')
+    del db
+
     # Query testing
     db = FileDatabase(test_dir)
     assert(len([o for o in db.get_objs()]) == N)
@@ -130,10 +621,162 @@ if __name__ == '__main__':
     correct_len = len([i for i in range(N) if '1' in str(i) and '2' in str(i)])
     assert(len([o for o in db.query(query)]) == correct_len)
     
+    # Parallel query testing (picklable queries)
+    from .query import Regex, Contains, AllOf, AnyOf
+    query = Regex('number [0-9]{1,2} created')
+    assert(len(list(db.parallel_query(query, workers=2))) == N/10)
+    query = AnyOf(Contains('1'), Contains('2'))
+    correct_len = len([i for i in range(N) if '1' in str(i) or '2' in str(i)])
+    assert(len(list(db.parallel_query(query, workers=2, ordered=False))) == correct_len)
+    query = AllOf(Contains('1'), Contains('2'))
+    assert(sorted(db.parallel_query(query, workers=2)) == \
+            sorted(o.basename for o in db.query(query)))
+    from threading import Event
+    cancel = Event()
+    for basename in db.parallel_query(Contains(text_to_add), workers=2, \
+            chunksize=10, cancel=cancel):
+        cancel.set()
+    assert(cancel.is_set())
+
     db.apply(lambda o: o.delete()) # Delete all files
     db.apply(lambda o: o._write()) # Write all files (but this shouldn't do anything)
     assert(len(listdir(test_dir)) == 0)
     
+    # Index testing
+    db = FileDatabase(test_dir, index=True)
+    for i in range(10):
+        db.add_obj('dir/indexed-{:02d}'.format(i), 'Indexed file {}\n'.format(i))
+    assert([e.basename for e in db.get_listing('dir/indexed-0[0-4]')] == \
+            ['dir/indexed-{:02d}'.format(i) for i in range(5)])
+    db.apply(lambda o: o.move(o._filepath.replace('indexed-', 'moved-')), \
+            objs=db.get_objs('dir/indexed-0[0-4]'))
+    [o.delete() for o in db.get_objs('dir/indexed-09')]
+    listing = [e.basename for e in db.get_listing()]
+    assert(len(listing) == 9)
+    assert(sum([b.startswith('dir/moved-') for b in listing]) == 5)
+    # Contents are looked up by their terms, without loading anything
+    from .query import Term, Prefix, And, Or
+    assert(db.lookup(Term('indexed file')) == listing)
+    assert(db.lookup(Term('5')) == ['dir/indexed-05'])
+    assert(db.lookup(Or(Term('1'), And(Prefix('ind'), Term('8')))) == \
+            ['dir/indexed-08', 'dir/moved-01'])
+    assert(db.lookup(Term('9')) == [])
+    db.close()
+
+    # Files changed outside of the database are picked up on restart
+    with open(test_dir + '/dir/indexed-05.txt', 'w') as f:
+        f.write('Changed outside the database')
+    file_remove(test_dir + '/dir/indexed-06.txt')
+    db = FileDatabase(test_dir, index=True)
+    assert(len(db.get_listing()) == 8)
+    assert(db.get_listing('dir/indexed-05')[0].size == \
+            len('Changed outside the database'))
+    assert(db.lookup(Term('outside')) == ['dir/indexed-05'])
+    assert(db.lookup(Term('5')) == [])
+
+    db.apply(lambda o: o.delete())
+    assert(len(db.get_listing()) == 0)
+    db.close()
+    for fname in listdir(test_dir):
+        if fname.startswith(FileDatabase.index_filename):
+            file_remove(test_dir + '/' + fname)
+    rmdir(test_dir + '/dir')
+
+    # Watch testing (files changed by other tools are applied
+    # to the cache and index as they change)
+    from os import rename
+    from time import sleep, time
+    def wait_for(condition):
+        start = time()
+        while not condition() and time() - start < 5:
+            sleep(0.01)
+        return condition()
+    class WatchedDatabase(FileDatabase):
+        watch_interval = 0.05
+    class CountingContentManager(FileContentManager):
+        loads = []
+        def get_metadata(self):
+            self.loads.append(self._filepath)
+            return super().get_metadata()
+    db = WatchedDatabase(test_dir, obj_class=CountingContentManager, index=True, watch=True)
+    for i in range(5):
+        db.add_obj('watched-{}'.format(i), 'Watched file {}\n'.format(i))
+    obj = [o for o in db.get_objs('watched-0')][0]
+    sleep(0.2) # Our own writes are seen too
+    del CountingContentManager.loads[:]
+    with open(test_dir + '/watched-0.txt', 'w') as f:
+        f.write('Edited elsewhere\n')
+    rename(test_dir + '/watched-1.txt', test_dir + '/watched-1-moved.txt')
+    file_remove(test_dir + '/watched-2.txt')
+    with open(test_dir + '/watched-5.txt', 'w') as f:
+        f.write('Added elsewhere\n')
+    assert(wait_for(lambda: [e.basename for e in db.get_listing()] == \
+            ['watched-0', 'watched-1-moved', 'watched-3', 'watched-4', 'watched-5']))
+    assert(wait_for(lambda: db.lookup(Term('elsewhere')) == ['watched-0', 'watched-5']))
+    assert(obj._filepath not in db._cache)
+    # Only the changed files were reloaded
+    assert(sorted(CountingContentManager.loads) == [test_dir + '/watched-0.txt', \
+            test_dir + '/watched-1-moved.txt', test_dir + '/watched-5.txt'])
+    db.apply(lambda o: o.delete())
+    db.close()
+    for fname in listdir(test_dir):
+        if fname.startswith(FileDatabase.index_filename):
+            file_remove(test_dir + '/' + fname)
+
+    # Journal testing (small changes are appended to journals, which
+    # are compacted in the background once they are large enough, or
+    # once journal writes are idle)
+    from .xml_file_manager import XMLContentManager
+    from .basic_file_manager import journal_path
+    class JournalContentManager(XMLContentManager):
+        journal = True
+        journal_limit = 256
+    db = FileDatabase(test_dir, obj_class=JournalContentManager, ext='xml', index=True)
+    db.add_obj('journaled', {'root': {'title': 'Title', 'body': 'Body'}})
+    fullpath = db._fullpath_from('journaled')
+    with open(fullpath, 'r') as f:
+        contents = f.read()
+    obj = next(db.get_objs('journaled'))
+    obj.set('root/title', 'Edited')
+    db.flush()
+    with open(fullpath, 'r') as f:
+        assert(f.read() == contents)
+    assert(file_exists(journal_path(fullpath)))
+    assert(db.get_listing('journaled')[0].mtime == JournalContentManager.stat(fullpath)[0])
+    while file_exists(journal_path(fullpath)):
+        obj.set('root/title', 'Edited ' + 'again'*len(obj.get('root/title')))
+        db.flush()
+        assert(wait_for(lambda: not db._compacting))
+    with open(fullpath, 'r') as f:
+        assert(f.read() == str(obj))
+    # Compacted file is picked up again
+    assert(next(db.get_objs('journaled')).get('root/title') == obj.get('root/title'))
+    db.compact_journals()
+    db.journal_idle = 0.1
+    obj.set('root/body', 'Idle')
+    db.flush()
+    assert(file_exists(journal_path(fullpath)))
+    assert(wait_for(lambda: not file_exists(journal_path(fullpath))))
+    assert(JournalContentManager(fullpath).get('root/body') == 'Idle')
+    db.journal_idle = 60
+    obj.set('root/body', 'Edited')
+    db.close()
+    assert(not file_exists(journal_path(fullpath)))
+    assert(JournalContentManager(fullpath).get('root/body') == 'Edited')
+    # ...or all of them, including journals written by others
+    db = FileDatabase(test_dir, obj_class=JournalContentManager, ext='xml', index=True)
+    obj = JournalContentManager(fullpath)
+    obj.set('root/body', 'Outside')
+    obj._write()
+    assert(file_exists(journal_path(fullpath)))
+    db.compact_journals(all=True)
+    assert(not file_exists(journal_path(fullpath)))
+    db.apply(lambda o: o.delete())
+    db.close()
+    for fname in listdir(test_dir):
+        if fname.startswith(FileDatabase.index_filename):
+            file_remove(test_dir + '/' + fname)
+
     # Remove testing directory (must be empty)
     rmdir(test_dir)
     print("FileDatabase() Testing Passed!")
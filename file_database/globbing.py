@@ -0,0 +1,73 @@
+from functools import lru_cache
+from re import compile as re_compile, escape as re_escape
+
+# Translate a glob pattern (as used by glob(recursive=True)) into
+# a regular expression that matches basenames relative to the root
+@lru_cache(maxsize=256)
+def glob_to_regex(pattern):
+    regex = ''
+    segments = pattern.split('/')
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == '**':
+            # '**' matches zero or more whole directories (or at the
+            # end, any path), except hidden ones as with other wildcards
+            regex += '(?:[^/.][^/]*(?:/[^/.][^/]*)*)?' if last else '(?:[^/.][^/]*/)*'
+            continue
+        # Like glob, wildcards don't match hidden entries
+        if segment[:1] in ('*', '?', '['):
+            regex += '(?![.])'
+        j = 0
+        while j < len(segment):
+            c = segment[j]
+            if c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '[' and ']' in segment[j+2:]:
+                # Character class, copied over (with '!' negation)
+                end = segment.index(']', j+2)
+                selector = segment[j+1:end]
+                if selector[:1] == '!':
+                    selector = '^' + selector[1:]
+                regex += '[' + selector.replace('\\', '\\\\') + ']'
+                j = end
+            else:
+                regex += re_escape(c)
+            j += 1
+        if not last:
+            regex += '/'
+    return re_compile(regex + r'\Z')
+
+def glob_match(name, pattern):
+    return glob_to_regex(pattern).match(name) is not None
+
+# Literal start of a glob pattern (up to its first wildcard),
+# which every name the pattern matches starts with
+def glob_prefix(pattern):
+    for i, c in enumerate(pattern):
+        if c in '*?[':
+            return pattern[:i]
+    return pattern
+
+if __name__ == '__main__':
+    # run tests
+    assert(glob_match('new-001', '**/*'))
+    assert(glob_match('dir/sub/new-001', '**/*'))
+    assert(not glob_match('.hidden', '**/*'))
+    assert(glob_match('renamed-012', 'renamed-0*'))
+    assert(not glob_match('renamed-112', 'renamed-0*'))
+    assert(not glob_match('dir/renamed-012', 'renamed-0*'))
+    assert(glob_match('dir/renamed-012', '**/renamed-0*'))
+    assert(glob_match('dir/renamed-012', 'dir/renamed-0[01]?'))
+    assert(not glob_match('dir/renamed-022', 'dir/renamed-0[!2]?'))
+    assert(glob_match('a.b+c', 'a.b+c')) # literals are escaped
+    assert(not glob_match('aXb+c', 'a.b+c'))
+    assert(glob_match('dir/sub/new-001', 'dir/**') and glob_match('new-001', '**'))
+    # Journals (and other hidden files) aren't matched by any wildcard
+    assert(not glob_match('dir/.new-001.xml.journal', 'dir/**'))
+    assert(not glob_match('dir/.hidden/new-001', 'dir/**'))
+    assert(not glob_match('.new-001.xml.journal', '**'))
+    assert(glob_prefix('dir/renamed-0[01]?') == 'dir/renamed-0')
+    assert(glob_prefix('**/*') == '' and glob_prefix('a.b+c') == 'a.b+c')
+    print("glob_match() Testing Passed!")
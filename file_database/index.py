@@ -0,0 +1,311 @@
+from .globbing import glob_match, glob_prefix
+
+from collections import namedtuple
+from functools import lru_cache
+from re import compile as re_compile
+from threading import RLock
+import sqlite3
+
+# Lightweight record of an indexed object, used for listings so
+# that objects don't have to be loaded (parsed) just to be shown
+IndexEntry = namedtuple('IndexEntry', \
+        ['basename', 'uid', 'title', 'description', 'signals', 'mtime', 'size'])
+
+# Terms are lowercase runs of letters and digits
+_term_regex = re_compile('[a-z0-9]+')
+
+def tokenize(text):
+    return _term_regex.findall(str(text).lower())
+
+# Terms of the title, description, signal names, and
+# any other text (e.g. signal values) in the metadata
+def get_terms(metadata):
+    texts = [metadata.get('title'), metadata.get('description')]
+    texts.extend(metadata.get('signals', []))
+    texts.extend(metadata.get('text', []))
+    return set(t for text in texts if text is not None for t in tokenize(text))
+
+class FileIndex(object):
+    '''
+    Persistent (SQLite) index of the metadata of every object in a
+    FileDatabase, keyed by basename. Each entry records the file's
+    mtime and size when it was indexed, so the index can be checked
+    against the files on disk (see sync()) and only the objects that
+    changed outside of the database need to be re-read.
+
+    The terms of each entry (see get_terms()) are kept in an inverted
+    index, so objects can be looked up by the words in their metadata
+    (see lookup()) without loading them.
+
+    The index is only a cache: it can always be deleted and rebuilt.
+    '''
+    # Bumped whenever the tables change, so older indexes are rebuilt
+    version = 1
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = RLock()
+        # Objects are updated from whichever thread writes them
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.create_function('glob_match', 2, glob_match)
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] != self.version:
+            self._conn.execute('DROP TABLE IF EXISTS entries')
+            self._conn.execute('DROP TABLE IF EXISTS terms')
+            self._conn.execute('PRAGMA user_version = {:d}'.format(self.version))
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                basename TEXT PRIMARY KEY,
+                uid TEXT,
+                title TEXT,
+                description TEXT,
+                signals TEXT,
+                mtime REAL,
+                size INTEGER
+            )''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS terms (
+                term TEXT,
+                basename TEXT,
+                PRIMARY KEY (term, basename)
+            ) WITHOUT ROWID''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS terms_basename ON terms (basename)')
+        self._conn.commit()
+
+    def __repr__(self):
+        return  "{0}('{1}')".format(self.__class__.__name__, self._filename)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    def _row_from(self, basename, mtime, size, metadata):
+        uid = metadata.get('uid')
+        return (basename,
+                str(uid) if uid is not None else None,
+                metadata.get('title'),
+                metadata.get('description'),
+                '\n'.join(metadata.get('signals', [])),
+                mtime, size)
+
+    def _entry_from(self, row):
+        row = list(row)
+        row[4] = tuple(row[4].split('\n')) if row[4] else ()
+        return IndexEntry(*row)
+
+    # Hidden files (which globbing never lists) aren't indexed,
+    # so every entry matches '**/*'
+    def _update(self, basename, mtime, size, metadata):
+        if not glob_match(basename, '**/*'):
+            return
+        self._conn.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?,?,?)', \
+                self._row_from(basename, mtime, size, metadata))
+        self._conn.execute('DELETE FROM terms WHERE basename = ?', (basename,))
+        self._conn.executemany('INSERT INTO terms VALUES (?,?)', \
+                [(term, basename) for term in get_terms(metadata)])
+
+    def _remove(self, basename):
+        self._conn.execute('DELETE FROM entries WHERE basename = ?', (basename,))
+        self._conn.execute('DELETE FROM terms WHERE basename = ?', (basename,))
+
+    def update(self, basename, mtime, size, metadata):
+        with self._lock:
+            self._update(basename, mtime, size, metadata)
+            self._conn.commit()
+
+    def remove(self, basename):
+        with self._lock:
+            self._remove(basename)
+            self._conn.commit()
+
+    def get(self, basename):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM entries WHERE basename = ?', \
+                    (basename,)).fetchone()
+        return self._entry_from(row) if row else None
+
+    # Map of basename -> (mtime, size) for every entry
+    def stats(self):
+        with self._lock:
+            return {r[0]: (r[1], r[2]) for r in \
+                    self._conn.execute('SELECT basename, mtime, size FROM entries')}
+
+    # Bring the index in line with the given files on disk.
+    # files is a map of basename -> (mtime, size), and load_metadata
+    # is called for every basename that is new or has changed
+    def sync(self, files, load_metadata):
+        indexed = self.stats()
+        with self._lock:
+            for basename in indexed.keys() - files.keys():
+                self._remove(basename)
+            for basename, stat in files.items():
+                if indexed.get(basename) != stat:
+                    self._update(basename, *stat, load_metadata(basename))
+            self._conn.commit()
+
+    # Get list of index entries, in basename order, whose basenames
+    # match the given globbing. Entries can also be filtered by title
+    # (containing the text, ignoring case), uid, or signal name.
+    # Pages of entries are given by limit and either offset, or
+    # the basename of the last entry of the previous page (after)
+    def listing(self, fileglob='**/*', title=None, uid=None, signal=None, \
+            limit=None, offset=0, after=None):
+        conditions, params = [], []
+        # Every entry matches '**/*' (see _update()). Otherwise, only the
+        # range of basenames starting with the literal start of the
+        # globbing (a range of the primary key) is matched against it
+        if fileglob != '**/*':
+            prefix = glob_prefix(fileglob)
+            if prefix:
+                conditions.append('basename >= ? AND basename < ?')
+                params.extend([prefix, prefix + chr(0x10ffff)])
+            conditions.append('glob_match(basename, ?)')
+            params.append(fileglob)
+        if title:
+            conditions.append("title LIKE ? ESCAPE '\\'")
+            params.append('%' + title.replace('\\', '\\\\').replace('%', '\\%') \
+                    .replace('_', '\\_') + '%')
+        if uid:
+            conditions.append('uid = ?')
+            params.append(uid)
+        if signal:
+            conditions.append("instr(char(10) || signals || char(10), ?) > 0")
+            params.append('\n' + signal + '\n')
+        if after is not None:
+            conditions.append('basename > ?')
+            params.append(after)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        params.extend([limit if limit is not None else -1, offset])
+        with self._lock:
+            rows = self._conn.execute('SELECT * FROM entries' + where + \
+                    ' ORDER BY basename LIMIT ? OFFSET ?', params).fetchall()
+        return [self._entry_from(r) for r in rows]
+
+    # Number of terms from lo up to hi (or of the term lo if hi is None),
+    # used to plan lookups. Counting stops at count_limit, since only
+    # the rarest terms need to be told apart
+    count_limit = 10000
+
+    def _count_terms(self, lo, hi=None):
+        where = 'term = ?' if hi is None else 'term >= ? AND term < ?'
+        params = [lo] if hi is None else [lo, hi]
+        return self._conn.execute('SELECT COUNT(*) FROM (SELECT 1 FROM terms WHERE ' + \
+                where + ' LIMIT ?)', params + [self.count_limit]).fetchone()[0]
+
+    # Get list of basenames (in order) of the entries matching the
+    # query of terms (see Term, Prefix, And and Or in query)
+    def lookup(self, query):
+        with self._lock:
+            sql, params = query.to_sql(lru_cache(None)(self._count_terms))
+            rows = self._conn.execute('SELECT DISTINCT basename FROM (' + sql + \
+                    ') ORDER BY basename', params).fetchall()
+        return [r[0] for r in rows]
+
+if __name__ == '__main__':
+    from os import remove as file_remove
+    from os.path import isfile as file_exists
+
+    filename = 'test-index.sqlite'
+    if file_exists(filename):
+        file_remove(filename)
+
+    index = FileIndex(filename)
+    assert(len(index) == 0)
+    metadata = {'uid': 'abc', 'title': 'A Title', 'description': 'Some text', \
+            'signals': ['sig-1', 'sig 2']}
+    index.update('dir/test-1', 1.0, 10, metadata)
+    index.update('test-2', 2.0, 20, {})
+    index.update('dir/.hidden', 3.0, 30, {})
+    assert(len(index) == 2)
+    entry = index.get('dir/test-1')
+    assert(entry.title == 'A Title')
+    assert(entry.signals == ('sig-1', 'sig 2'))
+    assert(index.get('test-2').signals == ())
+    assert([e.basename for e in index.listing()] == ['dir/test-1', 'test-2'])
+    assert([e.basename for e in index.listing('test-*')] == ['test-2'])
+    assert([e.basename for e in index.listing('dir/test-1')] == ['dir/test-1'])
+    assert([e.basename for e in index.listing('**/test-?')] == ['dir/test-1', 'test-2'])
+    assert(index.listing('dir/test-2') == [] and index.listing('dir/*/*') == [])
+
+    # Filtering and pages of entries
+    for i in range(10):
+        index.update('page/{}'.format(i), 3.0, 30, {'uid': str(i), \
+                'title': '{}0% Title_{}'.format(i, i % 2), 'signals': ['sig-{}'.format(i)]})
+    assert(len(index.listing(title='title')) == 11)
+    assert(len(index.listing(title='_1')) == 5)
+    assert([e.basename for e in index.listing(title='10%')] == ['page/1'])
+    assert([e.basename for e in index.listing(uid='3')] == ['page/3'])
+    assert([e.basename for e in index.listing(signal='sig-1')] == ['dir/test-1', 'page/1'])
+    assert(index.listing(signal='sig') == [])
+    assert([e.uid for e in index.listing('page/*', limit=3, offset=3)] == ['3', '4', '5'])
+    assert([e.uid for e in index.listing('page/*', limit=3, after='page/7')] == ['8', '9'])
+    assert([e.uid for e in index.listing('page/[!5]', limit=2, after='page/4')] == ['6', '7'])
+    assert([e.uid for e in index.listing(title='title_0', limit=2, after='page/2')] == ['4', '6'])
+    [index.remove('page/{}'.format(i)) for i in range(10)]
+
+    # Index persists between instances
+    index.close()
+    index = FileIndex(filename)
+    assert(index.stats() == {'dir/test-1': (1.0, 10), 'test-2': (2.0, 20)})
+
+    # Syncing only reloads files that changed, and drops missing ones
+    loaded = []
+    def load_metadata(basename):
+        loaded.append(basename)
+        return {'title': basename}
+    index.sync({'dir/test-1': (1.0, 10), 'test-3': (3.0, 30)}, load_metadata)
+    assert(loaded == ['test-3'])
+    assert(index.get('test-2') is None)
+    assert(index.get('test-3').title == 'test-3')
+    index.remove('test-3')
+    assert(len(index) == 1)
+
+    # Terms are looked up in the inverted index
+    from .query import Term, Prefix, And, Or
+    assert(get_terms(metadata) == {'a', 'title', 'some', 'text', 'sig', '1', '2'})
+    index.update('dir/test-1', 1.0, 10, metadata)
+    index.update('test-4', 4.0, 40, {'title': 'Other title', 'text': ['Value 42']})
+    assert(index.lookup(Term('title')) == ['dir/test-1', 'test-4'])
+    assert(index.lookup(Term('sig 2')) == ['dir/test-1'])
+    assert(index.lookup(Term('sig 3')) == [])
+    assert(index.lookup(Prefix('tit')) == ['dir/test-1', 'test-4'])
+    assert(index.lookup(Prefix('value 4')) == ['test-4'])
+    assert(index.lookup(And(Term('title'), Prefix('oth'))) == ['test-4'])
+    assert(index.lookup(Or(Term('some'), Term('42'))) == ['dir/test-1', 'test-4'])
+    assert(index.lookup(Or()) == [] and index.lookup(Term('')) == [])
+    # Terms of updated and removed entries are replaced
+    index.update('test-4', 5.0, 50, {'title': 'Replaced'})
+    assert(index.lookup(Term('42')) == [] and index.lookup(Term('replaced')) == ['test-4'])
+    index.remove('test-4')
+    assert(index.lookup(Term('replaced')) == [])
+
+    # Lookups are fast for large databases
+    from time import time
+    N = 100000
+    index.sync({'case/{:06d}'.format(i): (1.0, 1) for i in range(N)}, \
+            lambda basename: {'title': 'Case ' + basename[-3:], \
+                'signals': ['sig-{}'.format(int(basename[-6:]) % 100)]})
+    start = time()
+    assert(len(index.lookup(Term('case 042'))) == N/1000)
+    assert(len(index.lookup(And(Prefix('sig'), Term('sig-7')))) == N/100)
+    assert(len(index.lookup(Or(Term('sig 1'), Term('sig 2')))) == 2*N/100)
+    print("Index lookups took {:.2f} ms".format((time() - start)*1000/3))
+
+    # Older indexes are rebuilt
+    index._conn.execute('PRAGMA user_version = 0')
+    index.close()
+    index = FileIndex(filename)
+    assert(len(index) == 0 and index.lookup(Term('title')) == [])
+
+    index.close()
+    for suffix in ['', '-wal', '-shm']:
+        if file_exists(filename + suffix):
+            file_remove(filename + suffix)
+    print("FileIndex() Testing Passed!")
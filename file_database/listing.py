@@ -0,0 +1,212 @@
+from .globbing import glob_to_regex
+
+from collections import namedtuple
+from os import scandir, stat as file_stat
+from threading import Lock
+from time import time
+
+# Listing of a directory: the mtime (in ns) it was listed at, whether
+# that mtime can't be trusted (see DirectoryListing), the basenames of
+# its files with the extension and the names of its subdirectories
+_DirListing = namedtuple('_DirListing', ['mtime', 'racy', 'files', 'subdirs'])
+
+# Seconds within which a change to a directory may not change its mtime
+_mtime_granularity = 2.0
+
+def _has_magic(segment):
+    return any(c in segment for c in '*?[')
+
+class DirectoryListing(object):
+    '''
+    Cached listing of the files with the extension under a root
+    directory, for matching file globbings (see globbing) without
+    walking the whole tree every time.
+
+    Each directory is listed once (with scandir, whose entries already
+    know if they are directories), and is listed again only if its
+    mtime changed. Walks start from the directories named literally at
+    the start of the globbing, and only go as deep as it can match.
+    A directory changed within the granularity of its mtime (so it
+    could change again without its mtime changing) is always listed
+    again, until its mtime is old enough to be trusted.
+
+    If validate is unset, cached directories aren't checked at all, so
+    matching makes no system calls. This is for when every change is
+    reported with invalidate() (e.g. by a watcher of the files).
+    Hidden files and directories are never listed, like with globbing.
+    '''
+    def __init__(self, root, ext, validate=True):
+        self._root = root
+        self._ext = '.' + ext
+        self.validate = validate
+        self._dirs = {}
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "{0}('{1}', '{2}')".format(self.__class__.__name__, \
+                self._root, self._ext[1:])
+
+    def _path(self, reldir):
+        return self._root + '/' + reldir if reldir else self._root
+
+    def _list(self, reldir):
+        listing = self._dirs.get(reldir)
+        if listing is not None and not listing.racy and not self.validate:
+            return listing
+        try:
+            mtime = file_stat(self._path(reldir)).st_mtime_ns
+        except OSError:
+            self._forget(reldir)
+            return None
+        if listing is not None and not listing.racy and listing.mtime == mtime:
+            return listing
+        files = []
+        subdirs = []
+        try:
+            with scandir(self._path(reldir)) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    elif entry.name.endswith(self._ext):
+                        files.append(entry.name[:-len(self._ext)])
+        except OSError:
+            self._forget(reldir)
+            return None
+        # Subdirectories that are gone are forgotten
+        if listing is not None:
+            for subdir in set(listing.subdirs) - set(subdirs):
+                self._forget(self._join(reldir, subdir))
+        listing = _DirListing(mtime, time() - mtime/1e9 < _mtime_granularity, \
+                tuple(sorted(files)), tuple(sorted(subdirs)))
+        self._dirs[reldir] = listing
+        return listing
+
+    def _join(self, reldir, name):
+        return reldir + '/' + name if reldir else name
+
+    def _forget(self, reldir):
+        self._dirs.pop(reldir, None)
+        prefix = reldir + '/'
+        for other in [d for d in self._dirs if d.startswith(prefix)]:
+            del self._dirs[other]
+
+    # Basenames of the files under the directory, going
+    # down depth levels of subdirectories (None for any depth)
+    def _basenames(self, reldir, depth):
+        listing = self._list(reldir)
+        if listing is None:
+            return
+        for name in listing.files:
+            yield self._join(reldir, name)
+        if depth is None or depth > 0:
+            for subdir in listing.subdirs:
+                yield from self._basenames(self._join(reldir, subdir), \
+                        None if depth is None else depth - 1)
+
+    # Get list of basenames (relative to the root, without the
+    # extension) matching the file globbing, in order
+    def match(self, fileglob='**/*'):
+        regex = glob_to_regex(fileglob)
+        segments = fileglob.split('/')
+        literal = []
+        for segment in segments[:-1]:
+            if _has_magic(segment) or segment.startswith('.'):
+                break
+            literal.append(segment)
+        rest = segments[len(literal):]
+        depth = None if '**' in rest else len(rest) - 1
+        with self._lock:
+            basenames = list(self._basenames('/'.join(literal), depth))
+        return sorted(b for b in basenames if regex.match(b))
+
+    # Note that the file at the path (relative to the root, or a full
+    # path) changed, so its directory is listed again. If the directory
+    # isn't listed yet, the closest listed directory above it is
+    def invalidate(self, path):
+        if path.startswith(self._root + '/'):
+            path = path[len(self._root) + 1:]
+        reldir = path.rpartition('/')[0]
+        with self._lock:
+            while reldir and reldir not in self._dirs:
+                reldir = reldir.rpartition('/')[0]
+            self._dirs.pop(reldir, None)
+
+    def clear(self):
+        with self._lock:
+            self._dirs.clear()
+
+if __name__ == '__main__':
+    from os import makedirs, remove as file_remove, utime
+    from shutil import rmtree
+    from os.path import exists as file_exists
+
+    test_dir = 'test-listing'
+    if file_exists(test_dir):
+        rmtree(test_dir)
+    def write(basename, ext='txt'):
+        with open(test_dir + '/' + basename + '.' + ext, 'w') as f:
+            f.write(basename)
+    # Make directory mtimes old enough to be trusted
+    def age(*reldirs):
+        for reldir in reldirs:
+            path = test_dir + '/' + reldir if reldir else test_dir
+            utime(path, (time() - 10, time() - 10))
+
+    makedirs(test_dir + '/a/b')
+    makedirs(test_dir + '/.hidden')
+    for basename in ['top', 'a/one', 'a/two', 'a/b/deep', '.hidden/top']:
+        write(basename)
+    write('a/other', 'xml')
+    write('a/.journal')
+    age('', 'a', 'a/b', '.hidden')
+
+    listing = DirectoryListing(test_dir, 'txt')
+    assert(listing.match() == ['a/b/deep', 'a/one', 'a/two', 'top'])
+    assert(listing.match('*') == ['top'])
+    assert(listing.match('a/*') == ['a/one', 'a/two'])
+    assert(listing.match('**/t*') == ['a/two', 'top'])
+    assert(listing.match('a/b/deep') == ['a/b/deep'])
+    assert(listing.match('a/**') == ['a/b/deep', 'a/one', 'a/two']) # Not a/.journal
+    assert(listing.match('missing/*') == [])
+
+    # Unchanged directories aren't listed again
+    listed = []
+    list_dir = listing._list
+    def counting_list(reldir):
+        listing = list_dir(reldir)
+        listed.append((reldir, listing))
+        return listing
+    listing._list = counting_list
+    cached = dict(listing._dirs)
+    assert(listing.match() == ['a/b/deep', 'a/one', 'a/two', 'top'])
+    assert(all(l is cached[d] for d, l in listed))
+    # Only the walked directories are checked
+    del listed[:]
+    listing.match('a/*')
+    assert([d for d, _ in listed] == ['a'])
+
+    # Changed directories are listed again
+    write('a/three')
+    file_remove(test_dir + '/a/b/deep.txt')
+    assert(listing.match() == ['a/one', 'a/three', 'a/two', 'top'])
+    rmtree(test_dir + '/a/b')
+    assert(listing.match() == ['a/one', 'a/three', 'a/two', 'top'])
+    assert('a/b' not in listing._dirs)
+
+    # Without validation, only invalidated directories are listed again
+    age('', 'a')
+    listing.clear()
+    listing.match()
+    listing.validate = False
+    makedirs(test_dir + '/c/d')
+    write('c/d/new')
+    write('a/four')
+    assert(listing.match() == ['a/one', 'a/three', 'a/two', 'top'])
+    listing.invalidate('a/four')
+    listing.invalidate(test_dir + '/c/d/new.txt')
+    assert(listing.match() == ['a/four', 'a/one', 'a/three', 'a/two', 'c/d/new', 'top'])
+
+    rmtree(test_dir)
+    print("DirectoryListing() Testing Passed!")
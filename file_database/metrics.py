@@ -0,0 +1,241 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from cProfile import Profile
+from functools import wraps
+from threading import Lock, get_ident
+from time import perf_counter
+
+# Upper bounds (in seconds) of the buckets of timing histograms
+buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+class Timing(object):
+    '''
+    Count, total and maximum of the times recorded under a name, with
+    a histogram of the times (the number in each of the buckets, and
+    past the last bucket).
+    '''
+    __slots__ = ('count', 'total', 'max', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0]*(len(buckets) + 1)
+
+    def __repr__(self):
+        return "{0}(count={1}, total={2:.6f})".format(self.__class__.__name__, \
+                self.count, self.total)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.histogram[bisect_left(buckets, seconds)] += 1
+
+    def copy(self):
+        timing = Timing()
+        timing.count, timing.total, timing.max = self.count, self.total, self.max
+        timing.histogram = list(self.histogram)
+        return timing
+
+# Timings of the current request (see request_timings())
+_request_timings = ContextVar('request_timings', default=None)
+
+class Metrics(object):
+    '''
+    Timings of the instrumented code (see timed() and timer()), by
+    name. Nothing is recorded unless enabled is set, and instrumented
+    code only checks that when disabled.
+
+    Times are also added up for the current request, if there is one
+    (see request_timings()). Context variables follow requests into
+    the threads they use, as long as those copy the context (e.g. as
+    AsyncFileDatabase does).
+    '''
+    def __init__(self):
+        self.enabled = False
+        self._timings = {}
+        self._lock = Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = Timing()
+            timing.add(seconds)
+            timings = _request_timings.get()
+            if timings is not None:
+                count, total = timings.get(name, (0, 0.0))
+                timings[name] = (count + 1, total + seconds)
+
+    # Copy of the timings, by name
+    def snapshot(self):
+        with self._lock:
+            return {name: t.copy() for name, t in self._timings.items()}
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+
+    # Timings in the Prometheus text format, as a histogram
+    # of seconds labelled by name
+    def to_prometheus(self, prefix='noisyfox'):
+        metric = prefix + '_seconds'
+        lines = ['# HELP {} Time spent in instrumented code'.format(metric), \
+                '# TYPE {} histogram'.format(metric)]
+        for name, timing in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), timing.histogram):
+                cumulative += count
+                lines.append('{}_bucket{{name="{}",le="{}"}} {}'.format(metric, name, \
+                        bound, cumulative))
+            lines.append('{}_sum{{name="{}"}} {!r}'.format(metric, name, timing.total))
+            lines.append('{}_count{{name="{}"}} {}'.format(metric, name, timing.count))
+        return '\n'.join(lines) + '\n'
+
+# Metrics of everything instrumented
+metrics = Metrics()
+
+# Decorator recording the time of each call of the function under the name
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.record(name, perf_counter() - start)
+        return timed_func
+    return decorator
+
+# Record the time of the block under the name
+@contextmanager
+def timer(name):
+    if not metrics.enabled:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record(name, perf_counter() - start)
+
+# Add up the times recorded inside the block (in this context), giving
+# a map of name -> (count, total seconds). Note that times of nested
+# instrumented code (e.g. reads while loading) are counted in both
+@contextmanager
+def request_timings():
+    timings = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+# Format timings (see request_timings()) for a Server-Timing header
+def server_timing(timings, total=None):
+    entries = ['{};dur={:.3f};desc="{} calls"'.format(name.replace('.', '-'), \
+            1000*seconds, count) for name, (count, seconds) in sorted(timings.items())]
+    if total is not None:
+        entries.append('total;dur={:.3f}'.format(1000*total))
+    return ', '.join(entries)
+
+# Profiles of the current request (see profile_request()),
+# and the thread the request itself is profiled in
+_request_profiles = ContextVar('request_profiles', default=None)
+
+# Profile (with cProfile) the block, and any code run with profiled()
+# in this context from other threads. Gives the list of profiles, for
+# pstats.Stats(*profiles) once the block is done
+@contextmanager
+def profile_request():
+    profiles = []
+    token = _request_profiles.set((get_ident(), profiles))
+    profile = Profile()
+    profiles.append(profile)
+    profile.enable()
+    try:
+        yield profiles
+    finally:
+        profile.disable()
+        _request_profiles.reset(token)
+
+# Call func(*args, **kwargs), profiling it if the request it is
+# for is being profiled (and not already, in this thread)
+def profiled(func, *args, **kwargs):
+    request = _request_profiles.get()
+    if request is None or request[0] == get_ident():
+        return func(*args, **kwargs)
+    profile = Profile()
+    request[1].append(profile)
+    return profile.runcall(func, *args, **kwargs)
+
+if __name__ == '__main__':
+    from concurrent.futures import ThreadPoolExecutor
+    from contextvars import copy_context
+    from pstats import Stats
+    from time import sleep
+
+    @timed('test.sleep')
+    def nap(seconds):
+        sleep(seconds)
+        return seconds
+
+    # Nothing is recorded while disabled
+    assert(nap(0) == 0 and nap.__name__ == 'nap')
+    with timer('test.block'):
+        pass
+    assert(metrics.snapshot() == {})
+
+    metrics.enabled = True
+    nap(0.002)
+    nap(0.02)
+    with timer('test.block'):
+        pass
+    timings = metrics.snapshot()
+    assert(sorted(timings) == ['test.block', 'test.sleep'])
+    timing = timings['test.sleep']
+    assert(timing.count == 2 and 0.022 <= timing.total < 1 and timing.max >= 0.02)
+    assert(timing.histogram[bisect_left(buckets, 0.002)] == 1 and sum(timing.histogram) == 2)
+    # Errors are timed too
+    try:
+        nap(None)
+    except TypeError:
+        pass
+    assert(metrics.snapshot()['test.sleep'].count == 3)
+
+    text = metrics.to_prometheus()
+    assert('# TYPE noisyfox_seconds histogram' in text)
+    assert('noisyfox_seconds_bucket{name="test.sleep",le="+Inf"} 3' in text)
+    assert('noisyfox_seconds_count{name="test.block"} 1' in text)
+
+    # Times add up per request, following it into other threads
+    executor = ThreadPoolExecutor(2)
+    with request_timings() as timings:
+        nap(0)
+        executor.submit(copy_context().run, nap, 0.001).result()
+    nap(0)
+    assert(list(timings) == ['test.sleep'] and timings['test.sleep'][0] == 2)
+    header = server_timing(timings, total=0.5)
+    assert(header.startswith('test-sleep;dur=') and header.endswith('total;dur=500.000'))
+    assert('desc="2 calls"' in header)
+
+    # Requests are profiled, with the code they run in other threads
+    with profile_request() as profiles:
+        nap(0)
+        executor.submit(copy_context().run, profiled, nap, 0.001).result()
+        profiled(nap, 0) # Already profiled in this thread
+    assert(len(profiles) == 2)
+    assert(profiled(nap, 0) == 0 and len(profiles) == 2)
+    stats = Stats(*profiles)
+    assert(any(func[2] == 'nap' and stat[0] == 3 for func, stat in stats.stats.items()))
+    executor.shutdown()
+
+    metrics.reset()
+    metrics.enabled = False
+    assert(metrics.snapshot() == {})
+    print("Metrics() Testing Passed!")
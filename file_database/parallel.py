@@ -0,0 +1,91 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from os import cpu_count
+
+# Split an iterable into lists of at most chunksize items
+def chunked(iterable, chunksize):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunksize))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunksize))
+
+# Run func(chunk, *args) for chunks of items across a pool of processes,
+# yielding the result of each chunk as it becomes available.
+# func and args must be picklable. At most 2 chunks per worker are in
+# flight at once, so items can be produced lazily. If ordered, results
+# come back in the order of the chunks, otherwise as they complete.
+# Setting the cancel event (e.g. threading.Event) stops the run early.
+def map_chunks(func, items, args=(), workers=None, chunksize=64, \
+        ordered=True, cancel=None):
+    workers = workers or cpu_count() or 1
+    chunks = chunked(items, chunksize)
+    executor = ProcessPoolExecutor(workers)
+    in_flight = deque()
+    try:
+        while True:
+            # Keep the pool busy
+            while len(in_flight) < 2*workers and not (cancel and cancel.is_set()):
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                in_flight.append(executor.submit(func, chunk, *args))
+            if not in_flight or (cancel and cancel.is_set()):
+                return
+            if ordered:
+                yield in_flight.popleft().result()
+            else:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.remove(future)
+                    yield future.result()
+    finally:
+        # Also reached if the consumer stops early
+        executor.shutdown(wait=True, cancel_futures=True)
+
+# Worker: load each file as an object, and return the
+# fullpaths of the objects that pass the query
+def query_chunk(fullpaths, obj_class, query):
+    return [f for f in fullpaths if query(obj_class(f))]
+
+# Worker: apply func to each object loaded from file, writing objects
+# that were changed. Returns the results, as well as the changes made
+# to files as (event, filepath, stat, metadata) so they can be
+# applied to the database in the calling process
+def apply_chunk(fullpaths, obj_class, func):
+    results = []
+    changes = []
+    def on_change(obj, event, filepath):
+        if event == 'write':
+            changes.append((event, filepath, \
+                    obj_class.stat(filepath), obj.get_metadata()))
+        elif event == 'delete':
+            changes.append((event, filepath, None, None))
+    for fullpath in fullpaths:
+        obj = obj_class(fullpath)
+        obj._on_change = on_change
+        results.append(func(obj))
+        if obj._dirty:
+            obj._write()
+    return results, changes
+
+if __name__ == '__main__':
+    from threading import Event
+
+    assert(list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]])
+    assert(list(chunked([], 2)) == [])
+
+    results = list(map_chunks(sum, range(100), workers=2, chunksize=10))
+    assert(results == [sum(range(10*i, 10*(i+1))) for i in range(10)])
+    results = list(map_chunks(sum, range(100), workers=2, chunksize=10, ordered=False))
+    assert(sorted(results) == [sum(range(10*i, 10*(i+1))) for i in range(10)])
+
+    # Cancelling stops any more chunks from being submitted
+    cancel = Event()
+    results = []
+    for result in map_chunks(sum, range(1000), workers=1, chunksize=10, cancel=cancel):
+        results.append(result)
+        cancel.set()
+    assert(len(results) == 1)
+    print("map_chunks() Testing Passed!")
@@ -0,0 +1,248 @@
+from .index import tokenize, get_terms
+
+from re import compile as re_compile
+
+# Declarative queries for FileDatabase.query() and parallel_query().
+# Unlike lambdas, these can be pickled and sent to worker processes.
+
+# Get the value a query looks at from an object, where field is either
+# the name of a getter method (e.g. 'get_title'), a path for objects
+# with a get() method (e.g. 'root/testcase/title'), or None for the
+# whole contents of the object
+def get_field(obj, field):
+    if field is None:
+        return obj._contents if isinstance(obj._contents, str) else str(obj)
+    if '/' in field:
+        return obj.get(field)
+    return getattr(obj, field)()
+
+class Regex(object):
+    def __init__(self, pattern, field=None):
+        self.pattern = pattern
+        self.field = field
+        self._regex = re_compile(pattern)
+
+    def __getstate__(self):
+        return (self.pattern, self.field)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return "{0}({1!r}, field={2!r})".format(self.__class__.__name__, \
+                self.pattern, self.field)
+
+    def __call__(self, obj):
+        return self._regex.search(str(get_field(obj, self.field))) is not None
+
+class Contains(object):
+    def __init__(self, text, field=None):
+        self.text = text
+        self.field = field
+
+    def __repr__(self):
+        return "{0}({1!r}, field={2!r})".format(self.__class__.__name__, \
+                self.text, self.field)
+
+    def __call__(self, obj):
+        return self.text in str(get_field(obj, self.field))
+
+class AllOf(object):
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def __repr__(self):
+        return "{0}{1!r}".format(self.__class__.__name__, self.queries)
+
+    def __call__(self, obj):
+        return all(q(obj) for q in self.queries)
+
+class AnyOf(AllOf):
+    def __call__(self, obj):
+        return any(q(obj) for q in self.queries)
+
+class Not(object):
+    def __init__(self, query):
+        self.query = query
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.query)
+
+    def __call__(self, obj):
+        return not self.query(obj)
+
+# Queries of the terms in the metadata of objects (see index.get_terms()).
+# These can be looked up in the inverted index of a FileDatabase (see
+# FileDatabase.lookup()) without loading any objects, or called on
+# objects like the other queries.
+#
+# Each gives a SQL query selecting the basenames of matching entries
+# from the terms table (see to_sql()), and a SQL condition on a basename
+# (see condition()). Given count(lo, hi), an estimate of the number of
+# terms in [lo, hi), the rarest part of an And is selected first and
+# the other parts are only checked for those basenames (using the
+# primary key), so common terms don't make lookups slow
+
+_nothing_sql = 'SELECT basename FROM terms WHERE 0'
+
+def _join_conditions(queries, column, operator):
+    if not queries:
+        return '0', []
+    conditions, params = [], []
+    for query in queries:
+        condition, condition_params = query.condition(column)
+        conditions.append(condition)
+        params.extend(condition_params)
+    return '(' + operator.join(conditions) + ')', params
+
+# Terms from lo up to (but not including) hi, or the term lo if hi is None
+class _Range(object):
+    def __init__(self, lo, hi=None):
+        self.lo = lo
+        self.hi = hi
+
+    def estimate(self, count):
+        return count(self.lo, self.hi)
+
+    def _where(self):
+        if self.hi is None:
+            return 'term = ?', [self.lo]
+        return 'term >= ? AND term < ?', [self.lo, self.hi]
+
+    def to_sql(self, count):
+        where, params = self._where()
+        return 'SELECT DISTINCT basename FROM terms WHERE ' + where, params
+
+    def condition(self, column):
+        where, params = self._where()
+        return 'EXISTS (SELECT 1 FROM terms WHERE basename = ' + column + \
+                ' AND ' + where + ')', params
+
+class And(AllOf):
+    def estimate(self, count):
+        return min(q.estimate(count) for q in self.queries) if self.queries else 0
+
+    def to_sql(self, count):
+        if not self.queries:
+            return _nothing_sql, []
+        first = min(self.queries, key=lambda q: q.estimate(count))
+        sql, params = first.to_sql(count)
+        others = [q for q in self.queries if q is not first]
+        if not others:
+            return sql, params
+        sql = 'SELECT basename FROM (' + sql + ') AS c WHERE '
+        for query in others:
+            condition, condition_params = query.condition('c.basename')
+            sql += condition + (' AND ' if query is not others[-1] else '')
+            params = params + condition_params
+        return sql, params
+
+    def condition(self, column):
+        return _join_conditions(self.queries, column, ' AND ')
+
+class Or(AnyOf):
+    def estimate(self, count):
+        return sum(q.estimate(count) for q in self.queries)
+
+    def to_sql(self, count):
+        if not self.queries:
+            return _nothing_sql, []
+        sqls, params = [], []
+        for query in self.queries:
+            sql, query_params = query.to_sql(count)
+            sqls.append('SELECT basename FROM (' + sql + ')')
+            params.extend(query_params)
+        return ' UNION '.join(sqls), params
+
+    def condition(self, column):
+        return _join_conditions(self.queries, column, ' OR ')
+
+# Objects with every term of the text, e.g. Term('sig-name')
+# for objects with both of the terms 'sig' and 'name'
+class Term(object):
+    def __init__(self, text):
+        self.text = text
+        self.terms = tokenize(text)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.text)
+
+    def __call__(self, obj):
+        return bool(self.terms) and set(self.terms) <= get_terms(obj.get_metadata())
+
+    def _query(self):
+        return And(*[_Range(t) for t in self.terms])
+
+    def estimate(self, count):
+        return self._query().estimate(count)
+
+    def to_sql(self, count):
+        return self._query().to_sql(count)
+
+    def condition(self, column):
+        return self._query().condition(column)
+
+# Objects with every term of the text, where the last
+# term is a prefix, e.g. Prefix('sig-na') also matches 'sig-name'
+class Prefix(Term):
+    def __call__(self, obj):
+        terms = get_terms(obj.get_metadata())
+        return bool(self.terms) and set(self.terms[:-1]) <= terms and \
+                any(t.startswith(self.terms[-1]) for t in terms)
+
+    def _query(self):
+        if not self.terms:
+            return And()
+        # Terms are sorted, so this is a range of the primary key
+        prefix = _Range(self.terms[-1], self.terms[-1] + chr(0x10ffff))
+        return And(*[_Range(t) for t in self.terms[:-1]] + [prefix])
+
+if __name__ == '__main__':
+    from pickle import dumps, loads
+
+    # Stand-in object with string contents
+    class Obj(object):
+        def __init__(self, contents):
+            self._contents = contents
+        def get_title(self):
+            return self._contents.split('\n')[0]
+
+    obj = Obj('Title 12\nBody text')
+    assert(Regex('[0-9]{2}')(obj))
+    assert(not Regex('^Body')(obj))
+    assert(Regex('^Body', field=None)(Obj('Body')))
+    assert(Contains('Title', field='get_title')(obj))
+    assert(not Contains('Body', field='get_title')(obj))
+    assert(AllOf(Contains('1'), Contains('2'))(obj))
+    assert(not AllOf(Contains('1'), Contains('3'))(obj))
+    assert(AnyOf(Contains('3'), Contains('2'))(obj))
+    assert(Not(Contains('3'))(obj))
+
+    # Queries survive pickling
+    query = loads(dumps(AllOf(Regex('Title [0-9]+'), Not(Contains('z')))))
+    assert(query(obj))
+
+    # Term queries, on objects with metadata
+    class MetadataObj(object):
+        def get_metadata(self):
+            return {'title': 'Engine Start', 'signals': ['eng-speed', 'oil_temp']}
+
+    obj = MetadataObj()
+    assert(Term('engine')(obj) and Term('ENG SPEED')(obj))
+    assert(not Term('speed start stop')(obj) and not Term('')(obj))
+    assert(Prefix('oil-te')(obj) and Prefix('sta')(obj))
+    assert(not Prefix('temp-x')(obj))
+    assert(And(Term('start'), Prefix('oil'))(obj))
+    assert(not And(Term('start'), Term('stop'))(obj))
+    assert(Or(Term('stop'), Prefix('spe'))(obj))
+    assert(loads(dumps(Or(Term('stop'), And(Prefix('spe'), Term('oil')))))(obj))
+    # The rarest part of an And is selected first
+    counts = {'a': 20, 'b': 1, 'c': 5, 'd': 5}
+    count = lambda lo, hi: counts[lo]
+    sql, params = And(Term('a b'), Or(Prefix('c'), Term('d'))).to_sql(count)
+    assert(sql.count('EXISTS') == 3 and sql.count('UNION') == 0)
+    assert(params == ['b', 'a', 'c', 'c' + chr(0x10ffff), 'd'])
+    sql, params = And(Term('a'), Or(Prefix('c'), Term('d'))).to_sql(count)
+    assert(sql.count('EXISTS') == 1 and sql.count('UNION') == 1)
+    assert(params == ['c', 'c' + chr(0x10ffff), 'd', 'a'])
+    print("Query Testing Passed!")
@@ -1,3 +1,6 @@
+from functools import lru_cache
+from re import compile as re_compile
+
 # Traverse the tree
 def traverse(tree, path, value=None):
     # given path='key0/key1/.../keyN',
@@ -62,7 +65,115 @@ def traverse(tree, path, value=None):
     # assume it is a value and return it
     return tree
 
+# Range selector keys, e.g. '2:5' (not namespaced keys, e.g. 'ns:tag')
+_range_regex = re_compile(r'-?\d*:-?\d*')
+
+class CompiledPath(object):
+    '''
+    A path (as used by traverse()) parsed once, so it can be used
+    on many trees without re-parsing it. Walks the tree iteratively,
+    following the same rules as traverse(): missing keys are created
+    (as a dict if the next key starts with a letter, otherwise a list),
+    list indices can be negative, '-1' (or the length of the list)
+    extends a list when setting, 'start:end' selects a range, and a
+    trailing '#pop' pops the previous key.
+    '''
+    __slots__ = ('path', '_keys', '_indices', '_new', '_range', '_pop')
+
+    def __init__(self, path):
+        self.path = path
+        keys = path.split('/')
+        self._pop = len(keys) > 1 and keys[-1] == '#pop'
+        if self._pop:
+            keys = keys[:-1]
+        self._keys = keys
+        # Keys as list indices (where they are numerical)
+        self._indices = [int(k) if k.strip('-').isdigit() else None for k in keys]
+        # Type of container to create for missing keys
+        self._new = [dict if n[:1].isalpha() else list \
+                for n in keys[1:] + keys[-1:]]
+        # Range selector on the last key (if any)
+        self._range = None
+        if _range_regex.fullmatch(keys[-1]):
+            self._range = tuple(int(k) if k else None for k in keys[-1].split(':'))
+
+    def __repr__(self):
+        return  "{0}('{1}')".format(self.__class__.__name__, self.path)
+
+    # Walk to the node holding the last key, creating missing keys.
+    # Returns None if the walk ran into a value instead of a node
+    def _parent(self, tree):
+        keys = self._keys
+        indices = self._indices
+        new = self._new
+        node = tree
+        for i in range(len(keys) - 1):
+            if isinstance(node, dict):
+                key = keys[i]
+                if key not in node:
+                    node[key] = new[i]()
+                node = node[key]
+            elif isinstance(node, list):
+                node = node[indices[i]]
+            else:
+                return None, node
+        return node, None
+
+    def get(self, tree):
+        if self._pop:
+            return self.pop(tree)
+        node, value = self._parent(tree)
+        if node is None:
+            return value
+        key = self._keys[-1]
+        if isinstance(node, dict):
+            if key not in node:
+                node[key] = self._new[-1]()
+            return node[key]
+        elif isinstance(node, list):
+            if self._indices[-1] is not None:
+                return node[self._indices[-1]]
+            return node[self._range[0]:self._range[1]]
+        return node
+
+    def set(self, tree, value):
+        if self._pop:
+            return self.pop(tree)
+        node, _ = self._parent(tree)
+        key = self._keys[-1]
+        if isinstance(node, dict):
+            node[key] = value
+        elif isinstance(node, list):
+            index = self._indices[-1]
+            if index == -1 or index == len(node):
+                # Extends the list
+                if isinstance(value, list):
+                    node.extend(value)
+                else:
+                    node.append(value)
+            else:
+                node[index] = value
+
+    def pop(self, tree):
+        node, value = self._parent(tree)
+        if node is None:
+            return value
+        if isinstance(node, list):
+            return node.pop(self._indices[-1])
+        return node.pop(self._keys[-1])
+
+    def slice(self, tree, start=None, end=None):
+        return self.get(tree)[start:end]
+
+# Get the compiled form of the path, re-using
+# previously compiled paths
+@lru_cache(maxsize=1024)
+def compile_path(path):
+    return CompiledPath(path)
+
+
 if __name__ == '__main__':
+    from copy import deepcopy
     # run tests
     test_tree = {}
     traverse(test_tree, 'root/nested')
@@ -93,3 +204,42 @@ if __name__ == '__main__':
     assert(traverse(test_tree, 'root/new/nested')['inside']['another'] == 'nested')
     
     print("traverse() Testing Passed!")
+
+    # Compiled paths behave the same way as traverse()
+    def compiled(tree, path, value=None):
+        if value:
+            return compile_path(path).set(tree, value)
+        return compile_path(path).get(tree)
+    compiled_tree = {}
+    for path, value in [('root/nested', None), ('root/nested/multiple', 'times'), \
+            ('root/branch', ['A', 'B']), ('root/branch/1', None), \
+            ('root/new/branch/-1', 'C'), ('root/new/branch/1', 'd'), \
+            ('root/new/branch/1', 'D'), ('root/new/branch/-1', 'E'), \
+            ('root/new/branch/-1', ['F', 'G']), ('root/new/branch/2:5', None), \
+            ('root/new/branch/2/#pop', None), ('root/new/branch/-1/#pop', None), \
+            ('root/list/-1', 'x'), ('root/list/0', None), ('root/@attr', None), ('root/nested/multiple/x', None), \
+            ('root/new', {'nested': {'inside' : {'another' : 'nested'}}}), \
+            ('root/new/nested/inside/another', None), ('root/ns:tag', 'namespaced'), \
+            ('root/ns:tag', None), ('root/@xmlns:ns', 'uri'), ('root/@xmlns:ns', None)]:
+        test_tree_copy = deepcopy(compiled_tree)
+        assert(compiled(compiled_tree, path, value) == traverse(test_tree_copy, path, value))
+        assert(compiled_tree == test_tree_copy)
+    assert(compile_path('root/new/branch') is compile_path('root/new/branch'))
+    assert(compile_path('root/new/nested/inside').pop(compiled_tree) == {'another' : 'nested'})
+    assert(compile_path('root/branch').slice(compiled_tree, 1) == ['B'])
+    assert(compile_path('root/branch/:1').get(compiled_tree) == ['A'])
+    print("compile_path() Testing Passed!")
+
+    # Micro-benchmark against traverse()
+    from timeit import timeit
+    depth, width, number = 50, 10000, 2000
+    deep_tree = {}
+    deep_path = '/'.join('key{}'.format(i) for i in range(depth))
+    traverse(deep_tree, deep_path, value='leaf')
+    wide_tree = {'root' : {'items' : [{'@name' : str(i)} for i in range(width)]}}
+    wide_path = 'root/items/{}/@name'.format(width // 2)
+    for name, tree, path in [('deep', deep_tree, deep_path), ('wide', wide_tree, wide_path)]:
+        t_traverse = timeit(lambda: traverse(tree, path), number=number)
+        t_compiled = timeit(lambda: compile_path(path).get(tree), number=number)
+        print('  {}: traverse() {:.2f}us, compile_path().get() {:.2f}us ({:.1f}x)'.format( \
+                name, 1e6*t_traverse/number, 1e6*t_compiled/number, t_traverse/t_compiled))
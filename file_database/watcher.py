@@ -0,0 +1,414 @@
+from .basic_file_manager import journal_path
+
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from logging import getLogger
+from os import close as fd_close, read as fd_read, stat as file_stat, walk, strerror
+from os.path import join as path_join, relpath, sep as path_sep
+from select import select
+from struct import Struct
+from threading import Thread, Event
+from time import time
+
+logger = getLogger(__name__)
+
+# Change to a watched file. event is one of 'add', 'modify', 'move'
+# or 'delete', and dest is the new path of a moved file
+FileEvent = namedtuple('FileEvent', ['event', 'path', 'dest'])
+FileEvent.__new__.__defaults__ = (None,)
+
+# (mtime, size) of a file and its journal (if it has one),
+# or None if it doesn't exist
+def default_stat(filepath):
+    try:
+        st = file_stat(filepath)
+    except OSError:
+        return None
+    try:
+        journal_st = file_stat(journal_path(filepath))
+    except OSError:
+        return st.st_mtime, st.st_size
+    return max(st.st_mtime, journal_st.st_mtime), st.st_size + journal_st.st_size
+
+class Watcher(ABC):
+    '''
+    Watches the files with the extension under a root directory, and
+    reports the changes made to them (by anyone) as FileEvents.
+    Hidden files and directories (e.g. temporary files and indexes)
+    aren't watched, except that a change to the journal of a file
+    (see basic_file_manager.journal_path()) is a change to the file.
+
+    The watcher keeps a snapshot of the stat (see default_stat()) of
+    every file, and events are found by comparing the stat of the files
+    that might have changed against the snapshot. Subclasses decide
+    which files might have changed (see _changed_paths()).
+
+    Either call poll() for the events since the last poll, or start()
+    a thread calling back with each list of events. Errors in the thread
+    (e.g. the callback failing on a file being written) are logged, and
+    the thread keeps watching.
+    '''
+    def __init__(self, root, ext, stat=None, interval=1.0):
+        self._root = root
+        self._ext = '.' + ext
+        self._stat = stat or default_stat
+        self.interval = interval
+        self._files = self._snapshot()
+        self._thread = None
+        self._stopped = Event()
+
+    def __repr__(self):
+        return "{0}('{1}', '{2}')".format(self.__class__.__name__, \
+                self._root, self._ext[1:])
+
+    # Stat functions return None (or raise OSError) if there is no file
+    def _stat_of(self, filepath):
+        try:
+            return self._stat(filepath)
+        except OSError:
+            return None
+
+    # Path of the watched file a path belongs to (or None)
+    def _watched_path(self, filepath):
+        directory, _, filename = filepath.rpartition(path_sep)
+        if directory != self._root and \
+                any(d.startswith('.') for d in relpath(directory, self._root).split(path_sep)):
+            return None
+        if filename.startswith('.') and filename.endswith('.journal'):
+            filename = filename[1:-len('.journal')]
+        elif filename.startswith('.'):
+            return None
+        return directory + path_sep + filename if filename.endswith(self._ext) else None
+
+    def _walk(self, directory):
+        for dirpath, dirnames, filenames in walk(directory):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            yield dirpath, filenames
+
+    # Map of path -> stat for every watched file under the directory
+    def _snapshot(self, directory=None):
+        files = {}
+        for dirpath, filenames in self._walk(directory or self._root):
+            for filename in filenames:
+                filepath = self._watched_path(path_join(dirpath, filename))
+                if filepath is not None and filepath not in files:
+                    stat = self._stat_of(filepath)
+                    if stat is not None:
+                        files[filepath] = stat
+        return files
+
+    # Give the paths that might have changed (in the order they
+    # changed) and a map of path -> dest of moved files, waiting
+    # up to timeout seconds for any changes
+    @abstractmethod
+    def _changed_paths(self, timeout):
+        pass
+
+    # Compare the paths (in order) against the snapshot, and update it
+    def _events(self, paths, moves={}):
+        events = []
+        for path in paths:
+            old = self._files.get(path)
+            new = self._stat_of(path)
+            dest = moves.get(path)
+            if old is not None and new is None and dest is not None and \
+                    dest not in self._files and self._stat_of(dest) is not None:
+                events.append(FileEvent('move', path, dest))
+                del self._files[path]
+                self._files[dest] = self._stat_of(dest)
+            elif old is None and new is not None:
+                events.append(FileEvent('add', path))
+            elif old is not None and new is None:
+                events.append(FileEvent('delete', path))
+            elif old != new:
+                events.append(FileEvent('modify', path))
+            if new is None:
+                self._files.pop(path, None)
+            else:
+                self._files[path] = new
+        return events
+
+    # Get the list of events since the last poll, waiting up
+    # to timeout seconds (or the interval) for any changes
+    def poll(self, timeout=None):
+        paths, moves = self._changed_paths(self.interval if timeout is None else timeout)
+        # Each changed path is only compared once
+        paths = list(dict.fromkeys(list(moves.keys()) + paths))
+        return self._events(paths, moves)
+
+    # Call back with each list of events, from a thread
+    def start(self, callback):
+        self._stopped.clear()
+        def run():
+            while not self._stopped.is_set():
+                try:
+                    events = self.poll()
+                    if events:
+                        callback(events)
+                except Exception:
+                    logger.exception("%r failed, still watching", self)
+                    # Don't spin if polling itself keeps failing
+                    self._stopped.wait(self.interval)
+        self._thread = Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+
+class PollingWatcher(Watcher):
+    '''
+    Watcher comparing snapshots of every file, taken every interval
+    seconds. Moves are found by pairing deleted and added files with
+    the same stat (which a rename keeps).
+    '''
+    def _changed_paths(self, timeout):
+        self._stopped.wait(timeout)
+        files = self._snapshot()
+        paths = [p for p in self._files if p not in files] + \
+                [p for p, stat in files.items() if self._files.get(p) != stat]
+        added = {files[p]: p for p in paths if p not in self._files}
+        moves = {}
+        for path in paths:
+            if path not in files and added.get(self._files[path]):
+                moves[path] = added.pop(self._files[path])
+        return paths, moves
+
+# inotify (Linux) through the C library, if it has it
+_libc = None
+try:
+    _libc = CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1, _libc.inotify_add_watch
+except (OSError, AttributeError):
+    _libc = None
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+        IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# struct inotify_event, followed by the (padded) name
+_inotify_event = Struct('iIII')
+
+class InotifyWatcher(Watcher):
+    '''
+    Watcher using inotify, so only the files the kernel reports as
+    changed are compared. Every directory under the root is watched,
+    and moves are paired by the cookie of their two events. If the
+    kernel's queue overflows, every file is compared instead.
+    '''
+    def __init__(self, root, ext, stat=None, interval=1.0):
+        if _libc is None:
+            raise OSError("inotify is not available!")
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(get_errno(), strerror(get_errno()))
+        # Watched directories, by watch descriptor
+        self._dirs = {}
+        super().__init__(root, ext, stat, interval)
+        self._watch_tree(root)
+
+    def _watch_tree(self, directory):
+        for dirpath, _ in self._walk(directory):
+            wd = _libc.inotify_add_watch(self._fd, dirpath.encode(), IN_WATCH_MASK)
+            if wd >= 0:
+                self._dirs[wd] = dirpath
+
+    def _read_events(self, timeout):
+        if not select([self._fd], [], [], timeout)[0]:
+            return b''
+        data = b''
+        # Read everything queued (a whole checkout at once)
+        while True:
+            try:
+                chunk = fd_read(self._fd, 64*1024)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def _changed_paths(self, timeout):
+        paths = []
+        moves = {}
+        moved_from = {}
+        data = self._read_events(timeout)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _inotify_event.unpack_from(data, offset)
+            offset += _inotify_event.size
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return list(self._files) + list(self._snapshot()), {}
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            filepath = path_join(directory, name)
+            if mask & IN_ISDIR:
+                if name.startswith('.'):
+                    continue
+                prefix = filepath + path_sep
+                # Files of directories that left have gone
+                if mask & (IN_MOVED_FROM | IN_DELETE):
+                    paths.extend(p for p in self._files if p.startswith(prefix))
+                # Files of directories that arrived are new
+                if mask & (IN_MOVED_TO | IN_CREATE):
+                    self._watch_tree(filepath)
+                    paths.extend(self._snapshot(filepath))
+                continue
+            filepath = self._watched_path(filepath)
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = filepath
+            elif mask & IN_MOVED_TO and moved_from.get(cookie) and filepath:
+                moves[moved_from.pop(cookie)] = filepath
+            if filepath is not None:
+                paths.append(filepath)
+        return paths, moves
+
+    def close(self):
+        super().close()
+        if self._fd >= 0:
+            fd_close(self._fd)
+            self._fd = -1
+
+# Watcher of the files using inotify if possible, otherwise polling
+def create_watcher(root, ext, stat=None, interval=1.0):
+    if _libc is not None:
+        try:
+            return InotifyWatcher(root, ext, stat, interval)
+        except OSError:
+            pass
+    return PollingWatcher(root, ext, stat, interval)
+
+if __name__ == '__main__':
+    from os import makedirs, remove as file_remove, rename, replace
+    from os.path import exists as file_exists
+    from shutil import rmtree
+    from time import sleep
+
+    test_dir = 'test-watcher'
+    if file_exists(test_dir):
+        rmtree(test_dir)
+    makedirs(test_dir + '/sub')
+
+    # Files are written in one step, so they aren't seen half written
+    def write(basename, text, ext='txt'):
+        with open(test_dir + '/.tmp', 'w') as f:
+            f.write(text)
+        replace(test_dir + '/.tmp', test_dir + '/' + basename + '.' + ext)
+
+    def path(basename):
+        return test_dir + '/' + basename + '.txt'
+
+    # Poll until the events (ignoring ones that may be split between polls)
+    def poll_events(watcher, count):
+        events = []
+        start = time()
+        while len(events) < count and time() - start < 5:
+            events.extend(watcher.poll(0.1))
+        return events
+
+    write('existing', 'Existing')
+    for cls in [PollingWatcher, InotifyWatcher] if _libc else [PollingWatcher]:
+        watcher = cls(test_dir, 'txt', interval=0.05)
+        assert(list(watcher._files) == [path('existing')])
+        assert(watcher.poll(0) == [])
+
+        write('added', 'Added')
+        write('sub/other', 'Other', ext='xml') # Not watched
+        write('.hidden', 'Hidden')
+        assert(poll_events(watcher, 1) == [FileEvent('add', path('added'))])
+
+        write('added', 'Modified')
+        assert(poll_events(watcher, 1) == [FileEvent('modify', path('added'))])
+
+        rename(path('added'), path('sub/moved'))
+        assert(poll_events(watcher, 1) == \
+                [FileEvent('move', path('added'), path('sub/moved'))])
+
+        # Journals are part of their files
+        write('sub/.moved.txt', 'Journal', ext='journal')
+        assert(poll_events(watcher, 1) == [FileEvent('modify', path('sub/moved'))])
+        file_remove(test_dir + '/sub/.moved.txt.journal')
+        poll_events(watcher, 1)
+
+        # New directories are watched, and deleted ones are gone
+        makedirs(test_dir + '/new')
+        write('new/file', 'New')
+        sleep(0.05)
+        write('new/file-2', 'New')
+        events = poll_events(watcher, 2)
+        assert(set(events) == {FileEvent('add', path('new/file')), \
+                FileEvent('add', path('new/file-2'))})
+        rmtree(test_dir + '/new')
+        file_remove(path('sub/moved'))
+        events = poll_events(watcher, 3)
+        assert(set(events) == {FileEvent('delete', path('new/file')), \
+                FileEvent('delete', path('new/file-2')), FileEvent('delete', path('sub/moved'))})
+
+        # Events can be delivered from a thread
+        delivered = []
+        watcher.start(delivered.extend)
+        write('threaded', 'Threaded')
+        start = time()
+        while not delivered and time() - start < 5:
+            sleep(0.01)
+        watcher.close()
+        assert(delivered == [FileEvent('add', path('threaded'))])
+        file_remove(path('threaded'))
+
+        # ...and errors in the thread don't stop it
+        def fail_once(events):
+            if not delivered:
+                delivered.append(None)
+                raise ValueError("Half-written file")
+            delivered.extend(events)
+        delivered = []
+        logger.disabled = True
+        watcher = cls(test_dir, 'txt', interval=0.05)
+        watcher.start(fail_once)
+        write('failed', 'Failed')
+        start = time()
+        while not delivered and time() - start < 5:
+            sleep(0.01)
+        sleep(0.1)
+        write('recovered', 'Recovered')
+        while len(delivered) < 2 and time() - start < 5:
+            sleep(0.01)
+        watcher.close()
+        logger.disabled = False
+        assert(delivered == [None, FileEvent('add', path('recovered'))])
+        file_remove(path('failed'))
+        file_remove(path('recovered'))
+
+    # The base class only compares snapshots, and can't find changes itself
+    try:
+        Watcher(test_dir, 'txt')
+        assert(False)
+    except TypeError:
+        pass
+
+    rmtree(test_dir)
+    print("Watcher() Testing Passed!")
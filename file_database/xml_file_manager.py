@@ -1,24 +1,331 @@
 from .basic_file_manager import FileContentManager
-from .traverse import traverse
+from .metrics import timed
+from .traverse import compile_path
 
+from collections import OrderedDict
+from io import StringIO
+from json import dumps as json_dumps
+from xml.parsers.expat import ParserCreate
+from xml.sax.saxutils import XMLGenerator
+from xml.sax.xmlreader import AttributesImpl
 import xmltodict
 
+# Pretty printing, as with xmltodict.unparse(pretty=True, indent='  ')
+XML_INDENT = '  '
+XML_NEWL = '\n'
+
+class LazyElement(object):
+    '''
+    Placeholder for elements that were found in the document, but
+    have not been parsed yet. Holds the source of each element with
+    the tag (as it was in the document), and their attributes.
+    '''
+    def __init__(self, tag, sources, attrs):
+        self.tag = tag
+        self._sources = sources
+        self._attrs = attrs
+
+    def __repr__(self):
+        return "{0}('{1}', {2})".format(self.__class__.__name__, self.tag, \
+                len(self._sources))
+
+    # Parse the elements, as xmltodict would have
+    # (a list if there are multiple elements)
+    @timed('xml.parse_lazy')
+    def load(self):
+        values = [xmltodict.parse(source)[self.tag] for source in self._sources]
+        return values[0] if len(values) == 1 else values
+
+    # Attributes of each element (which are parsed anyway
+    # while finding the elements)
+    def attributes(self):
+        return [OrderedDict(('@' + k, v) for k, v in attrs.items()) \
+                for attrs in self._attrs]
+
+class ElementSplitter(object):
+    '''
+    Cuts the elements with the given tags that are direct children of
+    the path out of an XML document, leaving an empty element in their
+    place, while the document is read in chunks with expat (which only
+    parses the tags, not the elements into a tree). Elements end where
+    the event after them starts (see CurrentByteIndex), so their
+    source is kept exactly as it was in the document.
+
+    Feed the document to feed() and call close(), then parse the
+    remaining header, and the elements' (source, attributes) by tag.
+    '''
+    def __init__(self, path, tags):
+        self._keys = path.split('/')
+        self._tags = set(tags)
+        self._stack = []
+        # Document not cut up yet, from offset in the document
+        self._buf = bytearray()
+        self._offset = 0
+        # (tag, attributes, start, depth) of the element being cut
+        # out, and the one that ends where the next event starts
+        self._element = None
+        self._ending = None
+        self._header = []
+        self.elements = OrderedDict()
+        self._parser = ParserCreate()
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._parser.CommentHandler = \
+                self._parser.ProcessingInstructionHandler = \
+                self._parser.DefaultHandlerExpand = self._event
+
+    @property
+    def header(self):
+        return b''.join(self._header)
+
+    def _take(self, position):
+        taken = bytes(self._buf[:position - self._offset])
+        del self._buf[:position - self._offset]
+        self._offset = position
+        return taken
+
+    def _event(self, *args):
+        if self._ending is not None:
+            self._cut(self._parser.CurrentByteIndex)
+
+    def _cut(self, end):
+        tag, attrs, _, _ = self._ending
+        self._ending = None
+        self.elements.setdefault(tag, []).append((self._take(end).decode('utf-8'), attrs))
+        self._header.append('<{}/>'.format(tag).encode('utf-8'))
+
+    def _start(self, tag, attrs):
+        self._event()
+        if self._element is None and tag in self._tags and self._stack == self._keys:
+            start = self._parser.CurrentByteIndex
+            self._header.append(self._take(start))
+            self._element = (tag, attrs, start, len(self._stack))
+        self._stack.append(tag)
+
+    def _end(self, tag):
+        self._event()
+        self._stack.pop()
+        if self._element is not None and len(self._stack) == self._element[3]:
+            self._ending, self._element = self._element, None
+
+    def feed(self, data):
+        self._buf.extend(data)
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse(b'', True)
+        if self._ending is not None:
+            self._cut(self._offset + len(self._buf))
+        self._header.append(self._take(self._offset + len(self._buf)))
+
+# Read the XML document from the binary file in chunks, cutting out
+# the elements with the tags (see ElementSplitter). Returns the
+# remaining document, and the elements' (source, attributes) by tag
+def split_elements(f, path, tags, chunk_size=64*1024):
+    splitter = ElementSplitter(path, tags)
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        splitter.feed(chunk)
+    splitter.close()
+    return splitter.header, splitter.elements
+
 class XMLContentManager(FileContentManager):
+    '''
+    Manages a file holding an XML document, parsed using xmltodict.
+
+    Documents can be loaded lazily: elements with one of the lazy_tags
+    that are direct children of lazy_path are cut out of the document
+    before it is parsed, and are only parsed the first time a path
+    that touches them is used (e.g. by get() or set()). Accessing
+    _contents directly always parses the whole document.
+
+    Documents are written out as xmltodict.unparse() would, but
+    streamed to the file. Elements with one of the lazy_tags that were
+    never parsed are written as they were in the file, and the others
+    are formatted once and cached until a path touches them, so small
+    changes don't format the whole document again.
+
+    With a journal (see FileContentManager), set() is journaled as
+    {"set": path, "value": value} whenever that can be replayed again
+    (the value is JSON, and the path doesn't extend or pop a list).
+    '''
+    lazy_path = None
+    lazy_tags = ()
+
+    @property
+    def _contents(self):
+        self._load_lazy()
+        # Could be changed anywhere
+        self._xml_cache = {}
+        return self._tree
+
+    @_contents.setter
+    def _contents(self, contents):
+        self._tree = contents
+        self._lazy_node = None
+        # Formatted elements by tag
+        self._xml_cache = {}
+
     # Override to update representation string
-    # Also updates how write() method works
     def __str__(self):
-        return xmltodict.unparse(super().__str__(), pretty=True, indent='  ')
+        output = StringIO()
+        self._write_to(output)
+        return output.getvalue()
+
+    def _write_to(self, f):
+        handler = XMLGenerator(f, 'utf-8')
+        handler.startDocument()
+        path_keys = self.lazy_path.split('/') if self.lazy_tags else []
+        for key, value in self._tree.items():
+            self._emit(handler, key, value, path_keys, 0)
+        handler.endDocument()
+
+    # Same as xmltodict._emit(), except for the lazy elements
+    # (which are direct children of the lazy path)
+    def _emit(self, handler, key, value, path_keys, depth):
+        if not path_keys or path_keys[0] != key or not isinstance(value, dict):
+            xmltodict._emit(key, value, handler, depth=depth, preprocessor=self._preprocess, \
+                    pretty=True, indent=XML_INDENT, newl=XML_NEWL, full_document=not depth)
+            return
+        attrs = AttributesImpl(OrderedDict((k[1:], str(v)) \
+                for k, v in value.items() if k.startswith('@')))
+        children = [(k, v) for k, v in value.items() if k != '#text' and k[:1] != '@']
+        handler.ignorableWhitespace(depth*XML_INDENT)
+        handler.startElement(key, attrs)
+        if children:
+            handler.ignorableWhitespace(XML_NEWL)
+        for child_key, child_value in children:
+            if len(path_keys) == 1 and child_key in self.lazy_tags:
+                self._emit_lazy(handler, child_key, child_value, depth + 1)
+            else:
+                self._emit(handler, child_key, child_value, path_keys[1:], depth + 1)
+        if value.get('#text') is not None:
+            handler.characters(value['#text'])
+        if children:
+            handler.ignorableWhitespace(depth*XML_INDENT)
+        handler.endElement(key)
+        if depth:
+            handler.ignorableWhitespace(XML_NEWL)
+
+    def _emit_lazy(self, handler, tag, value, depth):
+        if isinstance(value, LazyElement):
+            for source in value._sources:
+                handler.ignorableWhitespace(depth*XML_INDENT + source + XML_NEWL)
+            return
+        elements = value if isinstance(value, list) else [value]
+        cache = self._xml_cache.get(tag)
+        if cache is None or len(cache) != len(elements):
+            cache = self._xml_cache[tag] = [None]*len(elements)
+        for i, element in enumerate(elements):
+            if cache[i] is None:
+                output = StringIO()
+                xmltodict._emit(tag, element, XMLGenerator(output, 'utf-8'), \
+                        depth=depth, preprocessor=self._preprocess, pretty=True, \
+                        indent=XML_INDENT, newl=XML_NEWL, full_document=False)
+                cache[i] = output.getvalue()
+            handler.ignorableWhitespace(cache[i])
+
+    # Drop the formatted elements the path could change
+    def _touch(self, path):
+        for tag in list(self._xml_cache.keys()):
+            tag_path = self.lazy_path + '/' + tag
+            if (tag_path + '/').startswith(path + '/'):
+                del self._xml_cache[tag]
+            elif path.startswith(tag_path + '/'):
+                keys = path[len(tag_path)+1:].split('/')
+                cache = self._xml_cache[tag]
+                # Only a single element (by index) is touched
+                if keys[0].isdigit() and keys[-1] != '#pop' and int(keys[0]) < len(cache):
+                    cache[int(keys[0])] = None
+                else:
+                    del self._xml_cache[tag]
+
+    # Override to change elements as they are written,
+    # see the preprocessor of xmltodict.unparse()
+    def _preprocess(self, key, value):
+        return key, value
     
     # Override to update object parsing
     def _read(self):
-        return xmltodict.parse(super()._read())
+        if not self.lazy_tags:
+            return xmltodict.parse(super()._read())
+        with open(self._filepath, 'rb') as f:
+            header, elements = split_elements(f, self.lazy_path, self.lazy_tags)
+        tree = xmltodict.parse(header)
+        node = tree
+        for key in self.lazy_path.split('/'):
+            node = node.get(key) if isinstance(node, dict) else None
+        for tag, tag_elements in elements.items():
+            # Make sure all elements were where they were expected,
+            # otherwise just parse everything
+            placeholder = node.get(tag, '') if isinstance(node, dict) else ''
+            if placeholder != (None if len(tag_elements) == 1 else [None]*len(tag_elements)):
+                return xmltodict.parse(super()._read())
+            node[tag] = LazyElement(tag, *[list(v) for v in zip(*tag_elements)])
+        return tree
+
+    # Parse the lazily loaded elements the given path touches (or all)
+    def _load_lazy(self, path=None):
+        if self._lazy_node is None:
+            if not self.lazy_tags:
+                return
+            # Find the node (once) after the document was read
+            node = self._tree
+            for key in self.lazy_path.split('/'):
+                node = node.get(key) if isinstance(node, dict) else None
+            if not isinstance(node, dict) or \
+                    not any(isinstance(v, LazyElement) for v in node.values()):
+                self._lazy_node = False
+                return
+            self._lazy_node = node
+        if self._lazy_node is False:
+            return
+        loaded_all = True
+        for tag, value in self._lazy_node.items():
+            if not isinstance(value, LazyElement):
+                continue
+            lazy_path = self.lazy_path + '/' + tag
+            if path is None or (path + '/').startswith(lazy_path + '/') or \
+                    (lazy_path + '/').startswith(path + '/'):
+                self._lazy_node[tag] = value.load()
+            else:
+                loaded_all = False
+        if loaded_all:
+            self._lazy_node = False
     
     # XML Methods
+    # Documents have no metadata to index by default (and
+    # shouldn't be parsed in full to find out)
+    def get_metadata(self):
+        return {}
+
+    @timed('xml.get')
     def get(self, path):
-        return traverse(self._contents, path)
+        self._load_lazy(path)
+        self._touch(path)
+        return compile_path(path).get(self._tree)
 
+    @timed('xml.set')
     def set(self, path, value):
-        traverse(self._contents, path, value=value)
+        self._load_lazy(path)
+        self._touch(path)
+        compile_path(path).set(self._tree, value)
+        self.mark_dirty(self._journal_entry(path, value))
+
+    # Journal entry for setting the path, if it is idempotent
+    def _journal_entry(self, path, value):
+        if not self.journal or set(path.split('/')) & {'-1', '#pop'}:
+            return None
+        try:
+            return json_dumps({'set': path, 'value': value})
+        except (TypeError, ValueError):
+            return None
+
+    def _replay(self, entry):
+        if 'set' not in entry:
+            return super()._replay(entry)
+        self._load_lazy(entry['set'])
+        self._touch(entry['set'])
+        compile_path(entry['set']).set(self._tree, entry['value'])
 
 if __name__ == '__main__':
     # Run tests
@@ -59,6 +366,142 @@ if __name__ == '__main__':
     assert(obj.get('root/item/4') == 'Item 5')
     assert(obj.get('root/item/5/@attr') == 'c')
     
+    obj.delete()
+
+    # Lazily loaded elements are only parsed when they are used
+    class LazyContentManager(XMLContentManager):
+        lazy_path = 'root/test'
+        lazy_tags = ('section', 'other')
+    xml = xmltodict.parse('''
+    <root>
+      <test id="1">
+        <title>Lazy</title>
+        <section name="a"><point t="0"/><point t="1"/></section>
+        <other name="b"><section name="nested"/></other>
+        <section name="c"/>
+        <after>After</after>
+      </test>
+    </root>
+    ''')
+    obj = LazyContentManager(filename, new_contents=xml)
+    obj._write()
+    obj = LazyContentManager(filename)
+    assert(isinstance(obj._tree['root']['test']['section'], LazyElement))
+    assert(obj._tree['root']['test']['section'].attributes() == \
+            [{'@name': 'a'}, {'@name': 'c'}])
+    assert(obj.get('root/test/@id') == '1')
+    assert(obj.get('root/test/title') == 'Lazy')
+    assert(obj.get('root/test/after') == 'After')
+    assert(isinstance(obj._tree['root']['test']['section'], LazyElement))
+    assert(obj.get('root/test/section/0/point/1/@t') == '1')
+    assert(isinstance(obj._tree['root']['test']['other'], LazyElement))
+    assert(obj.get('root/test/other/section/@name') == 'nested')
+    obj = LazyContentManager(filename)
+    assert(obj._contents == xml)
+    assert(str(LazyContentManager(filename)) == str(XMLContentManager(filename)))
+
+    # Written the same as xmltodict.unparse(), whether elements were
+    # parsed or not, only formatting the elements that were touched
+    unparse = lambda o: xmltodict.unparse(o._tree, pretty=True, indent='  ')
+    obj = LazyContentManager(filename)
+    with open(filename, 'r') as f:
+        assert(str(obj) == f.read())
+    assert(not obj._xml_cache)
+    obj.get('root/test/section/1/@name')
+    obj.get('root/test/other/@name')
+    assert(str(obj) == unparse(obj))
+    first, second = obj._xml_cache['section']
+    obj.set('root/test/title', 'Still Lazy')
+    assert(str(obj) == unparse(obj))
+    assert(obj._xml_cache['section'][0] is first and obj._xml_cache['section'][1] is second)
+    obj.set('root/test/section/0/@name', 'A')
+    assert(obj._xml_cache['section'] == [None, second])
+    assert(str(obj) == unparse(obj))
+    assert('<section name="A">' in str(obj))
+    obj.set('root/test/section/-1', {'@name': 'd'})
+    assert(str(obj) == unparse(obj))
+    obj.get('root/test/section/1/#pop')
+    assert(str(obj) == unparse(obj))
+    obj._write()
+    with open(filename, 'r') as f:
+        assert(f.read() == unparse(obj))
+
+    # Small changes can be appended to a journal instead
+    from .basic_file_manager import journal_path, ConflictError
+    class JournalContentManager(LazyContentManager):
+        journal = True
+    obj = JournalContentManager(filename)
+    with open(filename, 'r') as f:
+        contents = f.read()
+    stat = JournalContentManager.stat(filename)
+    obj.set('root/test/title', 'Journaled')
+    obj.set('root/test/section/1/@name', 'C')
+    obj._write()
+    with open(filename, 'r') as f:
+        assert(f.read() == contents)
+    assert(file_exists(journal_path(filename)))
+    assert(JournalContentManager.stat(filename) != stat)
+    # Replayed when read
+    replayed = JournalContentManager(filename)
+    assert(replayed.get('root/test/title') == 'Journaled')
+    assert(replayed.get('root/test/section/1/@name') == 'C')
+    assert(str(replayed) == str(obj))
+    # Ignoring a partially written entry
+    with open(journal_path(filename), 'a') as f:
+        f.write('{"set": "root/test/title", "val')
+    assert(str(JournalContentManager(filename)) == str(obj))
+    # (Which changed the file under obj, so read it again)
+    obj = JournalContentManager(filename)
+    # Changes that can't be replayed write the whole file
+    obj.set('root/test/section/-1', {'@name': 'e'})
+    obj._write()
+    assert(not file_exists(journal_path(filename)))
+    with open(filename, 'r') as f:
+        assert(f.read() == str(obj))
+    # Compacting writes the whole file
+    obj.set('root/test/title', 'Compacted')
+    obj._write()
+    assert(JournalContentManager.compact(filename) is not None)
+    assert(not file_exists(journal_path(filename)))
+    assert(JournalContentManager.compact(filename) is None)
+    with open(filename, 'r') as f:
+        assert(f.read() == str(obj))
+    # ...which other objects of the file see as a conflict
+    # (unless told otherwise, as FileDatabase does)
+    obj.set('root/test/title', 'Deleted')
+    try:
+        obj._write()
+        assert(False)
+    except ConflictError:
+        pass
+    obj = JournalContentManager(filename)
+    obj.set('root/test/title', 'Deleted')
+    obj._write()
+
+    # Lazy elements are found by parsing the tags (read in chunks of
+    # any size), so e.g. '>' in attribute values and comments are fine
+    from io import BytesIO
+    source = b'<?xml version="1.0"?>\n<root><test a="x>y">\n<!-- <section> -->' + \
+            b'<section name="1>0"><p v="a>"/></section>\n  <section name=">"/>' + \
+            b'<other>Other</other></test><section name="not lazy"/></root>'
+    for chunk_size in [1, 7, 64*1024]:
+        header, elements = split_elements(BytesIO(source), 'root/test', \
+                ('section', 'other'), chunk_size)
+        assert(header == b'<?xml version="1.0"?>\n<root><test a="x>y">\n' + \
+                b'<!-- <section> --><section/>\n  <section/><other/></test>' + \
+                b'<section name="not lazy"/></root>')
+        assert(elements['section'] == [('<section name="1>0"><p v="a>"/></section>', \
+                {'name': '1>0'}), ('<section name=">"/>', {'name': '>'})])
+        assert(elements['other'] == [('<other>Other</other>', {})])
+    with open(filename, 'wb') as f:
+        f.write(source)
+    obj = LazyContentManager(filename)
+    assert(obj._tree['root']['test']['section'].attributes() == \
+            [{'@name': '1>0'}, {'@name': '>'}])
+    assert(obj.get('root/test/section/0/p/@v') == 'a>')
+    assert(obj._contents == xmltodict.parse(source))
+
     # Remove testing directory (must be empty)
     obj.delete()
+    assert(not file_exists(journal_path(filename)))
     print("XMLContentManager() Testing Passed!")
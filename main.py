@@ -29,43 +29,212 @@ http://paperjs.org/examples/path-simplification
 DO-178B/C tool verification
 """
 
-from flask import Flask, render_template, redirect, url_for, request
+from flask import Flask, render_template, stream_template, redirect, url_for, \
+        request, jsonify, g, Response, abort
 app = Flask(__name__)
 
 from file_database.database import FileDatabase
+from file_database.async_database import AsyncFileDatabase
+from file_database.basic_file_manager import ConflictError
+from file_database.metrics import metrics, timer, request_timings, server_timing, \
+        profile_request, profiled
 
 from testcase import TestCaseContentManager as TestCase
-from os import getcwd as pwd
+from sections import section_classes
+from timeseries.columns import pack_columns, MIMETYPE as COLUMNS_MIMETYPE
+from timeseries.pyramid import find_window
+from collections import OrderedDict
+from contextlib import ExitStack
+from os import getcwd as pwd, makedirs
+from pstats import Stats
+from random import random
+from time import perf_counter, strftime
+from uuid import uuid4
+
+# Instrumentation (see file_database.metrics), also set from NOISYFOX_
+# environment variables, e.g. NOISYFOX_PROFILING=true
+app.config.update(
+    # Record timings of the database, XML and timeseries code (see /metrics)
+    METRICS=True,
+    # Add a Server-Timing header with the timings of each request
+    SERVER_TIMING=False,
+    # Profile requests asking for it (with ?profile=1), and a sample of
+    # the rest, saving the profiles (see pstats) in PROFILE_DIR
+    PROFILING=False,
+    PROFILE_SAMPLE_RATE=0.0,
+    PROFILE_DIR='profiles'
+)
+app.config.from_prefixed_env('NOISYFOX')
+metrics.enabled = app.config['METRICS'] or app.config['SERVER_TIMING']
 # TODO: Allow user to choose database directories
-db = FileDatabase(pwd()+'/file_testdb', obj_class=TestCase, ext='xml')
+# Test cases are also edited with other tools (e.g. git), so watch the files
+db = FileDatabase(pwd()+'/file_testdb', obj_class=TestCase, ext='xml', index=True, watch=True)
+# Views await database work (run on a bounded pool of threads),
+# so many reviewers can be served at once
+adb = AsyncFileDatabase(db)
+
+@app.before_request
+def start_request():
+    g.start = perf_counter()
+    g.instrumentation = ExitStack()
+    if app.config['SERVER_TIMING']:
+        g.timings = g.instrumentation.enter_context(request_timings())
+    if app.config['PROFILING'] and (request.args.get('profile') or \
+            random() < app.config['PROFILE_SAMPLE_RATE']):
+        g.profiles = g.instrumentation.enter_context(profile_request())
+
+# Note: Streamed templates are rendered after this, so their
+# rendering isn't in the timings or profile of the request
+@app.after_request
+def finish_request(response):
+    elapsed = perf_counter() - g.start
+    g.pop('instrumentation').close()
+    if 'timings' in g:
+        response.headers['Server-Timing'] = server_timing(g.timings, elapsed)
+    if 'profiles' in g:
+        response.headers['X-Profile'] = save_profile(g.profiles)
+    if metrics.enabled:
+        metrics.record('request.' + str(request.endpoint), elapsed)
+    return response
+
+@app.teardown_request
+def teardown_request(error):
+    instrumentation = g.pop('instrumentation', None)
+    if instrumentation is not None:
+        instrumentation.close()
+
+# Save the profiles of a request, returning the filename (unique,
+# as requests to an endpoint can come in within the same second)
+def save_profile(profiles):
+    for profile in profiles:
+        profile.create_stats()
+    filename = '{}-{}-{}.prof'.format(strftime('%Y%m%d-%H%M%S'), request.endpoint, \
+            uuid4().hex)
+    makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+    Stats(*[p for p in profiles if p.stats]).dump_stats(app.config['PROFILE_DIR'] + \
+            '/' + filename)
+    return filename
+
+# Render (timed and profiled, with the request)
+def render(template, **context):
+    with timer('render'):
+        return profiled(render_template, template, **context)
+
+@app.route("/metrics")
+def metrics_text():
+    return Response(metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+# Search filters (see FileIndex.listing()) and page sizes
+search_filters = ['title', 'uid', 'signal']
+search_limit = 50
+search_max_limit = 500
+
+# Page of the index listing for the search arguments, and the
+# cursor for the next page (None if this is the last page)
+async def search_page():
+    filters = {k: request.args[k] for k in search_filters if request.args.get(k)}
+    fileglob = request.args.get('basename') or '**/*'
+    limit = min(max(request.args.get('limit', search_limit, type=int), 1), search_max_limit)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    # Get one more entry than asked for, to know if there are more
+    listing = await adb.get_listing(fileglob, limit=limit + 1, offset=offset, \
+            after=request.args.get('after'), **filters)
+    return listing[:limit], listing[limit-1].basename if len(listing) > limit else None
 
 @app.route("/")
 @app.route("/search")
-def search():
-    return render_template("search.html", obj_listing=db.get_objs()) 
+async def search():
+    listing, after = await search_page()
+    next_url = None
+    if after:
+        args = {k: v for k, v in request.args.items() if k not in ('after', 'offset')}
+        next_url = url_for("search", after=after, **args)
+    # Rows are sent as they are rendered
+    return stream_template("search.html", obj_listing=listing, \
+            search_args=request.args, next_url=next_url)
+
+@app.route("/search.json")
+async def search_json():
+    listing, after = await search_page()
+    return jsonify({'results': [e._asdict() for e in listing], 'after': after})
     
 @app.route("/add", methods=["GET", "POST"])
-def add():
+async def add():
     error = None
     if request.method == 'POST':
-        error = db.add_obj(request.form["basename"])
+        basename = request.form["basename"]
+        error = await adb.add_obj(basename)
         if not error:
-            return redirect(url_for("edit", basename=fname))
-    return render_template("add.html", error=error)
+            return redirect(url_for("edit", basename=basename))
+    return render("add.html", error=error)
 
 @app.route("/view/<path:basename>")
-def view(basename):
-    obj = [o for o in db.get_objs(basename)][0]
-    print(obj)
-    return render_template("view.html", obj=obj)
+async def view(basename):
+    obj = await adb.get_obj(basename)
+    # Parse the sections before rendering
+    if obj:
+        await adb.run(lambda: [obj.get_section_objs(s) for s in section_classes])
+    return render("view.html", obj=obj)
 
 @app.route("/edit/<path:basename>", methods=["GET", "POST"])
-def edit(basename):
+async def edit(basename):
     error = None
-    obj = [o for o in db.get_objs(basename)][0]
+    obj = await adb.get_obj(basename)
     if request.method == 'POST':
         if request.form["function"] == "Update Title":
-            error = db.apply(lambda o: o.set_title(request.form["Title"]), objs=[obj])
+            # Changes are written together when the batch ends
+            title = request.form["Title"]
+            try:
+                await adb.batch_apply(lambda o: o.set_title(title), objs=[obj])
+            except ConflictError:
+                error = "The testcase was changed by someone else, please try again"
+                obj = await adb.get_obj(basename)
         if not error:
             return redirect(url_for("view", basename=basename))
-    return render_template("edit.html", error=error, obj=obj)
+    return render("edit.html", error=error, obj=obj)
+
+# Most buckets a plot of a signal can ask for
+signal_max_width = 10000
+
+# Columns of a signal's samples from t0 to t1 (time and data), or given
+# a width (in pixels), of its plot buckets (see Pyramid.query()) there,
+# and the number of samples in each row. None if there is no signal
+def signal_columns(obj, section, name, t0, t1, width):
+    if obj.find_section_obj_idx(section, name) is None:
+        return None, None
+    if width:
+        buckets = obj.get_plot_buckets(section, name, t0, t1, width)
+        return OrderedDict((k, getattr(buckets, k)) for k in buckets._fields[1:]), \
+                1 << buckets.level
+    times, data = obj.get_timeseries(section, name)
+    i0, i1 = find_window(times, t0, t1)
+    return OrderedDict([('time', times[i0:i1]), ('data', data[i0:i1])]), 1
+
+# Samples of a signal (from t0 to t1, and decimated to width buckets
+# if given), as binary columns (see timeseries.columns). The ETag is
+# the testcase's uid and version, so unchanged signals aren't sent again
+@app.route("/signal/<path:basename>/<section>/<name>")
+async def signal(basename, section, name):
+    obj = await adb.get_obj(basename)
+    if not obj or section not in section_classes:
+        abort(404)
+    version = obj.get_version()
+    etag = '{}-{:x}-{:x}'.format(obj.get_uid(), int(version[0]*1e9), version[1]) \
+            if version else None
+    if etag and etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        t0 = request.args.get('t0', type=float)
+        t1 = request.args.get('t1', type=float)
+        width = request.args.get('width', type=int)
+        if width is not None:
+            width = min(max(width, 1), signal_max_width)
+        columns, samples = await adb.run(signal_columns, obj, section, name, t0, t1, width)
+        if columns is None:
+            abort(404)
+        response = Response(pack_columns(columns), mimetype=COLUMNS_MIMETYPE)
+        response.headers['X-Samples-Per-Row'] = str(samples)
+    if etag:
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+    return response
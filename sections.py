@@ -1,7 +1,13 @@
 from xmltodict import unparse as xml_unparse
+
+from array import array
+from collections import OrderedDict
+
 class SectionObject(object):
-    def __init__(self, name=None):
+    # Note: Other keyword arguments are for other sections
+    def __init__(self, name=None, **other):
         assert(name)
+        self.data = OrderedDict()
         self.set_name(name)
     
     def get_name(self):
@@ -11,70 +17,209 @@ class SectionObject(object):
         self.data['@name'] = name
 
     def __repr__(self):
-        return self.data
+        return repr(self.data)
 
     def __str__(self):
-        return xml_unparse(self.data, pretty=True, indent='  ')
+        return xml_unparse({self.__class__.__name__ : self.data}, \
+                pretty=True, indent='  ', preprocessor=preprocess)
 
 class TimeseriesPoint(object):
-    def __init__(time=None, data=None, time_fmt=None, data_fmt=None):
-        assert(time)
-        assert(data)
-        assert(time_fmt)
-        assert(data_fmt)
-        self.time = time
-        self.data = data
+    '''
+    A point of a Timeseries. Points are views into the timeseries,
+    created when they are used, so the values and the formats are
+    only stored once (in the timeseries).
+    Unpacks as (time, data), and pt['@time']/pt['@data'] are the
+    formatted values (as they are in XML).
+    '''
+    __slots__ = ('_series', '_index')
+
+    def __init__(self, series, index):
+        self._series = series
+        self._index = index
+
+    @property
+    def time(self):
+        return self._series._times[self._index]
+
+    @property
+    def data(self):
+        return self._series._data[self._index]
+
+    @property
+    def time_fmt(self):
+        return self._series.time_fmt
+
+    @property
+    def data_fmt(self):
+        return self._series.data_fmt
+
+    def __iter__(self):
+        yield self.time
+        yield self.data
+
+    def __getitem__(self, key):
+        return self.as_dict()[key] if isinstance(key, str) else tuple(self)[key]
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __str__(self):
+        return str((self.time, self.data))
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def as_dict(self):
+        return OrderedDict([ 
+            ('@time', format(self.time, self.time_fmt)), 
+            ('@data', format(self.data, self.data_fmt))
+        ])
+
+# Format that gives back the values of numbers formatted in strings,
+# e.g. '.05f' for ['0.10000', '0.2']: with as many decimals as any of
+# them, or if some aren't fixed-point (e.g. '1e-7', 'nan') or have too
+# many decimals for a double, the shortest format that gives them back
+def infer_fmt(values):
+    decimals = 0
+    for value in values:
+        value = value.lower()
+        if 'e' in value or 'n' in value:
+            return ''
+        if '.' in value:
+            decimals = max(decimals, len(value) - value.index('.') - 1)
+    return '.{:02d}f'.format(decimals) if decimals <= 15 else ''
+
+class Timeseries(object):
+    '''
+    Sequence of (time, data) points stored as two arrays of doubles
+    (16 bytes a point), with the formats used to write them stored
+    once. The arrays are available (without copying) as the times
+    and data memoryviews, e.g. for numpy.frombuffer().
+    Slicing gives a timeseries viewing the same arrays, and iterating
+    gives TimeseriesPoint views, so neither copies any points.
+    '''
+    __slots__ = ('_times', '_data', 'time_fmt', 'data_fmt')
+
+    def __init__(self, timeseries=(), time_fmt='.05f', data_fmt='.03f'):
+        times = array('d')
+        data = array('d')
+        for time, value in timeseries:
+            times.append(time)
+            data.append(value)
+        self._times = memoryview(times)
+        self._data = memoryview(data)
         self.time_fmt = time_fmt
         self.data_fmt = data_fmt
 
-    def __str__(self):
-        return (time, data)
+    # From separate sequences (or buffers) of times and data
+    @classmethod
+    def from_arrays(cls, times, data, time_fmt='.05f', data_fmt='.03f'):
+        if len(times) != len(data):
+            raise ValueError("Times and data must be the same length!")
+        series = cls(time_fmt=time_fmt, data_fmt=data_fmt)
+        series._times = memoryview(array('d', times))
+        series._data = memoryview(array('d', data))
+        return series
+
+    # From points as they are parsed from XML, with
+    # formats that give back all of their values
+    @classmethod
+    def from_dicts(cls, pts):
+        if isinstance(pts, dict):
+            pts = [pts]
+        times = [pt['@time'] for pt in pts]
+        data = [pt['@data'] for pt in pts]
+        fmts = (infer_fmt(times), infer_fmt(data)) if pts else ()
+        return cls.from_arrays([float(t) for t in times], [float(d) for d in data], *fmts)
+
+    @property
+    def times(self):
+        return self._times.toreadonly()
+
+    @property
+    def data(self):
+        return self._data.toreadonly()
+
+    def __len__(self):
+        return len(self._times)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            series = self.__class__(time_fmt=self.time_fmt, data_fmt=self.data_fmt)
+            series._times = self._times[index]
+            series._data = self._data[index]
+            return series
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Timeseries index out of range")
+        return TimeseriesPoint(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield TimeseriesPoint(self, index)
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
 
     def __repr__(self):
-        return { 
-            '@time' : format(self.time, self.time_fmt), 
-            '@data' : format(self.data, self.data_fmt)
-        }
+        return "{0}({1} points)".format(self.__class__.__name__, len(self))
+
+    # Points as they are written to XML
+    def as_dicts(self):
+        for pt in self:
+            yield pt.as_dict()
+
+# Preprocessor for xmltodict.unparse(), writing
+# timeseries as XML elements
+def preprocess(key, value):
+    if isinstance(value, Timeseries):
+        return key, value.as_dicts()
+    return key, value
 
 class TimeseriesObject(SectionObject):
     def __init__(self, timeseries=None, sample_time=0.00100, lsb=1.000, \
             time_fmt='.05f', data_fmt='.03f', **data):
         super().__init__(**data)
         assert(timeseries)
-        self.set_timeseries(timeseries)
-        self.set_sample_time(sample_time)
-        self.set_lsb(lsb)
         self.set_time_fmt(time_fmt)
         self.set_data_fmt(data_fmt)
+        self.set_sample_time(sample_time)
+        self.set_lsb(lsb)
+        self.set_timeseries(timeseries)
 
     def set_time_fmt(self, time_fmt):
         self.time_fmt = time_fmt
+        if 'timeseries' in self.data:
+            self.data['timeseries'].time_fmt = time_fmt
 
     def set_data_fmt(self, data_fmt):
         self.data_fmt = data_fmt
+        if 'timeseries' in self.data:
+            self.data['timeseries'].data_fmt = data_fmt
 
     def get_fmts(self):
-        return time_fmt, data_fmt
+        return self.time_fmt, self.data_fmt
 
     def get_sample_time(self):
         return self.data['@sample_time']
     
-    def set_sample_time(self):
+    def set_sample_time(self, sample_time):
         self.data['@sample_time'] = format(sample_time, self.time_fmt)
     
-    def get_lsb(self, new_lsb):
+    def get_lsb(self):
         return self.data['@lsb']
     
-    def set_lsb(self, lsb, data_fmt):
+    def set_lsb(self, lsb):
         self.data['@lsb'] = format(lsb, self.data_fmt)
 
     def get_timeseries(self):
-        return [pt for pt in self.data['timeseries']]
+        return self.data['timeseries']
 
     def set_timeseries(self, timeseries):
         # Note: Timeseries object is default object. 
         # Perhaps make this extensible for other types? e.g. per-customer
-        self.data['timeseries'] = [TimeseriesPoint(*pt, *self.get_fmts()) for pt in timeseries]
+        self.data['timeseries'] = Timeseries(timeseries, *self.get_fmts())
 
 class SetupObject(SectionObject):
     def __init__(self, value=None, **data):
@@ -102,13 +247,13 @@ class VerifyObject(TimeseriesObject):
         self.set_latency(latency)
         self.set_variance(variance)
 
-    def get_latency(self, latency):
+    def get_latency(self):
         return self.data['@latency']
 
     def set_latency(self, latency):
         self.data['@latency'] = format(latency, self.time_fmt)
 
-    def get_variance(self, variance):
+    def get_variance(self):
         return self.data['@variance']
 
     def set_variance(self, variance):
@@ -131,3 +276,43 @@ if __name__ == '__main__':
     for section in section_classes.keys():
         section_obj = section_classes[section](**data)
         print(section_obj)
+
+    # Timeseries are stored compactly, and points are views
+    N = 100000
+    series = Timeseries(((t/1000., t % 7) for t in range(N)), '.03f', '.01f')
+    assert(len(series) == N)
+    assert(series.times.nbytes + series.data.nbytes == 16*N)
+    assert(series[-1] == ((N-1)/1000., (N-1) % 7))
+    t, d = series[10]
+    assert((t, d) == (0.01, 3.0))
+    assert(series[10]['@time'] == '0.010' and series[10]['@data'] == '3.0')
+    # Slices share the arrays
+    part = series[10:20]
+    assert(len(part) == 10 and part[0] == series[10])
+    assert(part.times.obj is series.times.obj)
+    assert(list(series[::50000]) == [(0.0, 0.0), (50.0, 50000 % 7)])
+    try:
+        series[N]
+        assert(False)
+    except IndexError:
+        pass
+    # Written to and read from XML with the same formats
+    pts = list(part.as_dicts())
+    assert(pts[0] == OrderedDict([('@time', '0.010'), ('@data', '3.0')]))
+    assert(Timeseries.from_dicts(pts) == part)
+    assert(list(Timeseries.from_dicts(pts).as_dicts()) == pts)
+    assert(list(Timeseries.from_dicts(pts[0]).as_dicts()) == pts[:1])
+    # Whatever the formats of the points, their values are kept
+    pts = [OrderedDict([('@time', t), ('@data', d)]) for t, d in \
+            [('2', '1.5'), ('2.5', '2.25'), ('3.125', '1e-7'), ('4', '-0.0')]]
+    series = Timeseries.from_dicts(pts)
+    assert(series.time_fmt == '.03f' and series.data_fmt == '')
+    assert(list(Timeseries.from_dicts(list(series.as_dicts()))) == \
+            [(2, 1.5), (2.5, 2.25), (3.125, 1e-7), (4, 0)])
+    assert(infer_fmt(['0.1234567890123456789']) == '' and infer_fmt(['inf']) == '')
+    section_obj = VerifyObject(**data)
+    assert(section_obj.get_timeseries()[1]['@time'] == '1.00000')
+    section_obj.set_time_fmt('.01f')
+    assert(section_obj.get_timeseries()[1]['@time'] == '1.0')
+    assert('<timeseries time="1.0" data="1.000"></timeseries>' in str(section_obj))
+    print("Timeseries() Testing Passed!")
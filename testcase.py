@@ -1,11 +1,44 @@
-from file_database.xml_file_manager import XMLContentManager
+from file_database.xml_file_manager import XMLContentManager, LazyElement
+from sections import section_classes, Timeseries, preprocess
+from timeseries.pyramid import Pyramid, read_pyramid, write_pyramid, checksum
+from timeseries.sidecar import read_sidecar, write_sidecar
 
 from collections import OrderedDict
+from os import remove as file_remove
+from os.path import isfile as file_exists, split as path_split, join as path_join
+from re import sub as re_sub
 from uuid import uuid1 as random_hash
 
+import numpy as np
+
 class TestCaseContentManager(XMLContentManager):
+    # Sections (with all their timeseries) are parsed when first used
+    lazy_path = 'root/testcase'
+    lazy_tags = tuple(section_classes.keys())
+    # Set to store timeseries in binary sidecar files next to the
+    # testcase instead of as XML elements, with the options for
+    # write_sidecar(), e.g. {'dtype': 'float32', 'compression': 'zlib'}
+    sidecar_options = None
+    # Sidecars of at least this many samples are written with a level
+    # of detail pyramid (see timeseries.pyramid) next to them, for
+    # plotting them at any zoom
+    pyramid_threshold = 4096
+    # Small edits (e.g. the title) are appended to a journal
+    # instead of writing the whole testcase
+    journal = True
 
     def __init__(self, filename, new_contents=None):
+        # Sidecar timeseries not written yet (by filename),
+        # and sidecar files to remove on the next write
+        self._sidecars = {}
+        self._stale_sidecars = set()
+        # Timeseries parsed from XML points (by id of the points, with
+        # the points), which stay in the tree as they were read so
+        # they are written back exactly
+        self._parsed_timeseries = {}
+        # Pyramids of signals (by id of the signal, with the signal),
+        # kept until the signal changes
+        self._pyramids = {}
         # Basic template for testcase
         # Note: Use OrderedDict here so we retain the right order in XML
         test_template = {
@@ -36,13 +69,43 @@ class TestCaseContentManager(XMLContentManager):
     def set_description(self, new_description):
         self.set('root/testcase/description', new_description)
 
+    # Metadata for the database index
+    def get_metadata(self):
+        testcase = self._tree['root']['testcase']
+        signals = []
+        values = []
+        for section in section_classes.keys():
+            objs = testcase.get(section) or []
+            # Only the names are needed, so don't parse lazy sections
+            if isinstance(objs, LazyElement):
+                objs = objs.attributes()
+            # A single element is parsed as a dict instead of a list
+            for obj in objs if isinstance(objs, list) else [objs]:
+                if isinstance(obj, dict) and obj.get('@name'):
+                    signals.append(obj['@name'])
+                    if obj.get('@value') is not None:
+                        values.append(obj['@value'])
+        return {
+            'uid' : testcase.get('@uid'),
+            'title' : testcase.get('title'),
+            'description' : testcase.get('description'),
+            'signals' : signals,
+            # Indexed as terms (e.g. setup values)
+            'text' : values
+        }
+
     # Testcase sectional data GET/SET
     def verify_section(self, section):
         assert(section) # in list of qualified sections
 
     def get_section_objs(self, section):
         self.verify_section(section)
-        return self.get('root/testcase/' + section)
+        objs = self.get('root/testcase/' + section)
+        # A single element is parsed as a dict instead of a list
+        if not isinstance(objs, list):
+            objs = [objs] if objs else []
+            self._tree['root']['testcase'][section] = objs
+        return objs
 
     def find_section_obj_idx(self, section, name):
         self.verify_section(section)
@@ -50,21 +113,191 @@ class TestCaseContentManager(XMLContentManager):
             if obj['@name'] == name:
                 return i
 
+    def create_signal_obj(self, section, **data):
+        self.verify_section(section)
+        sig = section_classes[section](**data).data
+        if self.sidecar_options is not None and 'timeseries' in sig:
+            timeseries = sig.pop('timeseries')
+            self._store_sidecar(section, sig, timeseries.times, timeseries.data)
+        return sig
+
     def add_section_obj(self, section, **data):
         self.verify_section(section)
         sig = self.create_signal_obj(section, **data)
+        self.get_section_objs(section)
         self.set('root/testcase/' + section + '/-1', sig)
 
     def del_section_obj(self, section, name):
         self.verify_section(section)
-        idx = str(self.find_section_obj_idx(section, name))
-        self.get('root/testcase/' + section + '/' + idx + '/#pop')
+        idx = self.find_section_obj_idx(section, name)
+        self._drop_signal(self.get_section_objs(section).pop(idx))
+        self.mark_dirty()
 
-    def update_section_obj(self, section, name, **data):
+    def update_section_obj(self, section, obj_name, **data):
         self.verify_section(section)
+        idx = self.find_section_obj_idx(section, obj_name)
+        self._drop_signal(self.get_section_objs(section)[idx])
         sig = self.create_signal_obj(section, **data)
-        idx = str(self.find_section_obj_idx(section, name))
-        self.set('root/testcase/' + section + '/' + idx, sig)
+        self.set('root/testcase/' + section + '/' + str(idx), sig)
+
+    # Timeseries of a signal as (times, data) arrays,
+    # wherever it is stored
+    def load_timeseries(self, sig):
+        if '@sidecar' in sig:
+            filename = sig['@sidecar']
+            if filename in self._sidecars:
+                return self._sidecars[filename]
+            return read_sidecar(self._sidecar_path(filename))
+        timeseries = sig.get('timeseries') or []
+        if not isinstance(timeseries, Timeseries):
+            timeseries = self._parse_timeseries(timeseries)
+        return np.frombuffer(timeseries.times), np.frombuffer(timeseries.data)
+
+    def _parse_timeseries(self, pts):
+        parsed = self._parsed_timeseries.get(id(pts))
+        if parsed is None or parsed[0] is not pts:
+            parsed = self._parsed_timeseries[id(pts)] = (pts, Timeseries.from_dicts(pts))
+        return parsed[1]
+
+    def _drop_signal(self, sig):
+        if isinstance(sig, dict):
+            self._parsed_timeseries.pop(id(sig.get('timeseries')), None)
+        self._pyramids.pop(id(sig), None)
+        self._drop_sidecar(sig)
+
+    def get_timeseries(self, section, name):
+        idx = self.find_section_obj_idx(section, name)
+        return self.load_timeseries(self.get_section_objs(section)[idx])
+
+    # Pyramid of a signal, read from next to its sidecar if it was
+    # written with one (for the same data), or built from its timeseries
+    def get_pyramid(self, section, name):
+        idx = self.find_section_obj_idx(section, name)
+        sig = self.get_section_objs(section)[idx]
+        return self._get_pyramid(sig, self.load_timeseries(sig)[1])
+
+    def _get_pyramid(self, sig, data):
+        cached = self._pyramids.get(id(sig))
+        if cached is not None and cached[0] is sig and cached[1].count == len(data):
+            return cached[1]
+        pyramid = None
+        filename = sig.get('@sidecar')
+        if filename and filename not in self._sidecars:
+            filepath = self._pyramid_path(self._sidecar_path(filename))
+            if file_exists(filepath):
+                pyramid = read_pyramid(filepath)
+                if pyramid.count != len(data) or pyramid.checksum != checksum(data):
+                    pyramid = None
+        if pyramid is None:
+            pyramid = Pyramid.build(data)
+        self._pyramids[id(sig)] = (sig, pyramid)
+        return pyramid
+
+    # Buckets (see Pyramid.query()) of a signal from t0 to t1,
+    # for plotting it width pixels wide
+    def get_plot_buckets(self, section, name, t0=None, t1=None, width=1000):
+        idx = self.find_section_obj_idx(section, name)
+        sig = self.get_section_objs(section)[idx]
+        times, data = self.load_timeseries(sig)
+        return self._get_pyramid(sig, data).query(times, data, t0, t1, width)
+
+    # Timeseries are written as XML elements
+    def _preprocess(self, key, value):
+        return preprocess(key, value)
+
+    # Sidecar Methods
+    def _sidecar_path(self, filename, filepath=None):
+        return path_join(path_split(filepath or self._filepath)[0], filename)
+
+    # Filename for a signal's sidecar, which doesn't change when the
+    # testcase is renamed (sidecars are in the same folder)
+    def _sidecar_filename(self, section, name):
+        name = re_sub(r'[^\w.-]', '_', str(name))
+        return '{0}.{1}.{2}.ts'.format(self.get_uid(), section, name)
+
+    def _pyramid_path(self, sidecar_path):
+        return sidecar_path[:-len('.ts')] + '.lod'
+
+    def _store_sidecar(self, section, sig, times, values):
+        filename = self._sidecar_filename(section, sig['@name'])
+        sig['@sidecar'] = filename
+        self._sidecars[filename] = (np.array(times, dtype=float), \
+                np.array(values, dtype=float))
+        self._stale_sidecars.discard(self._sidecar_path(filename))
+
+    def _drop_sidecar(self, sig):
+        filename = sig.get('@sidecar') if isinstance(sig, dict) else None
+        if filename:
+            self._sidecars.pop(filename, None)
+            self._stale_sidecars.add(self._sidecar_path(filename))
+
+    # Filenames of all the sidecars the testcase uses
+    def get_sidecars(self):
+        testcase = self._tree['root']['testcase']
+        filenames = []
+        for section in section_classes.keys():
+            objs = testcase.get(section) or []
+            # Only the attributes are needed, so don't parse lazy sections
+            if isinstance(objs, LazyElement):
+                objs = objs.attributes()
+            for obj in objs if isinstance(objs, list) else [objs]:
+                if isinstance(obj, dict) and obj.get('@sidecar'):
+                    filenames.append(obj['@sidecar'])
+        return filenames
+
+    # Write sidecars before the testcase, so it never
+    # references a sidecar that doesn't exist
+    def _write(self):
+        if self._filepath:
+            self._check_conflict()
+            options = self.sidecar_options or {}
+            dtype = options.get('dtype', 'float64')
+            for filename, (times, values) in self._sidecars.items():
+                filepath = self._sidecar_path(filename)
+                write_sidecar(filepath, times, values, **options)
+                if len(values) >= self.pyramid_threshold:
+                    # Built from the values as stored (and read back)
+                    values = np.asarray(values, dtype=dtype)
+                    write_pyramid(self._pyramid_path(filepath), Pyramid.build(values), \
+                            dtype, checksum(values))
+                elif file_exists(self._pyramid_path(filepath)):
+                    file_remove(self._pyramid_path(filepath))
+            # Pyramids of the values before they were stored
+            self._pyramids = {k: v for k, v in self._pyramids.items() \
+                    if v[0].get('@sidecar') not in self._sidecars}
+            self._sidecars = {}
+            super()._write()
+            self._remove_stale_sidecars()
+
+    def _remove_stale_sidecars(self):
+        for filepath in self._stale_sidecars:
+            for filepath in [filepath, self._pyramid_path(filepath)]:
+                if file_exists(filepath):
+                    file_remove(filepath)
+        self._stale_sidecars = set()
+
+    # Note: Sidecars not written yet are kept, as move()
+    # deletes the testcase before writing it again
+    def delete(self):
+        for filepath in [self._filepath, self._stale_filepath]:
+            if filepath:
+                self._stale_sidecars.update(self._sidecar_path(filename, filepath) \
+                        for filename in self.get_sidecars())
+        self._remove_stale_sidecars()
+        super().delete()
+
+    # Sidecars are moved along with the testcase, and
+    # written with it to the new folder
+    def move(self, new_filepath):
+        moved = path_split(new_filepath)[0] != path_split(self._filepath)[0]
+        if moved or not self._writes_behind():
+            for filename in self.get_sidecars():
+                if filename not in self._sidecars:
+                    times, values = read_sidecar(self._sidecar_path(filename))
+                    self._sidecars[filename] = (times.copy(), values.copy())
+                if moved:
+                    self._stale_sidecars.add(self._sidecar_path(filename))
+        super().move(new_filepath)
 
 if __name__ == '__main__':
     # Test this class
@@ -90,7 +323,7 @@ if __name__ == '__main__':
     }
     
     for section in ['setup', 'action', 'result', 'verify']:
-        test.add_section_obj(section, data1)
+        test.add_section_obj(section, **data1)
         idx = test.find_section_obj_idx(section, signame1)
         assert(idx == 0)
         assert(test.get_section_objs(section)[idx]['@name'] == signame1)
@@ -102,7 +335,7 @@ if __name__ == '__main__':
                 for i, pt in enumerate(data1[key]):
                     assert(float(obj[key][i]['@time']) == pt[0])
                     assert(float(obj[key][i]['@data']) == pt[1])
-        test.update_section_obj(section, signame1, data2)
+        test.update_section_obj(section, signame1, **data2)
         obj = test.get_section_objs(section)[idx]
         for key in obj.keys():
             if key[0] == '@' and key != '@name':
@@ -111,23 +344,137 @@ if __name__ == '__main__':
                 for i, pt in enumerate(data2[key]):
                     assert(float(obj[key][i]['@time']) == pt[0])
                     assert(float(obj[key][i]['@data']) == pt[1])
-        test.add_section_obj(section, data2)
-        test.update_section_obj(section, signame2, data1)
+        test.update_section_obj(section, signame2, **data1)
+        test.add_section_obj(section, **data2)
         idx = test.find_section_obj_idx(section, signame2)
         assert(idx == 1)
         assert(test.get_section_objs(section)[idx]['@name'] == signame2)
         obj = test.get_section_objs(section)[idx]
         for key in obj.keys():
             if key[0] == '@' and key != '@name':
-                assert(float(obj[key]) == data1[key.strip('@')])
+                assert(float(obj[key]) == data2[key.strip('@')])
             if key == 'timeseries':
-                for i, pt in enumerate(data1[key]):
+                for i, pt in enumerate(data2[key]):
                     assert(float(obj[key][i]['@time']) == pt[0])
                     assert(float(obj[key][i]['@data']) == pt[1])
         test.del_section_obj(section, signame2)
         test.del_section_obj(section, signame1)
         assert(len(test.get_section_objs(section)) == 0)
     
-    # Completed testing
     test.delete()
+
+    # Parsed timeseries are cached, and written back the same
+    test = TestCaseContentManager('test.xml')
+    test.add_section_obj('verify', **data1)
+    test._write()
+    with open('test.xml', 'r') as f:
+        contents = f.read()
+    test = TestCaseContentManager('test.xml')
+    assert(list(test.get_timeseries('verify', signame1)[1]) == [0, 1, 2, 3])
+    assert(list(test.get_timeseries('verify', signame1)[0]) == [0, 1, 2, 3])
+    assert(len(test._parsed_timeseries) == 1)
+    assert(str(test) == contents)
+    # Points are written back as they were read, whatever their format
+    with open('test.xml', 'w') as f:
+        f.write(contents.replace('data="2.000"', 'data="2.25"').replace( \
+                'time="3.00000"', 'time="2.5"').replace('data="3.000"', 'data="1e-7"'))
+    with open('test.xml', 'r') as f:
+        edited = f.read()
+    test = TestCaseContentManager('test.xml')
+    assert(list(test.get_timeseries('verify', signame1)[0]) == [0, 1, 2, 2.5])
+    assert(list(test.get_timeseries('verify', signame1)[1]) == [0, 1, 2.25, 1e-7])
+    test.find_section_obj_idx('verify', signame1)
+    test._write()
+    with open('test.xml', 'r') as f:
+        assert(f.read() == edited)
+    test = TestCaseContentManager('test.xml')
+    test.add_section_obj('setup', **data2)
+    metadata = test.get_metadata()
+    assert(metadata['signals'] == [signame2, signame1])
+    assert(metadata['text'] == [2.0])
+    test = TestCaseContentManager('test.xml')
+    test.set_title('Journaled')
+    test._write()
+    with open('test.xml', 'r') as f:
+        assert(f.read() == edited)
+    assert(TestCaseContentManager('test.xml').get_title() == 'Journaled')
+    test.delete()
+    
+    # Timeseries can be stored in binary sidecars instead
+    from os import mkdir, rmdir, listdir
+    class SidecarTestCase(TestCaseContentManager):
+        sidecar_options = {'delta': True, 'compression': 'zlib'}
+    N = 100000
+    times = np.round(np.arange(N)*0.001, 6)
+    values = np.round(np.sin(times), 3)
+    data1['timeseries'] = list(zip(times, values))
+    test = SidecarTestCase('test.xml')
+    for section in ['setup', 'action', 'result', 'verify']:
+        test.add_section_obj(section, **data1)
+    test.add_section_obj('verify', **data2)
+    assert(len(test.get_sidecars()) == 4)
+    t, v = test.get_timeseries('verify', signame1)
+    assert(np.array_equal(t, times) and np.array_equal(v, values))
+    test._write()
+    sidecars = [f for f in listdir('.') if f.endswith('.ts')]
+    assert(sorted(sidecars) == sorted(test.get_sidecars()))
+    with open('test.xml', 'r') as f:
+        assert('<timeseries' not in f.read())
+    # Sidecars are read back (only parsing the sections used)
+    test = SidecarTestCase('test.xml')
+    assert(sorted(test.get_sidecars()) == sorted(sidecars))
+    assert(isinstance(test._tree['root']['testcase']['verify'], LazyElement))
+    t, v = test.get_timeseries('verify', signame1)
+    assert(np.array_equal(t, times) and np.array_equal(v, values))
+    t, v = test.get_timeseries('verify', signame2)
+    assert(t.tolist() == [0, 1, 2, 3] and v.tolist() == [1, 2, 3, 4])
+    del t, v
+    # Long signals have pyramids written with them, short ones don't
+    pyramids = sorted(f for f in listdir('.') if f.endswith('.lod'))
+    assert(pyramids == sorted(f[:-3] + '.lod' for f in sidecars if signame1 in f))
+    buckets = test.get_plot_buckets('verify', signame1, 10.0, 20.0, width=100)
+    assert(len(buckets.first) <= 101 and buckets.max.max() == values[10000:20001].max())
+    buckets = test.get_plot_buckets('verify', signame2, width=2)
+    assert(buckets.min.tolist() == [1, 3] and buckets.max.tolist() == [2, 4])
+    del buckets
+    # Pyramids are kept until their signal changes
+    pyramid = test.get_pyramid('verify', signame1)
+    assert(pyramid.checksum is not None) # Read
+    assert(test.get_pyramid('verify', signame1) is pyramid)
+    pyramid = test.get_pyramid('verify', signame2)
+    test.update_section_obj('verify', signame2, **data2)
+    assert(test.get_pyramid('verify', signame2) is not pyramid)
+    # ...and only read for the data they were written for (e.g. not
+    # if rewriting a sidecar was interrupted before its pyramid)
+    filepath = test._sidecar_path(test._sidecar_filename('verify', signame1))
+    write_sidecar(filepath, times, -values, **SidecarTestCase.sidecar_options)
+    test = SidecarTestCase('test.xml')
+    pyramid = test.get_pyramid('verify', signame1)
+    assert(pyramid.checksum is None and pyramid.levels[-1][1][0] == -values.min())
+    write_sidecar(filepath, times, values, **SidecarTestCase.sidecar_options)
+    del pyramid
+    # Removed with their signal
+    test.del_section_obj('action', signame1)
+    test._write()
+    assert(len([f for f in listdir('.') if f.endswith('.ts')]) == 3)
+    assert(len([f for f in listdir('.') if f.endswith('.lod')]) == 2)
+    # Moved (in both modes) and deleted with the testcase
+    mkdir('sidecar-test')
+    test.move('sidecar-test/test.xml')
+    assert(len(listdir('sidecar-test')) == 6)
+    assert(set(test.get_sidecars() + ['test.xml']) < set(listdir('sidecar-test')))
+    assert(not [f for f in listdir('.') if f.endswith(('.ts', '.lod'))])
+    test.write_behind = True
+    test.move('test.xml')
+    assert(len(listdir('sidecar-test')) == 6)
+    test._write()
+    assert(not listdir('sidecar-test'))
+    t, v = SidecarTestCase('test.xml').get_timeseries('verify', signame1)
+    assert(np.array_equal(t, times) and np.array_equal(v, values))
+    del t, v
+    test.delete()
+    assert(not [f for f in listdir('.') if f.endswith(('.ts', '.lod')) or f == 'test.xml'])
+    rmdir('sidecar-test')
+
+    # Completed testing
     print("TestCaseContentManager() Testing Passed!")
@@ -0,0 +1,84 @@
+from .sidecar import DTYPES
+
+from collections import OrderedDict
+from struct import Struct
+
+import numpy as np
+
+# Compact binary transport for named columns of the same length (e.g.
+# the times and data of a timeseries), for sending them to clients.
+# The columns are stored one after the other as little-endian arrays,
+# after a header and their names (newline separated UTF-8, padded so
+# every column is aligned), so a client can view each one as a typed
+# array (e.g. a Float64Array) without copying or parsing anything.
+
+# magic, version, dtype, number of columns, number of rows, names length
+HEADER = Struct('<4sBBHQI')
+MAGIC = b'NFCB'
+VERSION = 1
+ALIGNMENT = 8
+
+MIMETYPE = 'application/vnd.noisyfox.columns'
+
+def pack_columns(columns, dtype='float64'):
+    if dtype not in DTYPES:
+        raise ValueError("Column dtype must be one of {}!".format(DTYPES))
+    names = '\n'.join(columns.keys()).encode('utf-8')
+    arrays = [np.asarray(c, dtype=np.dtype(dtype).newbyteorder('<')) \
+            for c in columns.values()]
+    rows = len(arrays[0]) if arrays else 0
+    if any(len(a) != rows for a in arrays):
+        raise ValueError("Columns must be the same length!")
+    padding = -(HEADER.size + len(names)) % ALIGNMENT
+    return b''.join([HEADER.pack(MAGIC, VERSION, DTYPES.index(dtype), len(arrays), \
+            rows, len(names)), names, b'\0'*padding] + [a.tobytes() for a in arrays])
+
+# Returns the columns as an OrderedDict of read-only arrays viewing buf
+def unpack_columns(buf):
+    magic, version, dtype, count, rows, names_length = HEADER.unpack_from(buf)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not packed columns!")
+    dtype = np.dtype(DTYPES[dtype]).newbyteorder('<')
+    offset = HEADER.size + names_length
+    names = bytes(buf[HEADER.size:offset]).decode('utf-8').split('\n') if count else []
+    offset += -offset % ALIGNMENT
+    columns = OrderedDict()
+    for name in names:
+        columns[name] = np.frombuffer(buf, dtype=dtype, count=rows, offset=offset)
+        offset += rows*dtype.itemsize
+    return columns
+
+if __name__ == '__main__':
+    times = np.round(np.arange(1001)*0.001, 6)
+    data = np.sin(times)
+    for dtype in DTYPES:
+        for columns in [OrderedDict([('time', times), ('data', data)]), \
+                OrderedDict([('t', times[:3]), ('min', data[:3]), ('max', [1, 2, 3])]), \
+                OrderedDict([('time', []), ('data', [])]), OrderedDict()]:
+            buf = pack_columns(columns, dtype)
+            unpacked = unpack_columns(buf)
+            assert(list(unpacked) == list(columns))
+            for name, column in columns.items():
+                assert(unpacked[name].dtype == dtype)
+                assert(np.array_equal(unpacked[name], np.asarray(column, dtype=dtype)))
+    # Only the header, names and columns, aligned
+    buf = pack_columns(OrderedDict([('time', times), ('data', data)]))
+    columns_offset = len(buf) - 2*8*1001
+    assert(columns_offset % ALIGNMENT == 0)
+    assert(buf[HEADER.size:columns_offset] == \
+            b'time\ndata'.ljust(columns_offset - HEADER.size, b'\0'))
+    assert(np.frombuffer(buf[-8:], '<f8')[0] == data[-1])
+
+    for columns, dtype in [(OrderedDict([('a', [1]), ('b', [])]), 'float64'), \
+            (OrderedDict([('a', [1])]), 'int8')]:
+        try:
+            pack_columns(columns, dtype)
+            assert(False)
+        except ValueError:
+            pass
+    try:
+        unpack_columns(b'\0'*HEADER.size)
+        assert(False)
+    except ValueError:
+        pass
+    print("pack_columns()/unpack_columns() Testing Passed!")
@@ -1,67 +1,139 @@
 from .shared import *
-def compress(timeseries):
-    # Trivial checks
-    check_list(timeseries)
-    if not len(timeseries) > 1:
-        return timeseries, 0
+from file_database.metrics import timed
 
-    # Start with the first point in the series
-    last_pt = timeseries[0]
-    check_tuple(last_pt)
-    compressed_timeseries = [last_pt]
-    
-    # For each point in the series
-    update_rate = None
-    last_added_pt = last_pt
-    last_slope = None
-    for this_pt in timeseries[1:]:
-        check_tuple(this_pt)
+class Compressor(object):
+    '''
+    Incremental version of compress(), for timeseries that are too
+    long to hold in memory (e.g. read from a file or a socket).
+    Points are given to feed() in chunks of any iterable, which returns
+    the compressed points that are final so far. finish() returns the
+    rest, along with the update rate for decompression. Only the last
+    few points are kept, no matter how long the timeseries is.
+
+    The compressed points are the same as compress() would return
+    for the whole timeseries (including the lossy mode, if given
+    a tolerance).
+    '''
+    def __init__(self, tolerance=0):
+        self.tolerance = tolerance
+        self.update_rate = None
+        self._last_pt = None
+        self._last_added_pt = None
+        self._last_slope = None
+        # Lossy mode: slopes from the last added point that stay
+        # within tolerance of every point since then
+        self._min_slope = float('-inf')
+        self._max_slope = float('inf')
+
+    def feed(self, timeseries):
+        compressed_timeseries = []
+        for this_pt in timeseries:
+            check_tuple(this_pt)
+            if self._last_pt is None:
+                # Start with the first point in the series
+                compressed_timeseries.append(this_pt)
+                self._last_added_pt = this_pt
+            elif self.tolerance:
+                self._add_within_tolerance(this_pt, compressed_timeseries)
+            else:
+                self._add(this_pt, compressed_timeseries)
+            self._last_pt = this_pt
+        return compressed_timeseries
+
+    def finish(self):
+        compressed_timeseries = []
+        # Add the last point if missing, so we have the point to stop decompression
+        if self._last_added_pt != self._last_pt:
+            compressed_timeseries.append(self._last_pt)
+            self._last_added_pt = self._last_pt
+        # Return the rest of the dataset, as well as the update rate for decompression
+        return compressed_timeseries, self.update_rate or 0
+
+    def _check_update_rate(self, this_time, last_time):
+        if not self.update_rate:
+            self.update_rate = get_update_rate(this_time, last_time)
+        check_update_rate(this_time, last_time, self.update_rate)
+
+    def _add(self, this_pt, compressed_timeseries):
+        last_pt = self._last_pt
+        last_slope = self._last_slope
         last_time, last_data = last_pt
         this_time, this_data = this_pt
         
-        if not update_rate:
-            update_rate = get_update_rate(this_time, last_time)
-        check_update_rate(this_time, last_time, update_rate)
+        self._check_update_rate(this_time, last_time)
         
         this_slope = calc_slope(last_time, last_data, this_time, this_data)
         
         # If the last point was not added and we're not seeing a 
         # trend continuation, add that point to the series
-        if last_pt != last_added_pt and this_slope != last_slope:
+        if last_pt != self._last_added_pt and this_slope != last_slope:
             compressed_timeseries.append(last_pt)
-            last_added_pt = last_pt
+            self._last_added_pt = last_pt
 
         # Add this point if the slope is different
         # (or the first iteration has a data change)
         if (this_data != last_data and last_slope is None) or \
                 (this_slope != last_slope and last_slope is not None):
             compressed_timeseries.append(this_pt)
-            last_added_pt = this_pt
+            self._last_added_pt = this_pt
 
         # Update past values
-        last_slope = this_slope
-        last_pt = this_pt
+        self._last_slope = this_slope
 
-    # Add the last point if missing, so we have the point to stop decompression
-    if compressed_timeseries[-1] != last_pt:
-        compressed_timeseries.append(last_pt)
+    # Lossy compression: drop every point that uncompress() can
+    # reproduce to within tolerance of its original value.
+    # Works like a "swing door": the slopes from the last kept point
+    # that stay within tolerance of every point since then narrow down
+    # as points come in, and once the next point falls outside of them
+    # the point before it is kept. Runs in O(n).
+    def _add_within_tolerance(self, this_pt, compressed_timeseries):
+        last_time, _ = self._last_pt
+        this_time, this_data = this_pt
 
-    # Return the compressed dataset, as well as the update rate for decompression
-    return compressed_timeseries, update_rate
+        self._check_update_rate(this_time, last_time)
 
-def uncompress(timeseries, update_rate):
+        # If a line to this point would miss any point since the
+        # last kept one, keep the last point and start from there
+        anchor_time, anchor_data = self._last_added_pt
+        slope = calc_slope(anchor_time, anchor_data, this_time, this_data)
+        if not self._min_slope <= slope <= self._max_slope:
+            compressed_timeseries.append(self._last_pt)
+            self._last_added_pt = self._last_pt
+            anchor_time, anchor_data = self._last_added_pt
+            self._min_slope = float('-inf')
+            self._max_slope = float('inf')
+
+        # Narrow the slopes down so later lines stay within
+        # tolerance of this point
+        self._min_slope = max(self._min_slope, calc_slope(anchor_time, anchor_data, \
+                this_time, this_data - self.tolerance))
+        self._max_slope = min(self._max_slope, calc_slope(anchor_time, anchor_data, \
+                this_time, this_data + self.tolerance))
 
+@timed('timeseries.compress')
+def compress(timeseries, tolerance=0):
+    # Trivial checks
     check_list(timeseries)
-    
     if not len(timeseries) > 1:
-        return timeseries
-    
-    last_pt = timeseries[0]
-    check_tuple(last_pt)
-    uncompressed_timeseries = [last_pt]
-    
-    for this_pt in timeseries[1:]:
+        return timeseries, 0
+
+    compressor = Compressor(tolerance)
+    compressed_timeseries = compressor.feed(timeseries)
+    last_pts, update_rate = compressor.finish()
+
+    # Return the compressed dataset, as well as the update rate for decompression
+    return compressed_timeseries + last_pts, update_rate
+
+# Generator version of uncompress(), which works on any
+# iterable of compressed points and yields samples lazily
+def iter_uncompress(timeseries, update_rate):
+    last_pt = None
+    for this_pt in timeseries:
         check_tuple(this_pt)
+        if last_pt is None:
+            yield this_pt
+            last_pt = this_pt
+            continue
         
         last_time, last_data = last_pt
         this_time, this_data = this_pt
@@ -74,15 +146,22 @@ def uncompress(timeseries, update_rate):
         last_time = add_and_round(last_time, update_rate)
         while this_time > last_time:
             last_data = last_data + slope*update_rate
-            last_pt = (last_time, last_data)
-            uncompressed_timeseries.append(last_pt)
+            yield (last_time, last_data)
             last_time = add_and_round(last_time, update_rate)
         # After we've filled up the array with last data samples,
         # add the newest sample in there and do it again
-        uncompressed_timeseries.append(this_pt)
+        yield this_pt
         last_pt = this_pt
 
-    return uncompressed_timeseries
+@timed('timeseries.uncompress')
+def uncompress(timeseries, update_rate):
+
+    check_list(timeseries)
+    
+    if not len(timeseries) > 1:
+        return timeseries
+    
+    return list(iter_uncompress(timeseries, update_rate))
 
 if __name__ == '__main__':
     def assert_equal(l1, l2):
@@ -212,4 +291,47 @@ if __name__ == '__main__':
         avg_comp = comp if not avg_comp else (comp + i*avg_comp)/(i+1)
     print('  Average compression: {:3.2f}%'.format(avg_comp))
     
+    # Lossy compression stays within the tolerance
+    print("Running randomized trials (lossy, normal dist [-10.0, 10.0] + ramp)")
+    def assert_within(l1, l2, tolerance):
+        assert(len(l1) == len(l2))
+        for (t1, d1), (t2, d2) in zip(l1, l2):
+            assert(round(t1, SIGFIGS) == round(t2, SIGFIGS))
+            assert(abs(d1 - d2) <= tolerance + EPSILON)
+    for tolerance in [0.5, 2.0, 10.0]:
+        avg_comp = None
+        for i in range(10): # run this many trials
+            timeseries = [(t/N, 10.0*t/N + rand_float(-10.0,10.0)) for t in range(N)]
+            compressed_timeseries, update_rate = compress(timeseries, tolerance)
+            assert_within(uncompress(compressed_timeseries, update_rate), timeseries, tolerance)
+            comp = assert_positive_compression(compressed_timeseries, timeseries)
+            avg_comp = comp if not avg_comp else (comp + i*avg_comp)/(i+1)
+        print('  Average compression (tolerance {}): {:3.2f}%'.format(tolerance, avg_comp))
+    timeseries = [(0.0, 0.0), (1.0, 0.1), (2.0, -0.1), (3.0, 0.0), (4.0, 5.0)]
+    assert(compress(timeseries, 0.5) == ([(0.0, 0.0), (3.0, 0.0), (4.0, 5.0)], 1.0))
+    assert(compress(timeseries, get_tolerance(lsb=1.0)) == compress(timeseries, 0.5))
+
+    # Streaming compression matches compress(), however it is fed
+    print("Running streaming trials")
+    def stream_compress(timeseries, tolerance=0):
+        compressor = Compressor(tolerance)
+        compressed_timeseries = []
+        points = iter(timeseries) # e.g. a file reader
+        chunk = [pt for _, pt in zip(range(rand_range(1, 100)), points)]
+        while chunk:
+            compressed_timeseries.extend(compressor.feed(chunk))
+            chunk = [pt for _, pt in zip(range(rand_range(1, 100)), points)]
+        last_pts, update_rate = compressor.finish()
+        return compressed_timeseries + last_pts, update_rate
+    for tolerance in [0, 1.0]:
+        for i in range(10): # run this many trials
+            timeseries = [(t/N, float(rand_range(0, 3)) + rand_float(-1.0, 1.0)*(i % 2)) \
+                    for t in range(N)]
+            assert(stream_compress(timeseries, tolerance) == compress(timeseries, tolerance))
+            compressed_timeseries, update_rate = compress(timeseries, tolerance)
+            uncompressed = iter_uncompress(iter(compressed_timeseries), update_rate)
+            assert(list(uncompressed) == uncompress(compressed_timeseries, update_rate))
+    assert(stream_compress([]) == ([], 0))
+    assert(stream_compress([(0.0, 1.0)]) == ([(0.0, 1.0)], 0))
+
     print('compress()/uncompress() Testing Passed!')
@@ -1,7 +1,24 @@
 from .shared import *
-from .compression import uncompress
+from .compression import iter_uncompress
+from file_database.metrics import timed
 
-def get_exceedences(actual_data, expected_data, sample_time, lsb=0, latency=0, variance=0):
+from collections import deque
+from math import ceil
+from itertools import zip_longest
+
+# Number of samples the actual data is allowed to lag behind the
+# expected data, rounded up to whole samples
+def get_latency_samples(latency, sample_time):
+    if not latency:
+        return 0
+    return int(ceil(latency/float(sample_time) - EPSILON))
+
+# Allowed difference from the expected data. Actual data is quantised
+# to lsb, so half an lsb either way is allowed on top of the variance
+def get_band(lsb=0, variance=0):
+    return variance + lsb/2.
+
+def check_boundaries(actual_data, expected_data):
     # Ensure input data is the right types
     check_list(actual_data)
     check_list(expected_data)
@@ -18,46 +35,173 @@ def get_exceedences(actual_data, expected_data, sample_time, lsb=0, latency=0, v
     if a0_t != e0_t or aN_t != eN_t:
         raise ValueError("Begining and Ending Times must be aligned")
 
-    # Verify lists are same lengths, or else we can't do the algorithm
-    a_decompressed = False
-    e_decompressed = False
-    if len(actual_data) != len(expected_data) or \
-            [t for t, _ in actual_data] != \
-            [t for t, _ in expected_data]:
-                # Check for data equivalency and decompress
-                # to attempt to get lengths to match
-                if len(actual_data) < len(expected_data):
-                    actual_data = uncompress(actual_data, sample_time)
-                    a_decompressed = True
-                if len(expected_data) < len(actual_data):
-                    expected_data = uncompress(expected_data, sample_time)
-                    e_decompressed = True
-                if len(actual_data) < len(expected_data) and not a_decompressed:
-                    actual_data = uncompress(actual_data, sample_time)
-                    a_decompressed = True
-                # If it still doesn't match then it's an error
-                if len(actual_data) != len(expected_data) or \
-                        [t for t, _ in actual_data] != \
-                        [t for t, _ in expected_data]:
-                    raise ValueError("Decompressed data doesn't align!")
+@timed('timeseries.get_exceedences')
+def get_exceedences(actual_data, expected_data, sample_time, lsb=0, latency=0, variance=0):
+    check_boundaries(actual_data, expected_data)
+
+    # Unless both lists are sampled at the same times, every sample_time
+    # (not e.g. both compressed with the same breakpoints, so the latency
+    # window counts samples), decompress them (lazily) so we compare
+    # samples at every sample time
+    aligned = len(actual_data) == len(expected_data) and \
+            all(a_t == e_t for (a_t, _), (e_t, _) in zip(actual_data, expected_data)) and \
+            all(abs(get_update_rate(next_t, prev_t) - sample_time) < sample_time*EPSILON \
+                    for (prev_t, _), (next_t, _) in zip(expected_data, expected_data[1:]))
+    if aligned:
+        samples = zip(actual_data, expected_data)
+    else:
+        samples = zip_longest(iter_uncompress(actual_data, sample_time), \
+                iter_uncompress(expected_data, sample_time))
 
     # Start our checking algorithm
+    window = get_latency_samples(latency, sample_time)
+    band = get_band(lsb, variance) + EPSILON
+    # Expected data over the latency window, kept as monotonic queues
+    # of (index, data) so the min/max are always at the front
+    window_max = deque()
+    window_min = deque()
     exceedences = []
-    for a_pt, e_pt in zip(actual_data, expected_data):
-        if not a_decompressed:
+    last_exceeded = False
+    for i, (a_pt, e_pt) in enumerate(samples):
+        if a_pt is None or e_pt is None or \
+                round(a_pt[0], SIGFIGS) != round(e_pt[0], SIGFIGS):
+            raise ValueError("Decompressed data doesn't align!")
+        if aligned:
             check_tuple(a_pt)
-        if not e_decompressed:
             check_tuple(e_pt)
+        a_time, a_data = a_pt
+        _, e_data = e_pt
 
-        # Ensure each actual point is within the bound given by the shape 
-        # drawn via the expected shape skewed in  +/- X and + T directions
-        # given our values of latency and variance.
-        
-        # Ensure these shapes are on proper bounds given our values of lsb
-        # and sample time so we don't get false negatives.
+        # The actual data is allowed to be anywhere the expected data
+        # was in the last latency window (skewed in the +T direction)...
+        while window_max and window_max[-1][1] <= e_data:
+            window_max.pop()
+        window_max.append((i, e_data))
+        while window_min and window_min[-1][1] >= e_data:
+            window_min.pop()
+        window_min.append((i, e_data))
+        while window_max[0][0] < i - window:
+            window_max.popleft()
+        while window_min[0][0] < i - window:
+            window_min.popleft()
 
-        # If we have a confirmed positive exceedence, append it to our list of exceedences
-        # This should return an entire section of points that exceed our bounds
+        # ...give or take the variance (skewed in the +/- X directions)
+        exceeded = a_data > window_max[0][1] + band or \
+                a_data < window_min[0][1] - band
+
+        # If we have a confirmed positive exceedence, add it to our list of exceedences
+        # (an entire section of points that exceed our bounds is one exceedence)
+        if exceeded and last_exceeded:
+            exceedences[-1] = (exceedences[-1][0], a_time)
+        elif exceeded:
+            exceedences.append((a_time, a_time))
+        last_exceeded = exceeded
+
+    return exceedences
+
+class LinearInterpolator(object):
+    '''
+    Values of a piecewise-linear timeseries (e.g. compressed data)
+    at increasing times, by walking its segments forward
+    '''
+    def __init__(self, timeseries):
+        self._timeseries = timeseries
+        self._i = 0
+
+    def __call__(self, time):
+        timeseries = self._timeseries
+        while self._i < len(timeseries) - 2 and timeseries[self._i + 1][0] <= time:
+            self._i += 1
+        if len(timeseries) == 1:
+            return timeseries[0][1]
+        (t0, d0), (t1, d1) = timeseries[self._i], timeseries[self._i + 1]
+        return d0 + calc_slope(t0, d0, t1, d1)*(time - t0)
+
+# Part of [t0, t1] where every line (given by its values at t0
+# and t1) is positive, as a (start, end) interval or None
+def positive_interval(t0, t1, lines):
+    start, end = t0, t1
+    for v0, v1 in lines:
+        if v0 <= 0 and v1 <= 0:
+            return None
+        if v0 > 0 and v1 > 0:
+            continue
+        # Solve for the crossing time
+        crossing = t0 + (t1 - t0)*v0/(v0 - v1)
+        if v0 > 0:
+            end = min(end, crossing)
+        else:
+            start = max(start, crossing)
+    return (start, end) if start < end else None
+
+# Same check as get_exceedences(), done directly on the piecewise-linear
+# compressed data (e.g. from compress()) without decompressing it.
+# Within each piece between breakpoints (of the actual data, expected
+# data, and expected data delayed by latency) the bounds are made of
+# lines, so the exceedences are found by solving for where the actual
+# data crosses them. Returns the (start, end) time intervals where
+# the actual data is out of bounds. Runs in O(number of breakpoints).
+@timed('timeseries.get_segment_exceedences')
+def get_segment_exceedences(actual_data, expected_data, sample_time, \
+        lsb=0, latency=0, variance=0):
+    check_boundaries(actual_data, expected_data)
+    start_time = expected_data[0][0]
+    end_time = expected_data[-1][0]
+    latency = get_latency_samples(latency, sample_time)*sample_time
+    band = get_band(lsb, variance) + EPSILON
+
+    # Every time the shape of the bounds or actual data can change
+    times = set(t for t, _ in actual_data)
+    times.update(t for t, _ in expected_data)
+    times.update(t + latency for t, _ in expected_data if t + latency < end_time)
+    times = sorted(times)
+
+    actual = LinearInterpolator(actual_data)
+    expected = LinearInterpolator(expected_data)
+    delayed = LinearInterpolator(expected_data)
+    # Expected breakpoints inside the latency window, kept as
+    # monotonic queues of data so the min/max are always at the front
+    window_max = deque()
+    window_min = deque()
+    next_bp = 0
+    exceedences = []
+    last_time, last_values = None, None
+    for time in times:
+        values = (actual(time), expected(time), delayed(max(time - latency, start_time)))
+        if last_time is None:
+            last_time, last_values = time, values
+            continue
+
+        # Breakpoints strictly inside the window for this whole piece
+        while next_bp < len(expected_data) and expected_data[next_bp][0] <= last_time:
+            bp = expected_data[next_bp]
+            while window_max and window_max[-1][1] <= bp[1]:
+                window_max.pop()
+            window_max.append(bp)
+            while window_min and window_min[-1][1] >= bp[1]:
+                window_min.pop()
+            window_min.append(bp)
+            next_bp += 1
+        while window_max and window_max[0][0] + latency < time:
+            window_max.popleft()
+        while window_min and window_min[0][0] + latency < time:
+            window_min.popleft()
+
+        # Above every upper bound, or below every lower bound
+        (a0, e0, d0), (a1, e1, d1) = last_values, values
+        above = [(a0 - band - e0, a1 - band - e1), (a0 - band - d0, a1 - band - d1)]
+        below = [(e0 - band - a0, e1 - band - a1), (d0 - band - a0, d1 - band - a1)]
+        if window_max:
+            above.append((a0 - band - window_max[0][1], a1 - band - window_max[0][1]))
+            below.append((window_min[0][1] - band - a0, window_min[0][1] - band - a1))
+        for exceedence in sorted(filter(None, [positive_interval(last_time, time, above), \
+                positive_interval(last_time, time, below)])):
+            # Join exceedences that continue across pieces
+            if exceedences and exceedence[0] <= exceedences[-1][1] + EPSILON:
+                exceedences[-1] = (exceedences[-1][0], max(exceedences[-1][1], exceedence[1]))
+            else:
+                exceedences.append(exceedence)
+        last_time, last_values = time, values
 
     return exceedences
 
@@ -66,10 +210,78 @@ if __name__ == '__main__':
     assert(get_exceedences([(0, 1), (1, 1)], [(0, 1), (1, 1)], 1) == [])
 
     from random import randrange as rand_range
-    from .compression import compress
+    from .compression import compress, uncompress
     N = 100
     for _ in range(10): # run this many trials
         timeseries, sample_time = compress([(t/N, rand_range(0,2)) for t in range(N+1)])
         assert(get_exceedences(timeseries, [(0,1), (1,1)], sample_time, variance=1) == [])
 
+    # Exceedences are sections of samples outside of the bounds
+    expected = [(t/10, 0.0) for t in range(11)]
+    actual = [(t/10, 0.0) for t in range(11)]
+    actual[3] = (0.3, 2.0)
+    actual[4] = (0.4, -2.0)
+    actual[8] = (0.8, 1.5)
+    assert(get_exceedences(actual, expected, 0.1, variance=1) == [(0.3, 0.4), (0.8, 0.8)])
+    assert(get_exceedences(actual, expected, 0.1, variance=1, lsb=1) == [(0.3, 0.4)])
+    assert(get_exceedences(actual, expected, 0.1, variance=2) == [])
+    assert(get_exceedences(compress(actual)[0], compress(expected)[0], 0.1, \
+            variance=1) == [(0.3, 0.4), (0.8, 0.8)])
+
+    # Latency allows the actual data to lag the expected data
+    expected = [(t/10, 0.0 if t < 5 else 1.0) for t in range(11)]
+    actual = [(t/10, 0.0 if t < 7 else 1.0) for t in range(11)]
+    assert(get_exceedences(actual, expected, 0.1, variance=0.5) == [(0.5, 0.6)])
+    assert(get_exceedences(actual, expected, 0.1, latency=0.2, variance=0.5) == [])
+    assert(get_exceedences(actual, expected, 0.1, latency=0.15, variance=0.5) == [])
+    assert(get_exceedences(actual, expected, 0.1, latency=0.1, variance=0.5) == [(0.6, 0.6)])
+    # ...but not lead it
+    assert(get_exceedences(expected, actual, 0.1, latency=0.2, variance=0.5) == [(0.5, 0.6)])
+    # Lists with the same breakpoints aren't samples, so the
+    # latency window is still in samples (not breakpoints)
+    expected = [(0, 0), (5, 0), (5.1, 10), (10, 10)]
+    actual = [(0, 0), (5, 0), (5.1, 0), (10, 10)]
+    exceedences = get_exceedences(actual, expected, 0.1, latency=0.1, variance=0.5)
+    assert(exceedences == get_exceedences(uncompress(actual, 0.1), uncompress(expected, 0.1), \
+            0.1, latency=0.1, variance=0.5))
+    assert([(round(s, 3), round(e, 3)) for s, e in exceedences] == [(5.2, 9.7)])
+
+    # Long signals
+    N = 100000
+    expected = [(0.0, 0.0), (N/1000, 100.0)]
+    actual = [(t/1000, t/1000 + (t % 100)/1000.) for t in range(N+1)]
+    assert(get_exceedences(actual, expected, 0.001, variance=0.1) == [])
+    actual[N//2] = (actual[N//2][0], 0.0)
+    assert(get_exceedences(actual, expected, 0.001, variance=0.1) == [(N/2000, N/2000)])
+
     print("get_exceedences() Testing Passed!")
+
+    # Segment version agrees with the sampled version at every sample
+    from random import uniform as rand_float
+    def exceeded_at(exceedences, time):
+        return any(start <= time <= end for start, end in exceedences)
+    N = 200
+    for i in range(20): # run this many trials
+        expected, sample_time = compress([(t/N, float(rand_range(0, 5) // 2)) for t in range(N+1)])
+        actual, _ = compress([(t/N, float(rand_range(0, 5) // 2)) for t in range(N+1)])
+        for latency in [0, 0.01, 0.1]:
+            segment_exceedences = get_segment_exceedences(actual, expected, sample_time, \
+                    latency=latency, variance=0.5)
+            sample_exceedences = get_exceedences(actual, expected, sample_time, \
+                    latency=latency, variance=0.5)
+            for t, _ in uncompress(actual, sample_time):
+                assert(exceeded_at(segment_exceedences, t) == exceeded_at(sample_exceedences, t))
+
+    # Crossing times are solved for between breakpoints
+    expected = [(0.0, 0.0), (10.0, 0.0)]
+    actual = [(0.0, 0.0), (10.0, 10.0)]
+    assert(get_segment_exceedences(actual, expected, 1.0, variance=2) == [(2.0 + EPSILON, 10.0)])
+    actual = [(0.0, 0.0), (5.0, -5.0), (10.0, 0.0)]
+    assert([(round(s, 3), round(e, 3)) for s, e in \
+            get_segment_exceedences(actual, expected, 1.0, variance=2)] == [(2.0, 8.0)])
+    # Cost depends on breakpoints, not duration
+    expected = [(0.0, 0.0), (1e6, 1e6)]
+    actual = [(0.0, 0.0), (1.0, 0.0), (1e6, 1e6 - 1.0)] # lags by 1.0
+    assert(get_segment_exceedences(actual, expected, 0.001, latency=1.0, variance=0.5) == [])
+    assert(get_segment_exceedences(actual, expected, 0.001, variance=0.5) != [])
+    print("get_segment_exceedences() Testing Passed!")
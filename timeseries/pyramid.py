@@ -0,0 +1,259 @@
+from .sidecar import DTYPES, write_atomic
+from file_database.metrics import timed
+
+from collections import namedtuple
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from zlib import crc32
+
+import numpy as np
+
+# Level of detail pyramid of a timeseries, for plotting any window of
+# it at any zoom without sending every sample. Level k splits the
+# samples into buckets of 2**k samples (aligned to the first sample),
+# and a query picks the level with at most about one bucket per pixel.
+#
+# Only the minimum and maximum of every bucket are stored, from the
+# base level up to the level with a single bucket. The first and last
+# values of the buckets (and their times) are read from the timeseries
+# itself, one sample per bucket. Levels below the base level are
+# computed when queried, from at most 2**base_level samples per pixel.
+#
+# A written pyramid keeps the checksum of the data it was built from,
+# so it can be checked against the timeseries it is read for.
+
+# magic, version, dtype, base level, number of samples, checksum
+HEADER = Struct('<4sBBBxQI4x')
+MAGIC = b'NFLP'
+VERSION = 2
+
+# Buckets of a window of a timeseries at a level: the times of the
+# first and last samples of each bucket, and the first, minimum,
+# maximum and last values
+Buckets = namedtuple('Buckets', ['level', 'start_times', 'end_times', \
+        'first', 'min', 'max', 'last'])
+
+def _bucket_count(count, level):
+    return (count + (1 << level) - 1) >> level
+
+# Levels stored for a timeseries of count samples
+def _level_range(count, base_level):
+    if not count:
+        return range(base_level, base_level)
+    top_level = max(base_level, (count - 1).bit_length())
+    return range(base_level, top_level + 1)
+
+# Indexes (i0, i1) of the samples from t0 to t1 (from the start
+# or to the end if not given), by binary search of the sorted times
+def find_window(times, t0=None, t1=None):
+    i0 = 0 if t0 is None else int(np.searchsorted(times, t0, 'left'))
+    i1 = len(times) if t1 is None else int(np.searchsorted(times, t1, 'right'))
+    return i0, max(i0, i1)
+
+# Minimum and maximum of every bucket of 2**level samples
+def _reduce(data, level):
+    starts = np.arange(0, len(data), 1 << level)
+    return np.minimum.reduceat(data, starts), np.maximum.reduceat(data, starts)
+
+# Minimum and maximum of every pair of buckets
+def _halve(mins, maxs):
+    if len(mins) % 2:
+        mins, maxs = np.append(mins, mins[-1]), np.append(maxs, maxs[-1])
+    return np.minimum(mins[0::2], mins[1::2]), np.maximum(maxs[0::2], maxs[1::2])
+
+# Checksum of the data of a timeseries (as stored, so
+# the same values in another dtype don't match)
+def checksum(data):
+    return crc32(np.ascontiguousarray(data))
+
+class Pyramid(object):
+    '''
+    Minimum and maximum of the buckets of every level (see above) of a
+    timeseries of count samples, as a list of (mins, maxs) arrays from
+    the base level up. Build one with build() (or read one written with
+    write_pyramid(), along with the checksum of its data), and query it
+    along with the timeseries.
+    '''
+    def __init__(self, count, levels, base_level=3, checksum=None):
+        self.count = count
+        self.levels = levels
+        self.base_level = base_level
+        self.checksum = checksum
+
+    def __repr__(self):
+        return "{0}(count={1}, levels={2})".format(self.__class__.__name__, \
+                self.count, len(self.levels))
+
+    @classmethod
+    @timed('timeseries.build_pyramid')
+    def build(cls, data, base_level=3):
+        data = np.asarray(data)
+        levels = []
+        for level in _level_range(len(data), base_level):
+            levels.append(_reduce(data, level) if not levels else _halve(*levels[-1]))
+        return cls(len(data), levels, base_level)
+
+    # Level for plotting samples with at most width (and at least
+    # half as many) buckets, not above the top level
+    def level_for(self, samples, width):
+        level = 0
+        while _bucket_count(samples, level) > max(width, 1):
+            level += 1
+        if self.levels:
+            level = min(level, self.base_level + len(self.levels) - 1)
+        return level
+
+    # Buckets covering the window of the timeseries (with times sorted)
+    # from t0 to t1 (the whole timeseries by default), at the level for
+    # plotting it width pixels wide. At level 0, buckets are samples
+    @timed('timeseries.query_pyramid')
+    def query(self, times, data, t0=None, t1=None, width=1000):
+        if len(times) != self.count or len(data) != self.count:
+            raise ValueError("Pyramid is not for this timeseries!")
+        i0, i1 = find_window(times, t0, t1)
+        level = self.level_for(i1 - i0, width)
+        size = 1 << level
+        b0, b1 = i0 >> level, _bucket_count(i1, level)
+        starts = np.arange(b0, b1)*size
+        ends = np.minimum(starts + size, self.count) - 1
+        if level == 0:
+            mins = maxs = data[i0:i1]
+        elif level >= self.base_level:
+            mins, maxs = self.levels[level - self.base_level]
+            mins, maxs = mins[b0:b1], maxs[b0:b1]
+        else:
+            mins, maxs = _reduce(data[b0*size:min(b1*size, self.count)], level)
+        return Buckets(level, times[starts], times[ends], data[starts], mins, maxs, \
+                data[ends])
+
+# Plot points of buckets, as (times, data) arrays: the first, minimum,
+# maximum and last values of each bucket, with the minimum and maximum
+# (whose times aren't kept) drawn between the first and last times
+def to_points(buckets):
+    if buckets.level == 0:
+        return buckets.start_times, buckets.first
+    middle = (buckets.start_times + buckets.end_times)/2
+    times = np.stack([buckets.start_times, middle, middle, buckets.end_times], axis=1)
+    data = np.stack([buckets.first, buckets.min, buckets.max, buckets.last], axis=1)
+    return times.ravel(), data.ravel()
+
+# Levels are stored one after the other, each as its minimums followed
+# by its maximums. The checksum is of the data the pyramid is for
+def write_pyramid(filepath, pyramid, dtype='float64', checksum=0):
+    if dtype not in DTYPES:
+        raise ValueError("Pyramid dtype must be one of {}!".format(DTYPES))
+    arrays = [np.ascontiguousarray(a, dtype=dtype).tobytes() \
+            for level in pyramid.levels for a in level]
+    write_atomic(filepath, HEADER.pack(MAGIC, VERSION, DTYPES.index(dtype), \
+            pyramid.base_level, pyramid.count, checksum), *arrays)
+
+# Returns the Pyramid, with its levels as read-only
+# views of the file mapped in memory
+def read_pyramid(filepath):
+    with open(filepath, 'rb') as f:
+        buf = mmap(f.fileno(), 0, access=ACCESS_READ)
+    magic, version, dtype, base_level, count, checksum = HEADER.unpack_from(buf)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a timeseries pyramid!")
+    dtype = DTYPES[dtype]
+    offset = HEADER.size
+    levels = []
+    for level in _level_range(count, base_level):
+        buckets = _bucket_count(count, level)
+        mins = np.frombuffer(buf, dtype=dtype, count=buckets, offset=offset)
+        offset += mins.nbytes
+        maxs = np.frombuffer(buf, dtype=dtype, count=buckets, offset=offset)
+        offset += maxs.nbytes
+        levels.append((mins, maxs))
+    return Pyramid(count, levels, base_level, checksum)
+
+if __name__ == '__main__':
+    from os import remove as file_remove
+    from os.path import getsize as file_size
+    from random import Random
+
+    # Every level matches reducing the samples directly
+    rng = Random(0)
+    data = np.array([rng.uniform(-10, 10) for _ in range(1000)])
+    times = np.round(np.arange(len(data))*0.001, 6)
+    pyramid = Pyramid.build(data)
+    assert(len(pyramid.levels) == 8) # Buckets of 8 to 1024 samples
+    for i, (mins, maxs) in enumerate(pyramid.levels):
+        size = 1 << (pyramid.base_level + i)
+        assert(np.array_equal(mins, [data[j:j + size].min() for j in range(0, 1000, size)]))
+        assert(np.array_equal(maxs, [data[j:j + size].max() for j in range(0, 1000, size)]))
+    assert(len(pyramid.levels[-1][0]) == 1 and pyramid.levels[-1][1][0] == data.max())
+
+    # Queries cover the window with at most width buckets
+    for t0, t1, width in [(None, None, 1000), (None, None, 100), (0.1, 0.2, 10), \
+            (0.1005, 0.1995, 3), (0.5, 0.5, 10), (0.0, 0.999, 1), (0.9, 5.0, 7)]:
+        buckets = pyramid.query(times, data, t0, t1, width)
+        i0 = 0 if t0 is None else int(np.searchsorted(times, t0))
+        i1 = 1000 if t1 is None else int(np.searchsorted(times, t1, 'right'))
+        size = 1 << buckets.level
+        assert(len(buckets.first) <= width + 1)
+        assert(buckets.level == 0 or 2*_bucket_count(i1 - i0, buckets.level) > width)
+        assert(buckets.start_times[0] <= times[i0] and buckets.end_times[-1] >= times[i1 - 1])
+        for j, start in enumerate(range((i0 // size)*size, i1, size)):
+            window = data[start:start + size]
+            assert(buckets.first[j] == window[0] and buckets.last[j] == window[-1])
+            assert(buckets.min[j] == window.min() and buckets.max[j] == window.max())
+    # Raw samples when zoomed in
+    buckets = pyramid.query(times, data, 0.1, 0.2, 1000)
+    assert(buckets.level == 0 and np.array_equal(buckets.first, data[100:201]))
+    plot_times, plot_data = to_points(buckets)
+    assert(np.array_equal(plot_times, times[100:201]))
+    plot_times, plot_data = to_points(pyramid.query(times, data, width=10))
+    assert(len(plot_times) == len(plot_data) == 4*8 and plot_data.max() == data.max())
+    assert(np.all(np.diff(plot_times) >= 0))
+    assert(find_window(times, 0.1, 0.2) == (100, 201))
+    assert(find_window(times, 0.1005) == (101, 1000) and find_window(times) == (0, 1000))
+    # Empty windows
+    assert(find_window(times, 0.5, 0.4) == (500, 500))
+    assert(len(pyramid.query(times, data, 2.0, 3.0).first) == 0)
+    assert(len(pyramid.query(times, data, 0.5, 0.4).first) == 0)
+    try:
+        pyramid.query(times[1:], data[1:])
+        assert(False)
+    except ValueError:
+        pass
+
+    # Small and empty timeseries
+    for n in [0, 1, 5, 8, 9]:
+        small = Pyramid.build(data[:n])
+        buckets = small.query(times[:n], data[:n], width=1)
+        assert(len(buckets.first) == min(n, 1))
+        if n:
+            assert(buckets.min[0] == data[:n].min() and buckets.max[0] == data[:n].max())
+
+    # Written and read back
+    filepath = 'test.lod'
+    for dtype in DTYPES:
+        write_pyramid(filepath, pyramid, dtype, checksum(data.astype(dtype)))
+        read = read_pyramid(filepath)
+        assert(read.count == 1000 and len(read.levels) == len(pyramid.levels))
+        assert(read.checksum == checksum(data.astype(dtype)) != checksum(data[::-1]))
+        for (mins, maxs), (read_mins, read_maxs) in zip(pyramid.levels, read.levels):
+            assert(np.array_equal(mins.astype(dtype), read_mins))
+            assert(np.array_equal(maxs.astype(dtype), read_maxs))
+        del read, mins, maxs, read_mins, read_maxs # Release the memory map
+    # Far smaller than the timeseries
+    assert(file_size(filepath) < 2*4*1000/3)
+    with open(filepath, 'wb') as f:
+        f.write(b'\0'*HEADER.size)
+    try:
+        read_pyramid(filepath)
+        assert(False)
+    except ValueError:
+        pass
+    file_remove(filepath)
+
+    # A long timeseries gives a few thousand points at any zoom
+    N = 10000000
+    times = np.round(np.arange(N)*0.001, 6)
+    data = np.sin(times)
+    pyramid = Pyramid.build(data)
+    for t0, t1 in [(None, None), (1000.0, 5000.0), (1234.5, 1240.0), (9999.0, 9999.9)]:
+        buckets = pyramid.query(times, data, t0, t1, width=1000)
+        assert(len(buckets.first) <= 1001 and len(to_points(buckets)[0]) <= 4004)
+    print("Pyramid() Testing Passed!")
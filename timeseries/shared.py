@@ -30,3 +30,11 @@ def add_and_round(prev_time, update_rate):
 
 def calc_slope(prev_time, prev_data, next_time, next_data):
     return (next_data - prev_data) / float((next_time - prev_time))
+
+# Default error bound for lossy compression of data with the given
+# lsb/variance (e.g. of a VerifyObject): half an lsb, which is below
+# the resolution of the data, or without an lsb a tenth of the variance
+def get_tolerance(lsb=0, variance=0):
+    if lsb:
+        return lsb/2.
+    return variance/10.
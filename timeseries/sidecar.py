@@ -0,0 +1,175 @@
+from file_database.metrics import timed
+
+from mmap import mmap, ACCESS_READ
+from os import remove as file_remove, replace as file_replace, fdopen
+from os.path import split as path_split
+from struct import Struct
+from tempfile import mkstemp
+from zlib import compress as zlib_compress, decompress as zlib_decompress
+
+import numpy as np
+
+# lz4 is optional, only needed for sidecars compressed with it
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Binary storage for a timeseries, next to the file that references it.
+# A sidecar holds a header followed by the times and then the data, as
+# packed float64 (or float32) arrays. Uncompressed sidecars are read
+# through a memory map without copying anything. Optionally, the
+# values are delta-encoded (each value is XORed bitwise with the one
+# before it, so it is lossless and slowly changing values become mostly
+# zero bits) and/or compressed with zlib or lz4.
+
+# magic, version, dtype, flags, reserved, number of points
+HEADER = Struct('<4sBBBxQ')
+MAGIC = b'NFTS'
+VERSION = 1
+
+DTYPES = ['float64', 'float32']
+UINTS = {'float64': np.uint64, 'float32': np.uint32}
+
+DELTA = 0x1
+ZLIB = 0x2
+LZ4 = 0x4
+COMPRESSIONS = {None: 0, 'zlib': ZLIB, 'lz4': LZ4}
+
+def delta_encode(values):
+    bits = values.view(UINTS[values.dtype.name])
+    encoded = bits.copy()
+    encoded[1:] ^= bits[:-1]
+    return encoded.view(values.dtype)
+
+def delta_decode(values):
+    bits = values.view(UINTS[values.dtype.name])
+    return np.bitwise_xor.accumulate(bits).view(values.dtype)
+
+def check_compression(compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError("Compression '{}' is not supported!".format(compression))
+    if compression == 'lz4' and lz4_frame is None:
+        raise ValueError("lz4 is not installed!")
+
+@timed('timeseries.write_sidecar')
+def write_sidecar(filepath, times, data, dtype='float64', delta=False, compression=None):
+    if dtype not in DTYPES:
+        raise ValueError("Sidecar dtype must be one of {}!".format(DTYPES))
+    check_compression(compression)
+    times = np.ascontiguousarray(times, dtype=dtype)
+    data = np.ascontiguousarray(data, dtype=dtype)
+    if len(times) != len(data):
+        raise ValueError("Times and data must be the same length!")
+
+    flags = (DELTA if delta else 0) | COMPRESSIONS[compression]
+    if delta:
+        times, data = delta_encode(times), delta_encode(data)
+    payload = times.tobytes() + data.tobytes()
+    if compression == 'zlib':
+        payload = zlib_compress(payload)
+    elif compression == 'lz4':
+        payload = lz4_frame.compress(payload)
+
+    write_atomic(filepath, HEADER.pack(MAGIC, VERSION, DTYPES.index(dtype), flags, \
+            len(times)), payload)
+
+# Replace the file with the chunks in one step, so readers (and
+# memory maps of the old file) never see a partially written file
+def write_atomic(filepath, *chunks):
+    directory, filename = path_split(filepath)
+    fd, temp_filepath = mkstemp(dir=directory or '.', \
+            prefix='.' + filename + '.', suffix='.tmp')
+    try:
+        with fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        file_replace(temp_filepath, filepath)
+    except BaseException:
+        file_remove(temp_filepath)
+        raise
+
+def read_header(buf):
+    magic, version, dtype, flags, count = HEADER.unpack_from(buf)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a timeseries sidecar!")
+    return DTYPES[dtype], flags, count
+
+# Returns (times, data) as read-only arrays. Without delta-encoding or
+# compression these are views of the file mapped in memory
+@timed('timeseries.read_sidecar')
+def read_sidecar(filepath):
+    with open(filepath, 'rb') as f:
+        buf = mmap(f.fileno(), 0, access=ACCESS_READ)
+    dtype, flags, count = read_header(buf)
+    offset = HEADER.size
+    if flags & (ZLIB | LZ4):
+        payload = memoryview(buf)[offset:]
+        if flags & ZLIB:
+            payload = zlib_decompress(payload)
+        else:
+            check_compression('lz4')
+            payload = lz4_frame.decompress(payload)
+        buf, offset = payload, 0
+    times = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+    data = np.frombuffer(buf, dtype=dtype, count=count, \
+            offset=offset + count*times.itemsize)
+    if flags & DELTA:
+        times, data = delta_decode(times), delta_decode(data)
+        times.flags.writeable = False
+        data.flags.writeable = False
+    return times, data
+
+if __name__ == '__main__':
+    from os.path import getsize as file_size
+
+    filepath = 'test.ts'
+    N = 1000000
+    times = np.round(np.arange(N)*0.001, 6)
+    data = np.round(np.sin(times), 3)
+
+    options = [{}, {'delta': True}, {'compression': 'zlib'}, \
+            {'delta': True, 'compression': 'zlib'}]
+    if lz4_frame is not None:
+        options.append({'delta': True, 'compression': 'lz4'})
+    for dtype in DTYPES:
+        for kwargs in options:
+            write_sidecar(filepath, times, data, dtype=dtype, **kwargs)
+            t, d = read_sidecar(filepath)
+            assert(t.dtype == dtype and d.dtype == dtype)
+            assert(np.array_equal(t, times.astype(dtype)))
+            assert(np.array_equal(d, data.astype(dtype)))
+            assert(not t.flags.writeable and not d.flags.writeable)
+            del t, d # Release the memory map
+
+    # Uncompressed is exactly the header and the arrays
+    write_sidecar(filepath, times, data)
+    assert(file_size(filepath) == HEADER.size + 2*8*N)
+    # Delta-encoding helps compressing the regular times
+    write_sidecar(filepath, times, data, compression='zlib')
+    zlib_size = file_size(filepath)
+    write_sidecar(filepath, times, data, delta=True, compression='zlib')
+    assert(file_size(filepath) < zlib_size)
+
+    # Empty timeseries
+    write_sidecar(filepath, [], [])
+    t, d = read_sidecar(filepath)
+    assert(len(t) == len(d) == 0)
+    del t, d
+
+    for args, kwargs in [(([0.0], []), {}), (([], []), {'dtype': 'int8'}), \
+            (([], []), {'compression': 'bz2'})]:
+        try:
+            write_sidecar(filepath, *args, **kwargs)
+            assert(False)
+        except ValueError:
+            pass
+    with open(filepath, 'wb') as f:
+        f.write(b'\0'*HEADER.size)
+    try:
+        read_sidecar(filepath)
+        assert(False)
+    except ValueError:
+        pass
+    file_remove(filepath)
+    print("write_sidecar()/read_sidecar() Testing Passed!")
@@ -0,0 +1,175 @@
+from .shared import EPSILON, SIGFIGS
+from .exceedence import get_latency_samples, get_band
+from file_database.metrics import timed
+
+import numpy as np
+
+# Array versions of compress()/uncompress() for long timeseries.
+# These take and return separate (contiguous) time and data arrays
+# instead of a list of (time, data) tuples.
+
+def to_arrays(timeseries):
+    if not len(timeseries):
+        return np.empty(0), np.empty(0)
+    times, data = zip(*timeseries)
+    return np.array(times, dtype=float), np.array(data, dtype=float)
+
+def to_timeseries(times, data):
+    return list(zip(times.tolist(), data.tolist()))
+
+@timed('timeseries.compress_arrays')
+def compress_arrays(times, data):
+    times = np.ascontiguousarray(times, dtype=float)
+    data = np.ascontiguousarray(data, dtype=float)
+    if len(times) != len(data):
+        raise ValueError("Times and data must be the same length!")
+    if not len(times) > 1:
+        return times, data, 0
+
+    time_steps = np.diff(times)
+    update_rate = float(time_steps[0])
+    if update_rate <= 0:
+        raise ValueError("Update Rate is not valid!")
+    # check if every rate is within 0.001% of update rate
+    if np.any(np.abs(time_steps - update_rate) >= update_rate*EPSILON):
+        raise ValueError("Update Rate not consistent!")
+
+    # Keep both points around every change in slope
+    # (same as compress(), but for every point at once)
+    slopes = np.diff(data) / time_steps
+    slope_changes = slopes[1:] != slopes[:-1]
+    keep = np.zeros(len(times), dtype=bool)
+    keep[0] = True
+    keep[1] = data[1] != data[0]
+    keep[1:-1] |= slope_changes
+    keep[2:] |= slope_changes
+    keep[-1] = True
+
+    return times[keep], data[keep], update_rate
+
+@timed('timeseries.uncompress_arrays')
+def uncompress_arrays(times, data, update_rate):
+    times = np.ascontiguousarray(times, dtype=float)
+    data = np.ascontiguousarray(data, dtype=float)
+    if not len(times) > 1:
+        return times, data
+
+    # Number of samples in each segment between compressed points
+    time_steps = np.diff(times)
+    steps = np.ceil(time_steps/update_rate - EPSILON).astype(np.int64)
+    segment = np.repeat(np.arange(len(steps)), steps)
+    # Step of each sample within its segment (1 to steps)
+    step = np.arange(1, len(segment) + 1) - \
+            np.repeat(np.cumsum(steps) - steps, steps)
+
+    slopes = np.diff(data) / time_steps
+    uncompressed_times = np.empty(len(segment) + 1)
+    uncompressed_data = np.empty(len(segment) + 1)
+    uncompressed_times[0] = times[0]
+    uncompressed_data[0] = data[0]
+    uncompressed_times[1:] = np.round(times[segment] + step*update_rate, SIGFIGS)
+    uncompressed_data[1:] = data[segment] + step*(slopes[segment]*update_rate)
+    # Compressed points are kept exactly
+    segment_ends = np.cumsum(steps)
+    uncompressed_times[segment_ends] = times[1:]
+    uncompressed_data[segment_ends] = data[1:]
+    return uncompressed_times, uncompressed_data
+
+# Maximum of x over the trailing window [i - window, i] for every i,
+# in O(n) using the van Herk/Gil-Werman block prefix/suffix maxima
+def sliding_max(x, window):
+    x = np.asarray(x, dtype=float)
+    size = window + 1
+    padded = np.full(window + len(x) + (-(window + len(x)) % size), -np.inf)
+    padded[window:window + len(x)] = x
+    blocks = padded.reshape(-1, size)
+    prefix = np.maximum.accumulate(blocks, axis=1).ravel()
+    suffix = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return np.maximum(suffix[:len(x)], prefix[window:window + len(x)])
+
+def sliding_min(x, window):
+    return -sliding_max(-np.asarray(x, dtype=float), window)
+
+# Array version of get_exceedences() for data sampled at the same
+# times (see uncompress_arrays()), with the same bounds
+@timed('timeseries.get_exceedences_arrays')
+def get_exceedences_arrays(times, actual, expected, sample_time, \
+        lsb=0, latency=0, variance=0):
+    times = np.asarray(times, dtype=float)
+    actual = np.asarray(actual, dtype=float)
+    expected = np.asarray(expected, dtype=float)
+    if not len(times) == len(actual) == len(expected):
+        raise ValueError("Times and data must be the same length!")
+    window = get_latency_samples(latency, sample_time)
+    band = get_band(lsb, variance) + EPSILON
+    exceeded = (actual > sliding_max(expected, window) + band) | \
+            (actual < sliding_min(expected, window) - band)
+    # Join consecutive exceeding samples into (start, end) intervals
+    edges = np.diff(np.concatenate(([False], exceeded, [False])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    return list(zip(times[starts].tolist(), times[ends].tolist()))
+
+if __name__ == '__main__':
+    from .compression import compress, uncompress
+    from random import randrange as rand_range, uniform as rand_float
+
+    def assert_matches(timeseries):
+        # Compressed points are exactly the same
+        compressed, update_rate = compress(timeseries)
+        c_times, c_data, c_update_rate = compress_arrays(*to_arrays(timeseries))
+        assert(to_timeseries(c_times, c_data) == [(float(t), float(d)) for t, d in compressed])
+        assert(c_update_rate == update_rate)
+        # Uncompressed points are the same to SIGFIGS
+        round_list = lambda l: [(round(t, SIGFIGS), round(d, SIGFIGS)) for t, d in l]
+        u_times, u_data = uncompress_arrays(c_times, c_data, c_update_rate)
+        assert(round_list(to_timeseries(u_times, u_data)) == \
+                round_list(uncompress(compressed, update_rate)))
+        assert(round_list(to_timeseries(u_times, u_data)) == round_list(timeseries))
+
+    # Same cases as compress()/uncompress()
+    assert_matches([])
+    assert_matches([(0.0, 0.0)])
+    assert_matches([(0.0, 0.0), (1.0, 0.0)])
+    assert_matches([(0.0, 1.0), (1.0, 1.0), (2.0, 1.0), (3.0, 1.0)])
+    assert_matches([(0.0, 0.0), (1.0, 0.0), (2.0, 0.0), (3.0, 2.0), (4.0, 2.0)])
+    assert_matches([(0.0, 0.0), (1.0, 1.0), (2.0, 2.0), (3.0, 3.0), (4.0, 3.0)])
+    assert_matches([(0.0, 0.0), (1.0, 0.0), (2.0, 1.0), (3.0, 2.0), (4.0, 3.0)])
+    N = 1000
+    for i in range(10):
+        assert_matches([(t/N, float(rand_range(0,2))) for t in range(N)])
+        assert_matches([(t/N, float(rand_range(0,10))) for t in range(N)])
+        assert_matches([(t/N, rand_float(-10.0,10.0)) for t in range(N)])
+
+    # Long ramps and flat lines
+    timeseries = [(float(t), float(min(t, N//2))) for t in range(10*N)]
+    assert_matches(timeseries)
+    assert(len(compress_arrays(*to_arrays(timeseries))[0]) == 5)
+
+    try:
+        compress_arrays([0.0, 1.0, 3.0], [0.0, 0.0, 0.0])
+        assert(False)
+    except ValueError:
+        pass
+
+    print('compress_arrays()/uncompress_arrays() Testing Passed!')
+
+    # Sliding windows and exceedences match the deque versions
+    from .exceedence import get_exceedences
+    x = np.array([rand_float(-1.0, 1.0) for _ in range(1000)])
+    for window in [0, 1, 2, 7, 999, 2000]:
+        assert(np.array_equal(sliding_max(x, window), \
+                [max(x[max(i-window, 0):i+1]) for i in range(len(x))]))
+        assert(np.array_equal(sliding_min(x, window), \
+                [min(x[max(i-window, 0):i+1]) for i in range(len(x))]))
+    for i in range(10):
+        expected = [(t/N, float(rand_range(0, 10))) for t in range(N)]
+        actual = [(t, d + rand_float(-2.0, 2.0)) for t, d in expected]
+        times, expected_data = to_arrays(expected)
+        _, actual_data = to_arrays(actual)
+        for latency in [0, 0.0025, 0.01]:
+            assert(get_exceedences_arrays(times, actual_data, expected_data, 1./N, \
+                    lsb=1, latency=latency, variance=1) == \
+                    get_exceedences(actual, expected, 1./N, lsb=1, latency=latency, variance=1))
+
+    print('get_exceedences_arrays() Testing Passed!')
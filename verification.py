@@ -0,0 +1,177 @@
+from file_database.parallel import map_chunks
+from testcase import TestCaseContentManager as TestCase
+from timeseries.compression import Compressor
+from timeseries.exceedence import get_segment_exceedences
+
+from csv import reader as csv_reader, writer as csv_writer
+from json import dumps as json_dumps
+from os.path import isfile as file_exists
+
+# Run data is stored as one CSV file of (time, data) rows per signal,
+# in a folder per testcase: <run_dir>/<testcase uid>/<signal name>.csv
+def run_data_path(run_dir, uid, name):
+    return '{0}/{1}/{2}.csv'.format(run_dir, uid, name)
+
+# Compressed run data, read row by row so that the whole recording
+# is never held in memory. Given a tolerance (e.g. get_tolerance() of
+# the signal, for storing it as prior-run data), points are dropped
+# as long as every sample stays within it (see Compressor). Run data
+# is verified without one, so no exceedence is smoothed away
+def read_run_data(filepath, tolerance=0):
+    compressor = Compressor(tolerance)
+    compressed_timeseries = []
+    with open(filepath, 'r', newline='') as f:
+        for row in csv_reader(f):
+            try:
+                pt = (float(row[0]), float(row[1]))
+            except ValueError:
+                continue # Header
+            compressed_timeseries.extend(compressor.feed([pt]))
+    last_pts, update_rate = compressor.finish()
+    return compressed_timeseries + last_pts, update_rate
+
+# Verify signals of a testcase, as a list (a single element is
+# parsed as a dict)
+def get_verify_signals(testcase):
+    signals = testcase.get('root/testcase/verify') or []
+    return signals if isinstance(signals, list) else [signals]
+
+# Worker: check every verify signal of each testcase against the run data
+def verify_chunk(fullpaths, run_dir):
+    results = []
+    for fullpath in fullpaths:
+        testcase = TestCase(fullpath)
+        uid = str(testcase.get_uid())
+        for signal in get_verify_signals(testcase):
+            result = {'fullpath': fullpath, 'uid': uid, 'signal': signal['@name'], \
+                    'passed': False, 'exceedences': [], 'error': None}
+            results.append(result)
+            filepath = run_data_path(run_dir, uid, signal['@name'])
+            if not file_exists(filepath):
+                result['error'] = 'No run data'
+                continue
+            try:
+                actual_data, _ = read_run_data(filepath)
+                expected_data = list(zip(*(d.tolist() \
+                        for d in testcase.load_timeseries(signal))))
+                result['exceedences'] = get_segment_exceedences(actual_data, expected_data, \
+                        float(signal['@sample_time']), lsb=float(signal.get('@lsb', 0)), \
+                        latency=float(signal.get('@latency', 0)), \
+                        variance=float(signal.get('@variance', 0)))
+                result['passed'] = not result['exceedences']
+            except (ValueError, KeyError, IndexError) as error:
+                result['error'] = str(error) or error.__class__.__name__
+    return results
+
+# Verify every testcase in the database (matching the file globbing)
+# against the run data across a pool of processes, yielding a result
+# for each verify signal as they come in
+def verify_runs(db, run_dir, fileglob='**/*', workers=None, chunksize=8):
+    # Workers read the files, so make sure they are up to date
+    db.flush()
+    fullpaths = db.get_fullpaths(fileglob)
+    for results in map_chunks(verify_chunk, fullpaths, (run_dir,), \
+            workers, chunksize, ordered=False):
+        for result in results:
+            result['basename'] = db._basename_from(result.pop('fullpath'))
+            yield result
+
+report_fields = ['basename', 'uid', 'signal', 'passed', 'error', 'exceedences']
+
+# Write results to a file as they come in, either as
+# JSON lines or CSV. Returns the number of failures
+def write_report(results, f, fmt='jsonl'):
+    failures = 0
+    if fmt == 'csv':
+        writer = csv_writer(f)
+        writer.writerow(report_fields)
+    for result in results:
+        failures += not result['passed']
+        if fmt == 'csv':
+            row = [result[k] for k in report_fields]
+            row[-1] = json_dumps(row[-1])
+            writer.writerow(row)
+        else:
+            f.write(json_dumps({k: result[k] for k in report_fields}) + '\n')
+        f.flush()
+    return failures
+
+if __name__ == '__main__':
+    from file_database.database import FileDatabase
+    from collections import OrderedDict
+    from io import StringIO
+    from json import loads as json_loads
+    from os import mkdir, listdir, remove as file_remove, rmdir
+
+    test_dir = 'verify_testdb'
+    run_dir = 'verify_testruns'
+    db = FileDatabase(test_dir, obj_class=TestCase, ext='xml')
+    mkdir(test_dir)
+    mkdir(run_dir)
+
+    # Testcases expecting a ramp, recorded either right or wrong
+    N = 10
+    for i in range(N):
+        db.add_obj('case-{}'.format(i))
+    for testcase in db.get_objs():
+        testcase.set('root/testcase/verify', [OrderedDict([('@name', name), \
+                ('@sample_time', '0.1'), ('@lsb', '0.0'), ('@latency', '0.0'), \
+                ('@variance', '0.5'), ('timeseries', [ \
+                    {'@time': '0.0', '@data': '0.0'}, {'@time': '1.0', '@data': '10.0'}])]) \
+                for name in ['ramp', 'missing']])
+        testcase._write()
+        uid = str(testcase.get_uid())
+        mkdir(run_dir + '/' + uid)
+        with open(run_data_path(run_dir, uid, 'ramp'), 'w') as f:
+            f.write('time,data\n')
+            for t in range(11):
+                wrong = testcase.basename == 'case-3' and t == 5
+                f.write('{},{}\n'.format(t/10, 0.0 if wrong else float(t)))
+
+    results = sorted(verify_runs(db, run_dir, workers=2, chunksize=3), \
+            key=lambda r: (r['basename'], r['signal']))
+    assert(len(results) == 2*N)
+    assert(all(r['error'] == 'No run data' for r in results if r['signal'] == 'missing'))
+    ramps = [r for r in results if r['signal'] == 'ramp']
+    assert([r['basename'] for r in ramps if not r['passed']] == ['case-3'])
+    assert(all(r['error'] is None for r in ramps))
+    assert(ramps[3]['exceedences'][0][0] < 0.5 < ramps[3]['exceedences'][0][1])
+
+    # Spikes just outside the variance are still caught (which
+    # compressing the run data within its tolerance would hide)
+    db.add_obj('spike')
+    testcase = next(db.get_objs('spike'))
+    testcase.set('root/testcase/verify', [OrderedDict([('@name', 'flat'), \
+            ('@sample_time', '0.1'), ('@lsb', '0.0'), ('@latency', '0.0'), \
+            ('@variance', '0.5'), ('timeseries', [ \
+                {'@time': '0.0', '@data': '0.0'}, {'@time': '10.0', '@data': '0.0'}])])])
+    testcase._write()
+    uid = str(testcase.get_uid())
+    mkdir(run_dir + '/' + uid)
+    with open(run_data_path(run_dir, uid, 'flat'), 'w') as f:
+        for t in range(101):
+            f.write('{},{}\n'.format(t/10, 0.52 if t == 50 else 0.49 if 40 <= t <= 60 else 0.0))
+    spike, = verify_chunk([testcase._filepath], run_dir)
+    assert(not spike['passed'] and spike['error'] is None)
+    assert(len(spike['exceedences']) == 1)
+    assert(4.9 < spike['exceedences'][0][0] < 5.0 < spike['exceedences'][0][1] < 5.1)
+
+    # Reports
+    report = StringIO()
+    assert(write_report(ramps, report) == 1)
+    assert([json_loads(l)['passed'] for l in report.getvalue().splitlines()].count(False) == 1)
+    report = StringIO()
+    assert(write_report(ramps, report, fmt='csv') == 1)
+    assert(report.getvalue().splitlines()[0] == ','.join(report_fields))
+    assert(len(report.getvalue().splitlines()) == N + 1)
+
+    # Remove testing directories
+    db.apply(lambda o: o.delete())
+    db.close()
+    rmdir(test_dir)
+    for uid in listdir(run_dir):
+        for fname in listdir(run_dir + '/' + uid):
+            file_remove(run_dir + '/' + uid + '/' + fname)
+        rmdir(run_dir + '/' + uid)
+    rmdir(run_dir)
+    print("verify_runs() Testing Passed!")
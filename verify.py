@@ -0,0 +1,29 @@
+from file_database.database import FileDatabase
+from testcase import TestCaseContentManager as TestCase
+from verification import verify_runs, write_report
+
+from argparse import ArgumentParser
+from sys import stdout, exit
+
+# Verify recorded runs against the testcases in the database, e.g.
+#   python verify.py testcases runs/nightly --workers 8 --output report.jsonl
+# Exits with 1 if any verify signal failed
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Verify run data against testcases")
+    parser.add_argument('db_root', help="testcase database folder")
+    parser.add_argument('run_dir', help="run data folder (<uid>/<signal>.csv)")
+    parser.add_argument('--glob', default='**/*', help="testcases to verify")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=8)
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('--output', default=None, help="report file (default stdout)")
+    args = parser.parse_args()
+
+    db = FileDatabase(args.db_root, obj_class=TestCase, ext='xml')
+    results = verify_runs(db, args.run_dir, args.glob, args.workers, args.chunksize)
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            failures = write_report(results, f, args.format)
+    else:
+        failures = write_report(results, stdout, args.format)
+    exit(1 if failures else 0)